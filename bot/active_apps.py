@@ -0,0 +1,136 @@
+"""
+Индекс активных заявок в памяти процесса
+
+Заявки в рабочих статусах читаются на каждое нажатие кнопки, строку чата и
+загрузку чека. Индекс держит их ApplicationView по id и по user_tg_id:
+Database обновляет его после каждой записи (write-through), заявки в
+конечных статусах выбрасываются, при старте индекс строится из БД.
+
+Заявки создаёт и API (отдельный процесс), поэтому промах — не «заявки нет»:
+Database читает БД и дополняет индекс. Чтобы чтение, начатое до записи, не
+перезаписало более свежее состояние, заполнение из БД принимается только
+если с его начала индекс не менялся (version).
+
+В шардированном запуске у каждого воркера свой индекс: listener получает id
+заявок после каждой записи (None — «все»), воркер рассылает их остальным,
+и те вызывают forget().
+
+API такие уведомления не получает, а статусы меняет бот, поэтому там индекс
+выключен (enabled=False): ничего не хранит, каждое чтение идёт в БД.
+"""
+from __future__ import annotations
+from typing import Any, Callable, Iterable
+
+ACTIVE_STATUSES = frozenset({
+    "WAITING_MERCHANT", "MERCHANT_TAKEN", "WAITING_PAYMENT", "WAITING_RECEIPT", "WAITING_CHECK",
+})
+
+
+class ActiveApps:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._by_id: dict[int, dict[str, Any]] = {}
+        # user_tg_id -> {app_id: None}: упорядоченное множество, порядок — по возрастанию id
+        self._by_user: dict[int, dict[int, None]] = {}
+        self.version = 0
+        # Вызывается после записи через индекс: id изменённых заявок или None — «все»
+        self.listener: Callable[[list[int] | None], None] | None = None
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, app_id: int) -> bool:
+        return app_id in self._by_id
+
+    def get(self, app_id: int) -> dict[str, Any] | None:
+        """Копия view: вызывающий может менять словарь, не трогая индекс"""
+        view = self._by_id.get(app_id)
+        return dict(view) if view is not None else None
+
+    def for_user(self, user_tg_id: int) -> list[dict[str, Any]]:
+        """Активные заявки пользователя, новые сначала"""
+        ids = self._by_user.get(user_tg_id, {})
+        return [dict(self._by_id[i]) for i in sorted(ids, reverse=True)]
+
+    # === Запись (write-through из Database) ===
+    def put(self, view: dict[str, Any]) -> None:
+        """Сохранить актуальное состояние заявки; конечный статус — удалить"""
+        self.version += 1
+        self._put(view)
+        self._notify([view["id"]])
+
+    def discard(self, app_id: int) -> None:
+        self.version += 1
+        self._discard(app_id)
+        self._notify([app_id])
+
+    def patch(self, app_id: int, **fields: Any) -> bool:
+        """Обновить поля заявки из индекса; False — заявки в индексе нет"""
+        view = self._by_id.get(app_id)
+        if view is None:
+            # Заявка изменилась, даже если здесь её нет: у других шардов она может быть
+            self._notify([app_id])
+            return False
+        self.put({**view, **fields})
+        return True
+
+    def discard_where(self, match: Callable[[dict[str, Any]], bool]) -> None:
+        """Выбросить заявки, у которых устарели данные из JOIN (банк, username)"""
+        self.version += 1
+        for app_id in [i for i, view in self._by_id.items() if match(view)]:
+            self._discard(app_id)
+        self._notify(None)
+
+    def forget(self, app_ids: Iterable[int] | None) -> None:
+        """Изменение из другого процесса: выбросить заявки (None — все), не уведомляя listener"""
+        self.version += 1
+        if app_ids is None:
+            self._by_id.clear()
+            self._by_user.clear()
+            return
+        for app_id in app_ids:
+            self._discard(app_id)
+
+    def _notify(self, app_ids: list[int] | None) -> None:
+        if self.listener is not None:
+            self.listener(app_ids)
+
+    # === Заполнение из БД ===
+    def fill(self, views: Iterable[dict[str, Any]], version: int) -> bool:
+        """Дополнить индекс прочитанным из БД, если с version записей не было"""
+        if version != self.version:
+            return False
+        for view in views:
+            self._put(view)
+        return True
+
+    def replace(self, views: Iterable[dict[str, Any]], version: int) -> bool:
+        """Полная пересборка по снимку активных заявок из БД"""
+        if version != self.version:
+            return False
+        self._by_id.clear()
+        self._by_user.clear()
+        for view in views:
+            self._put(view)
+        return True
+
+    def _put(self, view: dict[str, Any]) -> None:
+        app_id = view["id"]
+        if not self.enabled or view["status"] not in ACTIVE_STATUSES:
+            self._discard(app_id)
+            return
+        old = self._by_id.get(app_id)
+        if old is not None and old["user_tg_id"] != view["user_tg_id"]:
+            self._discard(app_id)
+        self._by_id[app_id] = dict(view)
+        self._by_user.setdefault(view["user_tg_id"], {})[app_id] = None
+
+    def _discard(self, app_id: int) -> None:
+        view = self._by_id.pop(app_id, None)
+        if view is None:
+            return
+        ids = self._by_user.get(view["user_tg_id"])
+        if ids is not None:
+            ids.pop(app_id, None)
+            if not ids:
+                del self._by_user[view["user_tg_id"]]
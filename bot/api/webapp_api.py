@@ -5,24 +5,64 @@ from __future__ import annotations
 import os
 import hmac
 import hashlib
+import ipaddress
 import json
-import datetime as dt
+import math
+import mimetypes
+import re
 from typing import Optional, Any
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Depends, Header, Query
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
 from pydantic import BaseModel, Field
 
-import sys
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него ответы сериализует json
+    orjson = None
 
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from db import Database, now_iso
+from bot.db import Database, now_iso
+from bot.profiler import QueryProfiler
+from bot.events import APP_CREATED, bus
+from bot.export import FORMATS, parse_date_range, export_filename, export_stream
+from bot.ratelimit import buckets
 
 # Конфигурация
 DB_PATH = os.getenv("DB_PATH", "./data.db")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()}
+SQL_PROFILE = os.getenv("SQL_PROFILE", "").strip().lower() in ("1", "true", "yes")
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "200").strip() or 200)
+# Прокси перед API (адреса или сети через запятую): только им верим в X-Forwarded-For
+TRUSTED_PROXIES = tuple(
+    ipaddress.ip_network(x.strip(), strict=False)
+    for x in os.getenv("TRUSTED_PROXIES", "").split(",") if x.strip()
+)
+
+# Кэширование ответов: справочники общие для всех, данные пользователя — только в его кэше
+CATALOG_CACHE = "public, max-age=300, stale-while-revalidate=3600"
+STATS_CACHE = "public, max-age=60"
+PRIVATE_CACHE = "private, no-cache"
+CORS_MAX_AGE = 86400
+GZIP_MIN_SIZE = 1024
+
+# Собранный Mini App (python webapp/build.py): файлы с хэшем в имени кэшируются навсегда
+WEBAPP_DIST = os.getenv("WEBAPP_DIST") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "webapp", "dist"
+)
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+SHELL_CACHE = "no-cache"
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+ASSET_NAME_RE = re.compile(r"^[\w-]+\.[0-9a-f]{10}\.(?:js|css)$")
+
+# Лимиты запросов (токенов в секунду, всплеск): по IP на всё /api,
+# по tg_id после проверки initData и отдельно на создание заявок
+IP_LIMIT = (20.0, 40.0)
+USER_LIMIT = (5.0, 20.0)
+CREATE_LIMIT = (0.1, 3.0)
 
 # Глобальная переменная для БД
 db: Optional[Database] = None
@@ -31,26 +71,130 @@ db: Optional[Database] = None
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global db
-    db = Database(DB_PATH)
+    # Статусы заявок меняет бот, инвалидации до API не доходят: индекс активных заявок не держим
+    db = Database(DB_PATH, profiler=QueryProfiler(slow_ms=SQL_SLOW_MS) if SQL_PROFILE else None,
+                  active_index=False)
     await db.init()
     yield
-    # Cleanup
+    await db.close()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON через orjson (UTF-8 без \\u-экранирования, без пробелов)"""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def cache_control(value: str):
+    """Dependency маршрута: проставляет Cache-Control успешному ответу"""
+    async def set_header(response: Response) -> None:
+        response.headers["Cache-Control"] = value
+    return Depends(set_header)
 
 
 app = FastAPI(
     title="NightLab WebApp API",
     description="API для Telegram Mini App",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
 )
 
-# CORS для WebApp
+
+# ============ Троттлинг ============
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(addr in net for net in TRUSTED_PROXIES)
+
+
+def client_ip(request: Request) -> str:
+    """IP клиента; X-Forwarded-For учитывается, только если запрос пришёл от доверенного прокси
+
+    Адреса в заголовке читаются справа налево, пропуская доверенные прокси:
+    первый чужой адрес и есть клиент, всё левее него клиент мог подделать.
+    """
+    host = request.client.host if request.client else "unknown"
+    forwarded = request.headers.get("x-forwarded-for")
+    if not forwarded or not is_trusted_proxy(host):
+        return host
+    for addr in reversed([a.strip() for a in forwarded.split(",") if a.strip()]):
+        host = addr
+        if not is_trusted_proxy(addr):
+            break
+    return host
+
+
+def too_many_requests(retry_after: float) -> dict[str, str]:
+    return {"Retry-After": str(math.ceil(retry_after))}
+
+
+def throttle(key: tuple, limit: tuple[float, float]) -> None:
+    """Бросает 429 с Retry-After, если ведро ключа пусто"""
+    retry_after = buckets.hit(key, *limit)
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Too many requests", headers=too_many_requests(retry_after))
+
+
+# Добавлен до CORS: CORSMiddleware оборачивает его и проставляет заголовки и на 429
+@app.middleware("http")
+async def throttle_by_ip(request: Request, call_next):
+    if request.url.path.startswith("/api/"):
+        retry_after = buckets.hit(("api-ip", client_ip(request)), *IP_LIMIT)
+        if retry_after:
+            return FastJSONResponse(
+                {"detail": "Too many requests"}, status_code=429, headers=too_many_requests(retry_after)
+            )
+    return await call_next(request)
+
+
+# ============ ETag ============
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Слабое сравнение (RFC 9110): W/ не учитывается"""
+    if if_none_match.strip() == "*":
+        return True
+    tag = etag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == tag for t in if_none_match.split(","))
+
+
+# Между троттлингом и GZip: хэшируется несжатое тело, поэтому тег слабый —
+# он одинаков для gzip и identity. Клиент шлёт If-None-Match и на 304 берёт
+# данные из своего кэша; пересчёт на сервере остаётся, экономится трафик и парсинг.
+@app.middleware("http")
+async def etag_for_json(request: Request, call_next):
+    response = await call_next(request)
+    if (request.method != "GET" or response.status_code != 200
+            or not request.url.path.startswith("/api/")
+            or response.headers.get("content-type", "").split(";")[0] != "application/json"):
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = 'W/"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+    headers = {k: v for k, v in response.headers.items() if k not in ("content-length", "content-type")}
+    headers["ETag"] = etag
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, status_code=200, headers=headers, media_type="application/json")
+
+
+# Сжатие; уже сжатые выгрузки (application/gzip) GZipMiddleware пропускает сам
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE, compresslevel=6)
+
+# CORS для WebApp; X-Init-Data всегда вызывает preflight, поэтому кэшируем его
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
+    max_age=CORS_MAX_AGE,
 )
 
 
@@ -157,9 +301,22 @@ def validate_telegram_init_data(init_data: str) -> dict[str, Any]:
     return user_data
 
 
-async def get_current_user(x_init_data: str = Header(..., alias="X-Init-Data")) -> dict[str, Any]:
-    """Dependency для получения текущего пользователя"""
-    return validate_telegram_init_data(x_init_data)
+async def get_current_user(response: Response,
+                           x_init_data: str = Header(..., alias="X-Init-Data")) -> dict[str, Any]:
+    """Dependency для получения текущего пользователя; ответ кэшируется только у него"""
+    user = validate_telegram_init_data(x_init_data)
+    throttle(("api-user", user.get("id")), USER_LIMIT)
+    response.headers["Cache-Control"] = PRIVATE_CACHE
+    response.headers["Vary"] = "X-Init-Data"
+    return user
+
+
+async def get_current_admin(user: dict = Depends(get_current_user)) -> dict[str, Any]:
+    """Dependency: только для админов (ADMIN_IDS или роль ADMIN)"""
+    tg_id = user.get("id")
+    if tg_id not in ADMIN_IDS and await db.get_user_role(tg_id) != "ADMIN":
+        raise HTTPException(status_code=403, detail="Admin only")
+    return user
 
 
 # ============ Endpoints ============
@@ -169,11 +326,10 @@ async def root():
     return {"status": "ok", "service": "NightLab WebApp API"}
 
 
-@app.get("/api/stats", response_model=StatsResponse)
+@app.get("/api/stats", response_model=StatsResponse, dependencies=[cache_control(STATS_CACHE)])
 async def get_stats():
     """Получить общую статистику платформы"""
-    stats = await db.get_stats()
-    return StatsResponse(**stats)
+    return await db.get_stats()
 
 
 @app.get("/api/user/profile", response_model=UserProfile)
@@ -195,24 +351,23 @@ async def get_user_profile(user: dict = Depends(get_current_user)):
     webapp_url = await db.get_setting("webapp_url", "https://t.me/your_bot/webapp")
     bot_username = webapp_url.split("/")[3] if "/" in webapp_url else "your_bot"
 
-    return UserProfile(
-        tg_id=user_data["tg_id"],
-        username=user_data["username"],
-        role=user_data["role"],
-        balance_uah=user_data["balance_uah"],
-        referral_code=user_data["referral_code"],
-        referral_link=f"https://t.me/{bot_username}?start={user_data['referral_code']}",
-        referral_count=referral_count,
-        created_at=user_data["created_at"]
-    )
+    return {
+        "tg_id": user_data["tg_id"],
+        "username": user_data["username"],
+        "role": user_data["role"],
+        "balance_uah": user_data["balance_uah"],
+        "referral_code": user_data["referral_code"],
+        "referral_link": f"https://t.me/{bot_username}?start={user_data['referral_code']}",
+        "referral_count": referral_count,
+        "created_at": user_data["created_at"]
+    }
 
 
 @app.get("/api/user/stats", response_model=UserStatsResponse)
 async def get_user_statistics(user: dict = Depends(get_current_user)):
     """Получить статистику пользователя"""
     tg_id = user.get("id")
-    stats = await db.get_user_stats(tg_id)
-    return UserStatsResponse(**stats)
+    return await db.get_user_stats(tg_id)
 
 
 @app.get("/api/applications", response_model=list[ApplicationResponse])
@@ -239,15 +394,15 @@ async def get_user_applications(
     rows = await db.list_user_apps(tg_id, limit=limit, offset=offset, status_filter=status)
 
     return [
-        ApplicationResponse(
-            id=row[0],
-            bank_name=row[1],
-            amount_uah=row[2],
-            payment_code=row[3],
-            status=row[4],
-            status_label=STATUS_LABELS.get(row[4], row[4]),
-            created_at=row[5]
-        )
+        {
+            "id": row[0],
+            "bank_name": row[1],
+            "amount_uah": row[2],
+            "payment_code": row[3],
+            "status": row[4],
+            "status_label": STATUS_LABELS.get(row[4], row[4]),
+            "created_at": row[5]
+        }
         for row in rows
     ]
 
@@ -268,6 +423,7 @@ async def create_application(data: ApplicationCreate):
     """Создать новую заявку"""
     user = validate_telegram_init_data(data.init_data)
     tg_id = user.get("id")
+    throttle(("api-create", tg_id), CREATE_LIMIT)
     username = user.get("username", f"user_{tg_id}")
 
     # Ensure user exists
@@ -287,45 +443,34 @@ async def create_application(data: ApplicationCreate):
     country_name = country["name"] if country else "Unknown"
 
     # Generate payment code
-    from utils import gen_payment_code
+    from bot.utils import gen_payment_code
     payment_code = gen_payment_code()
 
-    # Create application
-    app_id = await db.create_application(tg_id, data.bank_id, data.amount_uah, payment_code)
-
     # Check if bank has auto-requisites
     requisites = bank.get("requisites_text", "").strip()
     has_requisites = requisites and len(requisites) > 5 and "не заданы" not in requisites
 
     if has_requisites:
-        # Auto-assign requisites
-        await db.set_requisites_and_start_timer(app_id, requisites, ttl_minutes=20)
-
-        # Create notification
-        await db.create_notification(
-            tg_id,
-            "requisites",
-            "Реквизиты получены",
-            f"Заявка #{app_id}: реквизиты для оплаты",
-            json.dumps({"app_id": app_id})
+        # Create application with auto-assigned requisites, notification and audit in one transaction
+        app = await db.create_and_issue_application(
+            tg_id, data.bank_id, data.amount_uah, payment_code, requisites, ttl_minutes=20
         )
 
         return CreateAppResponse(
             success=True,
-            app_id=app_id,
+            app_id=app["id"],
             message="Заявка создана! Реквизиты получены автоматически.",
             requisites=requisites,
-            expires_at=(dt.datetime.utcnow() + dt.timedelta(minutes=20)).isoformat() + "Z",
+            expires_at=app["expires_at"],
             bank_name=bank["bank_name"],
             country_name=country_name,
             amount=data.amount_uah
         )
     else:
-        # Send to merchant chat
-        merchant_chat_id = await db.get_setting("merchant_chat_id")
-        if merchant_chat_id:
-            # Notification will be sent by bot handler
-            pass
+        # Application and app.created event for the bot's merchant dispatch in one transaction
+        app_id = await db.create_application(tg_id, data.bank_id, data.amount_uah, payment_code,
+                                             event=APP_CREATED)
+        bus.wake()
 
         return CreateAppResponse(
             success=True,
@@ -339,7 +484,7 @@ async def create_application(data: ApplicationCreate):
         )
 
 
-@app.get("/api/countries")
+@app.get("/api/countries", dependencies=[cache_control(CATALOG_CACHE)])
 async def get_countries():
     """Получить список стран"""
     countries = await db.list_countries(active_only=True)
@@ -349,7 +494,7 @@ async def get_countries():
     ]
 
 
-@app.get("/api/banks")
+@app.get("/api/banks", dependencies=[cache_control(CATALOG_CACHE)])
 async def get_banks(country_id: Optional[int] = Query(None)):
     """Получить список банков"""
     if country_id:
@@ -371,18 +516,7 @@ async def get_notifications(
     """Получить уведомления пользователя"""
     tg_id = user.get("id")
     notifications = await db.get_user_notifications(tg_id, limit=limit)
-    return [
-        NotificationResponse(
-            id=n["id"],
-            type=n["type"],
-            title=n["title"],
-            message=n["message"],
-            is_read=n["is_read"],
-            data=n["data"],
-            created_at=n["created_at"]
-        )
-        for n in notifications
-    ]
+    return notifications
 
 
 @app.get("/api/notifications/unread-count")
@@ -407,7 +541,7 @@ async def mark_notification_as_read(notification_id: int, user: dict = Depends(g
 async def get_application_detail(app_id: int, user: dict = Depends(get_current_user)):
     """Получить детали заявки"""
     tg_id = user.get("id")
-    app = await db.get_application(app_id)
+    app = await db.get_application_view(app_id)
 
     if not app:
         raise HTTPException(status_code=404, detail="Application not found")
@@ -415,8 +549,6 @@ async def get_application_detail(app_id: int, user: dict = Depends(get_current_u
     if app["user_tg_id"] != tg_id:
         raise HTTPException(status_code=403, detail="Access denied")
 
-    bank = await db.get_bank(app["bank_id"]) if app.get("bank_id") else None
-
     STATUS_LABELS = {
         "WAITING_MERCHANT": "Ожидает мерчанта",
         "MERCHANT_TAKEN": "Взята мерчантом",
@@ -430,7 +562,7 @@ async def get_application_detail(app_id: int, user: dict = Depends(get_current_u
 
     return {
         "id": app["id"],
-        "bank_name": bank["bank_name"] if bank else "Unknown",
+        "bank_name": app["bank_name"] or "Unknown",
         "amount_uah": app["amount_uah"],
         "payment_code": app["payment_code"],
         "status": app["status"],
@@ -442,6 +574,122 @@ async def get_application_detail(app_id: int, user: dict = Depends(get_current_u
     }
 
 
+@app.get("/api/application/{app_id}/messages")
+async def get_application_messages(
+        app_id: int,
+        user: dict = Depends(get_current_user),
+        limit: int = Query(50, ge=1, le=100),
+        before_id: Optional[int] = Query(None, ge=1)
+):
+    """История переписки по заявке (новые сначала, пагинация по before_id)"""
+    tg_id = user.get("id")
+    parts = await db.get_chat_participants(app_id)
+    if not parts:
+        raise HTTPException(status_code=404, detail="Application not found")
+    if tg_id not in (parts["user_tg_id"], parts["merchant_tg_id"]):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    messages = await db.list_messages(app_id, limit=limit, before_id=before_id)
+    return {
+        "messages": [
+            {
+                "id": m["id"],
+                "text": m["text"],
+                "from_me": m["from_tg_id"] == tg_id,
+                "created_at": m["created_at"]
+            }
+            for m in messages
+        ],
+        "next_before_id": messages[-1]["id"] if len(messages) == limit else None
+    }
+
+
+# ============ Admin ============
+
+@app.get("/api/admin/export")
+async def export_applications(
+        admin: dict = Depends(get_current_admin),
+        date_from: Optional[str] = Query(None),
+        date_to: Optional[str] = Query(None),
+        format: str = Query("csv"),
+        gzip: bool = Query(True)
+):
+    """Выгрузить заявки за период (CSV/JSONL, опционально gzip) потоком"""
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail="Unknown format")
+    try:
+        start, end = parse_date_range(date_from, date_to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+
+    filename = export_filename(start, end, format, gzip)
+    return StreamingResponse(
+        export_stream(db, start, end, format, compress=gzip),
+        media_type="application/gzip" if gzip else FORMATS[format][0],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.get("/api/admin/analytics")
+async def get_analytics(
+        admin: dict = Depends(get_current_admin),
+        date_from: Optional[str] = Query(None),
+        date_to: Optional[str] = Query(None)
+):
+    """Оборот по дням/банкам/странам и доля подтверждённых (из дневных агрегатов)"""
+    try:
+        start, end = parse_date_range(date_from, date_to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+    return await db.get_analytics(start, end)
+
+
+@app.get("/api/admin/search")
+async def search(
+        admin: dict = Depends(get_current_admin),
+        q: str = Query(..., min_length=1, max_length=200),
+        limit: int = Query(20, ge=1, le=100),
+        offset: int = Query(0, ge=0)
+):
+    """Полнотекстовый поиск по заявкам, пользователям и сообщениям чата"""
+    if not db.has_search:
+        raise HTTPException(status_code=503, detail="Search is not available (FTS5)")
+    results = await db.search(q, limit=limit, offset=offset)
+    return {"query": q, "limit": limit, "offset": offset, "results": results}
+
+
+# ============ Mini App ============
+
+def webapp_file(name: str, request: Request, cache: str) -> FileResponse:
+    """Отдаёт файл из dist, выбирая заранее сжатый вариант по Accept-Encoding"""
+    path = os.path.join(WEBAPP_DIST, name)
+    media_type = mimetypes.guess_type(name)[0]
+    headers = {"Cache-Control": cache, "Vary": "Accept-Encoding"}
+    accept = request.headers.get("accept-encoding", "")
+    for encoding, suffix in PRECOMPRESSED:
+        if encoding in accept and os.path.exists(path + suffix):
+            headers["Content-Encoding"] = encoding
+            return FileResponse(path + suffix, media_type=media_type, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@app.get("/app", include_in_schema=False)
+@app.get("/app/", include_in_schema=False)
+async def webapp_shell(request: Request):
+    """HTML-оболочка Mini App; всегда перепроверяется, чтобы подхватить новые бандлы"""
+    if not os.path.exists(os.path.join(WEBAPP_DIST, "index.html")):
+        raise HTTPException(status_code=404, detail="WebApp is not built (python webapp/build.py)")
+    return webapp_file("index.html", request, SHELL_CACHE)
+
+
+@app.get("/app/{name}", include_in_schema=False)
+async def webapp_asset(name: str, request: Request):
+    """Бандлы с хэшем содержимого в имени"""
+    if not ASSET_NAME_RE.match(name) or not os.path.exists(os.path.join(WEBAPP_DIST, name)):
+        raise HTTPException(status_code=404, detail="Not found")
+    return webapp_file(name, request, IMMUTABLE_CACHE)
+
+
 # ============ Запуск ============
 
 if __name__ == "__main__":
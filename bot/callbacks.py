@@ -0,0 +1,166 @@
+"""
+Callback-данные кнопок и единая таблица маршрутизации callback_query
+
+Раньше каждый обработчик висел на своём F.data.startswith(...) и aiogram
+проверял фильтры по очереди во всех роутерах. Теперь callback_data строится
+через типизированные CallbackData с короткими префиксами, а обработчик
+ищется по точному значению или по префиксу одним поиском в словаре.
+"""
+from __future__ import annotations
+from typing import Any, Callable
+
+from aiogram import Router
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.dispatcher.event.handler import FilterObject, HandlerObject
+from aiogram.filters import StateFilter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.fsm.state import State
+from aiogram.types import CallbackQuery
+
+SEP = ":"
+
+
+class AppCb(CallbackData, prefix="app"):
+    """Базовый класс для кнопок, привязанных к заявке"""
+    app_id: int
+
+    @classmethod
+    def template(cls) -> str:
+        """callback_data с плейсхолдером {app_id} для прототипов клавиатур"""
+        return f"{cls.__prefix__}{cls.__separator__}{{app_id}}"
+
+
+# Заявка: мерчант
+class TakeCb(AppCb, prefix="tk"): ...
+class ReleaseCb(AppCb, prefix="rl"): ...
+class SendSavedCb(AppCb, prefix="ss"): ...
+class SendNewCb(AppCb, prefix="sn"): ...
+
+# Заявка: пользователь
+class PaidCb(AppCb, prefix="pd"): ...
+class CancelCb(AppCb, prefix="cx"): ...
+class ReceiptCb(AppCb, prefix="rc"): ...
+class SkipReceiptCb(AppCb, prefix="sr"): ...
+
+# Заявка: проверка чека и чат
+class ApproveCb(AppCb, prefix="ok"): ...
+class RejectCb(AppCb, prefix="rj"): ...
+class ChatCb(AppCb, prefix="ch"): ...
+
+
+# Создание заявки
+class CountryCb(CallbackData, prefix="co"):
+    country_id: int
+
+
+class BankCb(CallbackData, prefix="bk"):
+    bank_id: int
+
+
+# Админка
+class RoleCb(CallbackData, prefix="ar"):
+    tg_id: int
+    role: str
+
+
+class SettingCb(CallbackData, prefix="as"):
+    key: str
+
+
+class PhotoCb(CallbackData, prefix="ap"):
+    kind: str
+
+
+class ExportCb(CallbackData, prefix="ae"):
+    days: int
+    fmt: str
+
+
+class AnalyticsCb(CallbackData, prefix="an"):
+    days: int
+
+
+# Префиксы из прошлых версий: кнопки в уже отправленных сообщениях
+# (чат мерчантов, заявки пользователей) продолжают работать
+LEGACY_PREFIXES: dict[str, type[CallbackData]] = {
+    "take": TakeCb,
+    "release": ReleaseCb,
+    "send_saved": SendSavedCb,
+    "send_new": SendNewCb,
+    "paid": PaidCb,
+    "cancel": CancelCb,
+    "receipt": ReceiptCb,
+    "skip_receipt": SkipReceiptCb,
+    "approve": ApproveCb,
+    "reject": RejectCb,
+    "chat": ChatCb,
+    "country": CountryCb,
+    "bank": BankCb,
+}
+
+
+class CallbackTable:
+    """Таблица обработчиков callback_query: точные значения и префиксы CallbackData
+
+    Обработчики регистрируются декоратором и вызываются как обычные хендлеры
+    aiogram: получают только те аргументы (db, config, state, ...), которые
+    объявили, плюс callback_data с распакованным объектом.
+    """
+
+    def __init__(self, name: str = "callbacks"):
+        self._exact: dict[str, HandlerObject] = {}
+        self._prefix: dict[str, tuple[type[CallbackData], HandlerObject]] = {}
+        self.router = Router(name=name)
+        self.router.callback_query.register(self._dispatch)
+
+    def __call__(self, key: str | type[CallbackData], *filters: Any,
+                 state: State | None = None) -> Callable:
+        def decorator(callback: Callable) -> Callable:
+            checks = [FilterObject(f) for f in filters]
+            if state is not None:
+                checks.insert(0, FilterObject(StateFilter(state)))
+            handler = HandlerObject(callback=callback, filters=checks or None)
+            if isinstance(key, str):
+                self._add(self._exact, key, handler)
+            else:
+                self._add(self._prefix, key.__prefix__, (key, handler))
+                for legacy, cls in LEGACY_PREFIXES.items():
+                    if cls is key:
+                        self._add(self._prefix, legacy, (key, handler))
+            return callback
+        return decorator
+
+    @staticmethod
+    def _add(table: dict, key: str, value: Any) -> None:
+        if key in table:
+            raise ValueError(f"Callback {key!r} is already registered")
+        table[key] = value
+
+    def resolve(self, data: str) -> tuple[HandlerObject, CallbackData | None] | None:
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, None
+        prefix, sep, rest = data.partition(SEP)
+        entry = self._prefix.get(prefix) if sep else None
+        if entry is None:
+            return None
+        cls, handler = entry
+        try:
+            return handler, cls.unpack(f"{cls.__prefix__}{SEP}{rest}")
+        except (TypeError, ValueError):
+            return None
+
+    async def _dispatch(self, call: CallbackQuery, **data: Any) -> Any:
+        found = self.resolve(call.data or "")
+        if found is None:
+            raise SkipHandler()
+        handler, callback_data = found
+        if callback_data is not None:
+            data["callback_data"] = callback_data
+        ok, data = await handler.check(call, **data)
+        if not ok:
+            raise SkipHandler()
+        return await handler.call(call, **data)
+
+
+callbacks = CallbackTable()
@@ -20,6 +20,30 @@ class Config:
     rules_url: str = "https://t.me/your_channel/1"
     welcome_photo_url: str | None = None
 
+    # SQL profiling (opt-in)
+    sql_profile: bool = False
+    sql_slow_ms: float = 200.0
+
+    # Троттлинг входящих апдейтов: токенов в секунду и размер всплеска на пользователя
+    throttle_rate: float = 1.0
+    throttle_burst: float = 10.0
+
+    # Планировщик апдейтов: обработчиков одновременно, предел очереди, при переполнении wait|drop
+    sched_workers: int = 16
+    sched_queue_limit: int = 1000
+    sched_overflow: str = "wait"
+
+    # Аренда лидерства фоновых циклов между экземплярами бота, секунды
+    lease_ttl: float = 10.0
+
+    # Bot API: свой сервер (None — api.telegram.org), размер пула соединений, таймаут запроса
+    bot_api_url: str | None = None
+    bot_api_pool: int = 100
+    bot_api_timeout: float = 10.0
+
+    # Порт HTTP /metrics (Prometheus); None — не поднимать
+    metrics_port: int | None = None
+
 
 def load_config() -> Config:
     load_dotenv()
@@ -38,6 +62,9 @@ def load_config() -> Config:
     mch = os.getenv("MERCHANT_CHAT_ID", "").strip()
     merchant_chat_id = int(mch) if mch.lstrip("-").isdigit() else None
 
+    metrics_port_raw = os.getenv("METRICS_PORT", "").strip()
+    metrics_port = int(metrics_port_raw) if metrics_port_raw.isdigit() else None
+
     channel_id_raw = os.getenv("CHANNEL_ID", "").strip()
     channel_id = int(channel_id_raw) if channel_id_raw.lstrip("-").isdigit() else (channel_id_raw or None)
 
@@ -52,4 +79,16 @@ def load_config() -> Config:
         team_url=os.getenv("TEAM_URL", "https://t.me/your_team").strip(),
         rules_url=os.getenv("RULES_URL", "https://t.me/your_channel/1").strip(),
         welcome_photo_url=os.getenv("WELCOME_PHOTO_URL", "").strip() or None,
+        sql_profile=os.getenv("SQL_PROFILE", "").strip().lower() in ("1", "true", "yes"),
+        sql_slow_ms=float(os.getenv("SQL_SLOW_MS", "200").strip() or 200),
+        throttle_rate=float(os.getenv("THROTTLE_RATE", "1").strip() or 1),
+        throttle_burst=float(os.getenv("THROTTLE_BURST", "10").strip() or 10),
+        sched_workers=int(os.getenv("SCHED_WORKERS", "16").strip() or 16),
+        sched_queue_limit=int(os.getenv("SCHED_QUEUE_LIMIT", "1000").strip() or 1000),
+        sched_overflow=os.getenv("SCHED_OVERFLOW", "wait").strip().lower() or "wait",
+        lease_ttl=float(os.getenv("LEASE_TTL", "10").strip() or 10),
+        bot_api_url=os.getenv("BOT_API_URL", "").strip().rstrip("/") or None,
+        bot_api_pool=int(os.getenv("BOT_API_POOL", "100").strip() or 100),
+        bot_api_timeout=float(os.getenv("BOT_API_TIMEOUT", "10").strip() or 10),
+        metrics_port=metrics_port,
     )
@@ -1,8 +1,21 @@
 from __future__ import annotations
 import aiosqlite
+import asyncio
 import datetime as dt
+import json
+import logging
+import sqlite3
+import time
 from typing import Optional, Any
 
+from bot.active_apps import ACTIVE_STATUSES, ActiveApps
+from bot.loader import BatchLoader
+from bot.profiler import QueryProfiler
+from bot.utils import referral_code
+from bot.writer import Writer
+
+logger = logging.getLogger("paydesk.db")
+
 SCHEMA = """
 PRAGMA foreign_keys = ON;
 
@@ -99,19 +112,376 @@ CREATE TABLE IF NOT EXISTS referrals (
     FOREIGN KEY(referred_tg_id) REFERENCES users(tg_id),
     UNIQUE(referred_tg_id)
 );
+
+CREATE TABLE IF NOT EXISTS receipts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    app_id INTEGER NOT NULL,
+    user_tg_id INTEGER NOT NULL,
+    file_id TEXT NOT NULL,
+    file_unique_id TEXT NOT NULL,
+    file_type TEXT NOT NULL,
+    chat_id INTEGER,
+    message_id INTEGER,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY(app_id) REFERENCES applications(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_receipts_unique ON receipts(file_unique_id);
+CREATE INDEX IF NOT EXISTS idx_receipts_app ON receipts(app_id, id);
+CREATE INDEX IF NOT EXISTS idx_applications_created ON applications(created_at);
+CREATE INDEX IF NOT EXISTS idx_applications_user ON applications(user_tg_id, status);
+CREATE INDEX IF NOT EXISTS idx_messages_app ON messages(app_id, id);
+
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT NOT NULL,
+    bank_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    apps_count INTEGER NOT NULL DEFAULT 0,
+    amount_uah REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, bank_id, status)
+) WITHOUT ROWID;
+
+-- Outbox: события для бота пишутся той же транзакцией, что и изменение
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    delivered_at TEXT,
+    -- Исчерпаны попытки доставки: relay больше не берёт, вернуть — replay_events()
+    dead_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(id) WHERE delivered_at IS NULL;
+
+-- Аренда лидерства между процессами: expires_at — unix time, token растёт при смене владельца
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    token INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+# Дневные агрегаты поддерживаются триггерами при каждой смене статуса заявки.
+# Создаются после миграций, когда у applications уже есть bank_id.
+ROLLUP_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS trg_daily_stats_insert AFTER INSERT ON applications
+BEGIN
+    INSERT INTO daily_stats (day, bank_id, status, apps_count, amount_uah)
+    VALUES (substr(NEW.created_at, 1, 10), COALESCE(NEW.bank_id, 0), NEW.status, 1, NEW.amount_uah)
+    ON CONFLICT(day, bank_id, status) DO UPDATE SET
+        apps_count = apps_count + 1, amount_uah = amount_uah + excluded.amount_uah;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_daily_stats_update AFTER UPDATE OF status, bank_id, amount_uah ON applications
+WHEN OLD.status IS NOT NEW.status OR OLD.bank_id IS NOT NEW.bank_id OR OLD.amount_uah IS NOT NEW.amount_uah
+BEGIN
+    UPDATE daily_stats SET apps_count = apps_count - 1, amount_uah = amount_uah - OLD.amount_uah
+    WHERE day = substr(OLD.created_at, 1, 10) AND bank_id = COALESCE(OLD.bank_id, 0) AND status = OLD.status;
+    INSERT INTO daily_stats (day, bank_id, status, apps_count, amount_uah)
+    VALUES (substr(NEW.created_at, 1, 10), COALESCE(NEW.bank_id, 0), NEW.status, 1, NEW.amount_uah)
+    ON CONFLICT(day, bank_id, status) DO UPDATE SET
+        apps_count = apps_count + 1, amount_uah = amount_uah + excluded.amount_uah;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_daily_stats_delete AFTER DELETE ON applications
+BEGIN
+    UPDATE daily_stats SET apps_count = apps_count - 1, amount_uah = amount_uah - OLD.amount_uah
+    WHERE day = substr(OLD.created_at, 1, 10) AND bank_id = COALESCE(OLD.bank_id, 0) AND status = OLD.status;
+END;
+"""
+
+REBUILD_DAILY_STATS = (
+    "DELETE FROM daily_stats",
+    """
+    INSERT INTO daily_stats (day, bank_id, status, apps_count, amount_uah)
+    SELECT substr(created_at, 1, 10), COALESCE(bank_id, 0), status, COUNT(*), SUM(amount_uah)
+    FROM applications
+    GROUP BY 1, 2, 3
+    """,
+)
+
+# Полнотекстовый поиск (FTS5). rowid детерминирован: ref_id * 4 + код сущности,
+# поэтому триггеры обновляют/удаляют запись индекса по rowid без поиска.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+    kind UNINDEXED, ref_id UNINDEXED, app_id UNINDEXED, body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_search_message_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO search_index (rowid, kind, ref_id, app_id, body)
+    VALUES (NEW.id * 4 + 1, 'message', NEW.id, NEW.app_id, NEW.text);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_search_message_delete AFTER DELETE ON messages
+BEGIN
+    DELETE FROM search_index WHERE rowid = OLD.id * 4 + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_search_user_insert AFTER INSERT ON users
+BEGIN
+    INSERT INTO search_index (rowid, kind, ref_id, app_id, body)
+    VALUES (NEW.tg_id * 4 + 2, 'user', NEW.tg_id, NULL, NEW.username);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_search_user_update AFTER UPDATE OF username ON users
+WHEN OLD.username IS NOT NEW.username
+BEGIN
+    DELETE FROM search_index WHERE rowid = OLD.tg_id * 4 + 2;
+    INSERT INTO search_index (rowid, kind, ref_id, app_id, body)
+    VALUES (NEW.tg_id * 4 + 2, 'user', NEW.tg_id, NULL, NEW.username);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_search_user_delete AFTER DELETE ON users
+BEGIN
+    DELETE FROM search_index WHERE rowid = OLD.tg_id * 4 + 2;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_search_app_insert AFTER INSERT ON applications
+BEGIN
+    INSERT INTO search_index (rowid, kind, ref_id, app_id, body)
+    VALUES (NEW.id * 4 + 3, 'application', NEW.id, NEW.id,
+            NEW.id || ' ' || NEW.payment_code || ' ' || COALESCE(NEW.requisites_text_override, ''));
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_search_app_update AFTER UPDATE OF payment_code, requisites_text_override ON applications
+WHEN OLD.payment_code IS NOT NEW.payment_code
+  OR OLD.requisites_text_override IS NOT NEW.requisites_text_override
+BEGIN
+    DELETE FROM search_index WHERE rowid = OLD.id * 4 + 3;
+    INSERT INTO search_index (rowid, kind, ref_id, app_id, body)
+    VALUES (NEW.id * 4 + 3, 'application', NEW.id, NEW.id,
+            NEW.id || ' ' || NEW.payment_code || ' ' || COALESCE(NEW.requisites_text_override, ''));
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_search_app_delete AFTER DELETE ON applications
+BEGIN
+    DELETE FROM search_index WHERE rowid = OLD.id * 4 + 3;
+END;
 """
 
+REBUILD_SEARCH_INDEX = (
+    "DELETE FROM search_index",
+    """
+    INSERT INTO search_index (rowid, kind, ref_id, app_id, body)
+    SELECT id * 4 + 1, 'message', id, app_id, text FROM messages
+    """,
+    """
+    INSERT INTO search_index (rowid, kind, ref_id, app_id, body)
+    SELECT tg_id * 4 + 2, 'user', tg_id, NULL, username FROM users
+    """,
+    """
+    INSERT INTO search_index (rowid, kind, ref_id, app_id, body)
+    SELECT id * 4 + 3, 'application', id, id,
+           id || ' ' || payment_code || ' ' || COALESCE(requisites_text_override, '')
+    FROM applications
+    """,
+)
+
+# init() и бэкфилл ждут другой процесс, который делает то же, дольше обычных 5 с
+BACKFILL_BUSY_TIMEOUT_MS = 120_000
+
+
+async def run_backfill(db, marker: str, statements: tuple[str, ...], force: bool = False) -> bool:
+    """Выполнить бэкфилл один раз на базу; True — выполнен сейчас
+
+    Отметка — строка settings с ключом marker, пишется в той же транзакции:
+    упавший посередине бэкфилл повторится при следующем init(). BEGIN
+    IMMEDIATE: процессы, стартующие одновременно (воркеры, API), выполняют
+    его по очереди, и следующий уже видит отметку.
+    """
+    await (await db.execute(f"PRAGMA busy_timeout = {BACKFILL_BUSY_TIMEOUT_MS}")).close()
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        cur = await db.execute("SELECT 1 FROM settings WHERE key=?", (marker,))
+        if await cur.fetchone() is not None and not force:
+            await db.rollback()
+            return False
+        for sql in statements:
+            await db.execute(sql)
+        await db.execute(
+            """INSERT INTO settings (key, value, updated_at) VALUES (?, '1', ?)
+               ON CONFLICT(key) DO UPDATE SET updated_at=excluded.updated_at""",
+            (marker, now_iso()),
+        )
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    return True
+
+
+def fts_query(text: str) -> str:
+    """Пользовательский ввод -> безопасный запрос FTS5 (фразы с префиксным поиском)"""
+    terms = [t.strip("@#") for t in text.split()]
+    return " ".join('"' + t.replace('"', '""') + '"*' for t in terms if t)
+
+
+# ApplicationView: заявка вместе с банком, страной и username участников — одним JOIN
+APP_VIEW_KEYS = (
+    "id", "user_tg_id", "bank_id", "amount_uah", "payment_code", "status",
+    "created_at", "requisites_sent_at", "expires_at", "updated_at",
+    "assigned_merchant_tg_id", "requisites_text_override",
+    "receipt_file_id", "receipt_file_type",
+    "bank_name", "requisites_text", "country_id", "country_name",
+    "user_username", "merchant_username",
+)
+APP_VIEW_SELECT = """
+SELECT a.id, a.user_tg_id, a.bank_id, a.amount_uah, a.payment_code, a.status,
+       a.created_at, a.requisites_sent_at, a.expires_at, a.updated_at,
+       a.assigned_merchant_tg_id, a.requisites_text_override,
+       a.receipt_file_id, a.receipt_file_type,
+       b.bank_name, b.requisites_text, b.country_id, c.name,
+       u.username, m.username
+FROM applications a
+LEFT JOIN bank_accounts b ON b.id=a.bank_id
+LEFT JOIN countries c ON c.id=b.country_id
+LEFT JOIN users u ON u.tg_id=a.user_tg_id
+LEFT JOIN users m ON m.tg_id=a.assigned_merchant_tg_id
+"""
+APP_VIEW_SQL = APP_VIEW_SELECT + "WHERE a.id IN ({})"
+ACTIVE_VIEW_SQL = APP_VIEW_SELECT + "WHERE a.status IN ({})".format(",".join("?" * len(ACTIVE_STATUSES)))
+ACTIVE_IDS_FOR_USER_SQL = "SELECT id FROM applications WHERE user_tg_id=? AND status IN ({})".format(
+    ",".join("?" * len(ACTIVE_STATUSES))
+)
+
+# Статусы, которые входят в оборот (как в get_stats)
+TURNOVER_STATUSES = ("CONFIRMED", "WAITING_PAYMENT", "WAITING_RECEIPT", "WAITING_CHECK")
+
 def now_iso() -> str:
     return dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
+class LeaseLost(Exception):
+    """Аренда перешла другому владельцу: запись с устаревшим fencing token отклонена"""
+
+
+async def check_fence(db, fence: tuple[str, int] | None) -> None:
+    """Внутри транзакции писателя: аренда name всё ещё с этим token"""
+    if fence is None:
+        return
+    cur = await db.execute("SELECT token FROM leases WHERE name=?", (fence[0],))
+    row = await cur.fetchone()
+    if row is None or row[0] != fence[1]:
+        raise LeaseLost(fence[0])
+
+
 class Database:
-    def __init__(self, path: str):
+    FLUSH_DELAY = 0.2
+    FLUSH_BATCH = 100
+    # Неудачный сброс повторяется через FLUSH_RETRY_DELAY, после FLUSH_RETRIES подряд пачка выбрасывается
+    FLUSH_RETRY_DELAY = 5.0
+    FLUSH_RETRIES = 5
+    PARTICIPANTS_TTL = 300
+    SETTINGS_TTL = 30
+    CATALOG_TTL = 60
+
+    def __init__(self, path: str, profiler: QueryProfiler | None = None, active_index: bool = True):
         self.path = path
+        self.profiler = profiler
         self._app_cols: set[str] | None = None
+        self.has_search = False
+        # Write-behind: отложенные INSERT'ы, сбрасываются пачкой (executemany)
+        self._deferred: dict[str, list[tuple]] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._flush_tasks: set[asyncio.Task] = set()
+        self._flush_failures = 0
+        self._flush_lock = asyncio.Lock()
+        # Настройки: key -> (value | None, expires_at); другие процессы увидят изменения через SETTINGS_TTL
+        self._settings: dict[str, tuple[str | None, float]] = {}
+        # Каталог стран/банков: (sql, params) -> (expires_at, rows)
+        self._catalog: dict[tuple, tuple[float, list[tuple]]] = {}
+        # Участники чата по app_id: (expires_at, participants)
+        self._participants: dict[int, tuple[float, dict[str, Any]]] = {}
+        # get_application_view за один проход цикла событий -> один запрос
+        self._app_views: BatchLoader[int, dict[str, Any]] = BatchLoader(self.get_application_views)
+        # Активные заявки: write-through после каждой записи в applications.
+        # Без active_index (API: изменения бота до него не доходят) view читаются из БД
+        self.active = ActiveApps(enabled=active_index)
+        # Все записи идут через одного писателя: group commit вместо commit на каждый вызов
+        self.writer = Writer(self._connect)
+
+    def _connect(self):
+        if self.profiler is None:
+            return aiosqlite.connect(self.path)
+        return self.profiler.connect(self.path)
+
+    # === Write-behind ===
+    def defer(self, sql: str, params: tuple) -> None:
+        """Поставить запись в очередь; сбрасывается через FLUSH_DELAY или при FLUSH_BATCH строк"""
+        batch = self._deferred.setdefault(sql, [])
+        batch.append(params)
+        if len(batch) >= self.FLUSH_BATCH:
+            self._schedule_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.FLUSH_DELAY, self._schedule_flush)
+
+    def _schedule_flush(self) -> None:
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task) -> None:
+        self._flush_tasks.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        # Строки уже вернулись в _deferred (flush), повторяем позже
+        logger.error("write-behind flush failed (attempt %d): %r", self._flush_failures, task.exception())
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.FLUSH_RETRY_DELAY, self._schedule_flush)
+
+    async def flush(self) -> None:
+        """Записать все отложенные строки одной транзакцией; при ошибке строки остаются в очереди"""
+        async with self._flush_lock:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            pending, self._deferred = self._deferred, {}
+            if not pending:
+                return
+
+            async def write(db) -> None:
+                for sql, rows in pending.items():
+                    await db.executemany(sql, rows)
+
+            try:
+                await self.writer.run(write)
+            except BaseException:
+                self._flush_failures += 1
+                if self._flush_failures > self.FLUSH_RETRIES:
+                    self._flush_failures = 0
+                    logger.error("write-behind: dropping %d rows after %d failed flushes",
+                                 sum(map(len, pending.values())), self.FLUSH_RETRIES + 1)
+                    raise
+                # Вернуть пачку перед строками, отложенными во время записи
+                for sql, rows in self._deferred.items():
+                    pending.setdefault(sql, []).extend(rows)
+                self._deferred = pending
+                raise
+            self._flush_failures = 0
+
+    async def close(self) -> None:
+        """Дождаться запущенных сбросов, сбросить остаток write-behind и дописать очередь писателя"""
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("write-behind flush on close failed, %d rows lost: %r",
+                         sum(map(len, self._deferred.values())), e)
+        await self.writer.close()
 
     async def init(self) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.executescript(SCHEMA)
+        async with self._connect() as db:
+            # Воркеры и API запускают init() одновременно: DDL — под BEGIN IMMEDIATE
+            # (иначе в WAL гонка снимков даёт «database is locked» без ожидания)
+            await (await db.execute(f"PRAGMA busy_timeout = {BACKFILL_BUSY_TIMEOUT_MS}")).close()
+            # WAL: читатели (бот, API) не ждут писателя; режим сохраняется в файле БД
+            await (await db.execute("PRAGMA journal_mode=WAL")).close()
+            await db.executescript(f"BEGIN IMMEDIATE;\n{SCHEMA}\nCOMMIT;")
 
             async def cols(table: str) -> set[str]:
                 cur = await db.execute(f"PRAGMA table_info({table})")
@@ -135,6 +505,10 @@ class Database:
             if "requisites_text_override" not in app_cols:
                 await db.execute("ALTER TABLE applications ADD COLUMN requisites_text_override TEXT")
 
+            # Migration: outbox.dead_at
+            if "dead_at" not in await cols("outbox"):
+                await db.execute("ALTER TABLE outbox ADD COLUMN dead_at TEXT")
+
             # Migration: users new columns
             user_cols = await cols("users")
             if "balance_uah" not in user_cols:
@@ -170,21 +544,62 @@ class Database:
                 )
             await db.commit()
 
+            # Rollup: триггеры + бэкфилл из истории, пока он не отмечен выполненным
+            await db.executescript(f"BEGIN IMMEDIATE;\n{ROLLUP_TRIGGERS}\nCOMMIT;")
+            await run_backfill(db, "backfill:daily_stats", REBUILD_DAILY_STATS)
+
+            # Поиск: FTS5 может отсутствовать в сборке SQLite, тогда /find недоступен.
+            # Остальные ошибки (в том числе бэкфилла) — не повод молча выключать поиск
+            try:
+                await db.executescript(f"BEGIN IMMEDIATE;\n{SEARCH_SCHEMA}\nCOMMIT;")
+                self.has_search = True
+            except sqlite3.OperationalError as e:
+                await db.rollback()
+                if "fts5" not in str(e):
+                    raise
+                self.has_search = False
+            if self.has_search:
+                await run_backfill(db, "backfill:search_index", REBUILD_SEARCH_INDEX)
+
+        await self.load_active_apps()
+
+    async def rebuild_daily_stats(self) -> None:
+        """Пересчитать daily_stats из applications (бэкфилл)"""
+        async with self._connect() as db:
+            await run_backfill(db, "backfill:daily_stats", REBUILD_DAILY_STATS, force=True)
+
     # === Settings ===
     async def get_setting(self, key: str, default: str = "") -> str:
-        async with aiosqlite.connect(self.path) as db:
+        cached = self._settings.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0] if cached[0] is not None else default
+        async with self._connect() as db:
             cur = await db.execute("SELECT value FROM settings WHERE key=?", (key,))
             row = await cur.fetchone()
-            return row[0] if row else default
+        value = row[0] if row else None
+        self._settings[key] = (value, time.monotonic() + self.SETTINGS_TTL)
+        return value if value is not None else default
 
     async def set_setting(self, key: str, value: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                """INSERT INTO settings (key, value, updated_at) VALUES (?, ?, ?)
-                   ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at""",
-                (key, value, now_iso())
-            )
-            await db.commit()
+        self._settings[key] = (value, time.monotonic() + self.SETTINGS_TTL)
+        await self.writer.execute(
+            """INSERT INTO settings (key, value, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at""",
+            (key, value, now_iso())
+        )
+
+    # === Catalog cache ===
+    async def _catalog_query(self, q: str, params: tuple = ()) -> list[tuple]:
+        """Списки стран/банков: кэш до изменения каталога (или CATALOG_TTL для других процессов)"""
+        key = (q, params)
+        cached = self._catalog.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        async with self._connect() as db:
+            cur = await db.execute(q, params)
+            rows = await cur.fetchall()
+        self._catalog[key] = (time.monotonic() + self.CATALOG_TTL, rows)
+        return rows
 
     # === Countries ===
     async def list_countries(self, active_only: bool = True) -> list[tuple[int, str, int]]:
@@ -192,12 +607,10 @@ class Database:
         if active_only:
             q += " WHERE is_active=1"
         q += " ORDER BY name"
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(q)
-            return await cur.fetchall()
+        return await self._catalog_query(q)
 
     async def get_country(self, country_id: int) -> Optional[dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute("SELECT id, name, is_active FROM countries WHERE id=?", (country_id,))
             row = await cur.fetchone()
             if not row:
@@ -205,18 +618,16 @@ class Database:
             return {"id": row[0], "name": row[1], "is_active": bool(row[2])}
 
     async def upsert_country(self, name: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                """INSERT INTO countries (name, is_active, created_at) VALUES (?, 1, ?)
-                   ON CONFLICT(name) DO UPDATE SET is_active=1""",
-                (name, now_iso())
-            )
-            await db.commit()
+        await self.writer.execute(
+            """INSERT INTO countries (name, is_active, created_at) VALUES (?, 1, ?)
+               ON CONFLICT(name) DO UPDATE SET is_active=1""",
+            (name, now_iso())
+        )
+        self._catalog.clear()
 
     async def set_country_active(self, country_id: int, is_active: bool) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE countries SET is_active=? WHERE id=?", (1 if is_active else 0, country_id))
-            await db.commit()
+        await self.writer.execute("UPDATE countries SET is_active=? WHERE id=?", (1 if is_active else 0, country_id))
+        self._catalog.clear()
 
     # === Banks ===
     async def list_banks(self, active_only: bool = True) -> list[tuple[int, str, int]]:
@@ -224,21 +635,17 @@ class Database:
         if active_only:
             q += " WHERE is_active=1"
         q += " ORDER BY bank_name"
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(q)
-            return await cur.fetchall()
+        return await self._catalog_query(q)
 
     async def list_banks_by_country(self, country_id: int, active_only: bool = True) -> list[tuple[int, str, int]]:
         q = "SELECT id, bank_name, is_active FROM bank_accounts WHERE country_id=?"
         if active_only:
             q += " AND is_active=1"
         q += " ORDER BY bank_name"
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(q, (country_id,))
-            return await cur.fetchall()
+        return await self._catalog_query(q, (country_id,))
 
     async def get_bank(self, bank_id: int) -> Optional[dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute(
                 "SELECT id, country_id, bank_name, requisites_text, is_active FROM bank_accounts WHERE id=?",
                 (bank_id,),
@@ -249,7 +656,7 @@ class Database:
             return {"id": row[0], "country_id": row[1], "bank_name": row[2], "requisites_text": row[3], "is_active": bool(row[4])}
 
     async def upsert_bank(self, bank_name: str, requisites_text: str, country_id: int = 1) -> None:
-        async with aiosqlite.connect(self.path) as db:
+        async def write(db) -> None:
             cur = await db.execute("SELECT id, country_id FROM bank_accounts WHERE bank_name=?", (bank_name,))
             row = await cur.fetchone()
             if row:
@@ -263,17 +670,26 @@ class Database:
                        VALUES (?, ?, ?, 1, ?)""",
                     (country_id, bank_name, requisites_text, now_iso())
                 )
-            await db.commit()
+
+        await self.writer.run(write)
+        self._catalog.clear()
+        self.active.discard_where(lambda view: view["bank_name"] == bank_name)
 
     async def set_bank_active(self, bank_id: int, is_active: bool) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE bank_accounts SET is_active=? WHERE id=?", (1 if is_active else 0, bank_id))
-            await db.commit()
+        await self.writer.execute("UPDATE bank_accounts SET is_active=? WHERE id=?", (1 if is_active else 0, bank_id))
+        self._catalog.clear()
 
     # === Applications ===
-    async def create_application(self, user_tg_id: int, bank_id: int, amount_uah: float, payment_code: str) -> int:
+    async def create_application(self, user_tg_id: int, bank_id: int, amount_uah: float, payment_code: str,
+                                 event: str | None = None) -> int:
+        """Новая заявка в WAITING_MERCHANT
+
+        event — тема события {"app_id": ...} в outbox, записывается той же
+        транзакцией: заявка и событие о ней появляются только вместе.
+        """
         created = now_iso()
-        async with aiosqlite.connect(self.path) as db:
+
+        async def write(db) -> int:
             cur = await db.execute(
                 """
                 INSERT INTO applications (user_tg_id, bank_id, amount_uah, payment_code, status, created_at, updated_at)
@@ -281,11 +697,60 @@ class Database:
                 """,
                 (user_tg_id, bank_id, amount_uah, payment_code, created, created),
             )
-            await db.commit()
-            return cur.lastrowid
+            app_id = cur.lastrowid
+            if event:
+                await db.execute(
+                    "INSERT INTO outbox (topic, payload, created_at) VALUES (?, ?, ?)",
+                    (event, json.dumps({"app_id": app_id}), created),
+                )
+            return app_id
+
+        app_id = await self.writer.run(write)
+        await self._sync_active(app_id)
+        return app_id
+
+    async def create_and_issue_application(self, user_tg_id: int, bank_id: int, amount_uah: float,
+                                           payment_code: str, requisites_text: str,
+                                           ttl_minutes: int = 20) -> dict[str, Any]:
+        """Заявка с автовыдачей реквизитов одной транзакцией
+
+        Заявка сразу создаётся в WAITING_PAYMENT с реквизитами и сроком оплаты,
+        в той же транзакции пишутся уведомление «Реквизиты получены» и запись
+        APP_CREATED в audit_log. Возвращает ApplicationView созданной заявки.
+        """
+        created = dt.datetime.utcnow().replace(microsecond=0)
+        sent = created.isoformat() + "Z"
+        exp = (created + dt.timedelta(minutes=ttl_minutes)).isoformat() + "Z"
+
+        async def write(db) -> dict[str, Any]:
+            cur = await db.execute(
+                """
+                INSERT INTO applications (user_tg_id, bank_id, amount_uah, payment_code, status,
+                                          requisites_text_override, requisites_sent_at, expires_at,
+                                          created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'WAITING_PAYMENT', ?, ?, ?, ?, ?)
+                """,
+                (user_tg_id, bank_id, amount_uah, payment_code, requisites_text, sent, exp, sent, sent),
+            )
+            app_id = cur.lastrowid
+            await db.execute(
+                """INSERT INTO notifications (user_tg_id, type, title, message, data, created_at)
+                   VALUES (?, 'requisites', 'Реквизиты получены', ?, ?, ?)""",
+                (user_tg_id, f"Заявка #{app_id}: реквизиты для оплаты", json.dumps({"app_id": app_id}), sent),
+            )
+            await db.execute(
+                "INSERT INTO audit_log (tg_id, action, payload, created_at) VALUES (?, 'APP_CREATED', ?, ?)",
+                (user_tg_id, f"app_id={app_id};auto=1", sent),
+            )
+            cur = await db.execute(APP_VIEW_SQL.format("?"), (app_id,))
+            return dict(zip(APP_VIEW_KEYS, await cur.fetchone()))
+
+        view = await self.writer.run(write)
+        self.active.put(view)
+        return dict(view)
 
     async def get_application(self, app_id: int) -> Optional[dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute(
                 """
                 SELECT id, user_tg_id, bank_id, amount_uah, payment_code, status,
@@ -307,8 +772,97 @@ class Database:
             ]
             return dict(zip(keys, row))
 
+    async def get_application_views(self, app_ids: list[int]) -> dict[int, dict[str, Any]]:
+        """ApplicationView по списку id: {app_id: view}, отсутствующих id в ответе нет"""
+        app_ids = list(dict.fromkeys(app_ids))
+        if not app_ids:
+            return {}
+        async with self._connect() as db:
+            cur = await db.execute(APP_VIEW_SQL.format(",".join("?" * len(app_ids))), app_ids)
+            rows = await cur.fetchall()
+        return {row[0]: dict(zip(APP_VIEW_KEYS, row)) for row in rows}
+
+    async def get_application_view(self, app_id: int) -> Optional[dict[str, Any]]:
+        """Заявка + bank_name, requisites_text, country_name, user_username, merchant_username
+
+        bank_name/requisites_text равны None, если банк удалён. Активные
+        заявки отдаются из индекса; промахи, вызванные в одном проходе цикла
+        событий, объединяются в один запрос.
+        """
+        view = self.active.get(app_id)
+        if view is not None:
+            return view
+        version = self.active.version
+        view = await self._app_views.load(app_id)
+        if view is not None:
+            self.active.fill([view], version)
+        return view
+
+    async def get_active_apps_for_user(self, user_tg_id: int) -> list[dict[str, Any]]:
+        """Активные заявки пользователя (ApplicationView), новые сначала
+
+        Заявки создаёт и API со своим индексом, поэтому набор id всегда
+        читается из БД (idx_applications_user); из индекса берутся только
+        view уже известных заявок, остальные дочитываются и попадают в индекс.
+        """
+        version = self.active.version
+        async with self._connect() as db:
+            cur = await db.execute(ACTIVE_IDS_FOR_USER_SQL, (user_tg_id, *ACTIVE_STATUSES))
+            ids = [row[0] for row in await cur.fetchall()]
+        views = {}
+        for app_id in ids:
+            view = self.active.get(app_id)
+            if view is not None and view["status"] in ACTIVE_STATUSES:
+                views[app_id] = view
+        missing = [app_id for app_id in ids if app_id not in views]
+        if missing:
+            loaded = await self.get_application_views(missing)
+            self.active.fill(loaded.values(), version)
+            views.update(loaded)
+        # Заявки, которые другой процесс уже закрыл, выбрасываем из индекса
+        stale = [view["id"] for view in self.active.for_user(user_tg_id) if view["id"] not in views]
+        if stale:
+            self.active.forget(stale)
+        return [views[app_id] for app_id in sorted(views, reverse=True)]
+
+    async def load_active_apps(self) -> int:
+        """Пересобрать индекс активных заявок из БД; возвращает их число"""
+        if not self.active.enabled:
+            return 0
+        version = self.active.version
+        async with self._connect() as db:
+            cur = await db.execute(ACTIVE_VIEW_SQL, tuple(ACTIVE_STATUSES))
+            rows = await cur.fetchall()
+        # Запись во время чтения — снимок устарел, пересоберём в следующий раз
+        self.active.replace((dict(zip(APP_VIEW_KEYS, row)) for row in rows), version)
+        return len(rows)
+
+    def forget_apps(self, app_ids: list[int] | None) -> None:
+        """Заявки изменил другой процесс: выбросить их из индекса и кэша участников (None — все)"""
+        self.active.forget(app_ids)
+        if app_ids is None:
+            self._participants.clear()
+        else:
+            for app_id in app_ids:
+                self._participants.pop(app_id, None)
+
+    async def _sync_active(self, app_id: int) -> None:
+        """Write-through: перечитать заявку после записи и обновить индекс"""
+        if not self.active.enabled:
+            return
+        self.active.version += 1
+        version = self.active.version
+        views = await self.get_application_views([app_id])
+        if self.active.version != version:
+            # Параллельная запись: прочитанное могло устареть, пусть следующее чтение сходит в БД
+            self.active.discard(app_id)
+        elif app_id in views:
+            self.active.put(views[app_id])
+        else:
+            self.active.discard(app_id)
+
     async def list_user_apps(self, user_tg_id: int, limit: int = 20, offset: int = 0, status_filter: str | None = None) -> list[tuple]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             query = """
                 SELECT a.id, COALESCE(b.bank_name, '[UNKNOWN]') as bank_name, a.amount_uah, a.payment_code, a.status, a.created_at
                 FROM applications a
@@ -325,7 +879,7 @@ class Database:
             return await cur.fetchall()
 
     async def count_user_apps(self, user_tg_id: int, status_filter: str | None = None) -> int:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             query = "SELECT COUNT(*) FROM applications WHERE user_tg_id=?"
             params = [user_tg_id]
             if status_filter:
@@ -335,120 +889,302 @@ class Database:
             row = await cur.fetchone()
             return row[0] if row else 0
 
-    async def assign_merchant(self, app_id: int, merchant_tg_id: int) -> bool:
-        async with aiosqlite.connect(self.path) as db:
+    async def iter_export_rows(self, date_from: str, date_to: str, chunk_size: int = 500):
+        """Заявки за [date_from, date_to) вместе с банком/страной/пользователями, чанками"""
+        async with self._connect() as db:
             cur = await db.execute(
                 """
-                UPDATE applications
-                SET assigned_merchant_tg_id=?, status='MERCHANT_TAKEN', updated_at=?
-                WHERE id=? AND status='WAITING_MERCHANT'
+                SELECT a.id, a.created_at, a.updated_at, a.status, a.amount_uah, a.payment_code,
+                       a.bank_id, b.bank_name, c.name,
+                       a.user_tg_id, u.username, a.assigned_merchant_tg_id, m.username,
+                       a.requisites_sent_at, a.expires_at
+                FROM applications a
+                LEFT JOIN bank_accounts b ON b.id=a.bank_id
+                LEFT JOIN countries c ON c.id=b.country_id
+                LEFT JOIN users u ON u.tg_id=a.user_tg_id
+                LEFT JOIN users m ON m.tg_id=a.assigned_merchant_tg_id
+                WHERE a.created_at >= ? AND a.created_at < ?
+                ORDER BY a.created_at, a.id
                 """,
-                (merchant_tg_id, now_iso(), app_id),
+                (date_from, date_to),
             )
-            await db.commit()
-            return cur.rowcount == 1
+            while True:
+                rows = await cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    async def assign_merchant(self, app_id: int, merchant_tg_id: int) -> bool:
+        self._participants.pop(app_id, None)
+        cur = await self.writer.execute(
+            """
+            UPDATE applications
+            SET assigned_merchant_tg_id=?, status='MERCHANT_TAKEN', updated_at=?
+            WHERE id=? AND status='WAITING_MERCHANT'
+            """,
+            (merchant_tg_id, now_iso(), app_id),
+        )
+        if cur.rowcount == 1:
+            await self._sync_active(app_id)
+        return cur.rowcount == 1
 
     async def unassign_merchant(self, app_id: int, merchant_tg_id: int | None = None) -> bool:
+        self._participants.pop(app_id, None)
         now = now_iso()
-        async with aiosqlite.connect(self.path) as db:
-            if merchant_tg_id is None:
-                cur = await db.execute(
-                    """
-                    UPDATE applications
-                    SET status='WAITING_MERCHANT', assigned_merchant_tg_id=NULL, updated_at=?
-                    WHERE id=? AND status='MERCHANT_TAKEN'
-                    """,
-                    (now, app_id),
-                )
-            else:
-                cur = await db.execute(
-                    """
-                    UPDATE applications
-                    SET status='WAITING_MERCHANT', assigned_merchant_tg_id=NULL, updated_at=?
-                    WHERE id=? AND status='MERCHANT_TAKEN' AND assigned_merchant_tg_id=?
-                    """,
-                    (now, app_id, merchant_tg_id),
-                )
-            await db.commit()
-            return cur.rowcount == 1
-
-    async def set_requisites_and_start_timer(self, app_id: int, requisites_text: str, ttl_minutes: int = 20) -> bool:
-        created = dt.datetime.utcnow().replace(microsecond=0)
-        sent = created.isoformat() + "Z"
-        exp = (created + dt.timedelta(minutes=ttl_minutes)).isoformat() + "Z"
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
+        if merchant_tg_id is None:
+            cur = await self.writer.execute(
                 """
                 UPDATE applications
-                SET requisites_text_override=?, requisites_sent_at=?, expires_at=?, status='WAITING_PAYMENT', updated_at=?
+                SET status='WAITING_MERCHANT', assigned_merchant_tg_id=NULL, updated_at=?
                 WHERE id=? AND status='MERCHANT_TAKEN'
                 """,
-                (requisites_text, sent, exp, now_iso(), app_id),
+                (now, app_id),
             )
-            await db.commit()
-            return cur.rowcount == 1
+        else:
+            cur = await self.writer.execute(
+                """
+                UPDATE applications
+                SET status='WAITING_MERCHANT', assigned_merchant_tg_id=NULL, updated_at=?
+                WHERE id=? AND status='MERCHANT_TAKEN' AND assigned_merchant_tg_id=?
+                """,
+                (now, app_id, merchant_tg_id),
+            )
+        if cur.rowcount == 1:
+            self.active.patch(app_id, status="WAITING_MERCHANT", assigned_merchant_tg_id=None,
+                              merchant_username=None, updated_at=now)
+        return cur.rowcount == 1
+
+    async def set_requisites_and_start_timer(self, app_id: int, requisites_text: str, ttl_minutes: int = 20) -> bool:
+        created = dt.datetime.utcnow().replace(microsecond=0)
+        sent = created.isoformat() + "Z"
+        exp = (created + dt.timedelta(minutes=ttl_minutes)).isoformat() + "Z"
+        now = now_iso()
+        cur = await self.writer.execute(
+            """
+            UPDATE applications
+            SET requisites_text_override=?, requisites_sent_at=?, expires_at=?, status='WAITING_PAYMENT', updated_at=?
+            WHERE id=? AND status='MERCHANT_TAKEN'
+            """,
+            (requisites_text, sent, exp, now, app_id),
+        )
+        if cur.rowcount == 1 and not self.active.patch(
+            app_id, requisites_text_override=requisites_text, requisites_sent_at=sent,
+            expires_at=exp, status="WAITING_PAYMENT", updated_at=now,
+        ):
+            await self._sync_active(app_id)
+        return cur.rowcount == 1
 
     async def set_app_status(self, app_id: int, status: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE applications SET status=?, updated_at=? WHERE id=?", (status, now_iso(), app_id))
-            await db.commit()
+        now = now_iso()
+        await self.writer.execute("UPDATE applications SET status=?, updated_at=? WHERE id=?", (status, now, app_id))
+        if status not in ACTIVE_STATUSES:
+            self.active.discard(app_id)
+        elif not self.active.patch(app_id, status=status, updated_at=now):
+            await self._sync_active(app_id)
 
     async def set_receipt(self, app_id: int, file_id: str, file_type: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
+        now = now_iso()
+        await self.writer.execute(
+            "UPDATE applications SET receipt_file_id=?, receipt_file_type=?, updated_at=? WHERE id=?",
+            (file_id, file_type, now, app_id),
+        )
+        self.active.patch(app_id, receipt_file_id=file_id, receipt_file_type=file_type, updated_at=now)
+
+    async def add_receipt(self, app_id: int, user_tg_id: int, file_id: str, file_unique_id: str,
+                          file_type: str, chat_id: int | None = None, message_id: int | None = None) -> list[int]:
+        """Сохраняет чек и возвращает id других заявок, к которым уже прикладывали этот файл"""
+        now = now_iso()
+
+        async def write(db) -> list[int]:
+            cur = await db.execute(
+                "SELECT DISTINCT app_id FROM receipts WHERE file_unique_id=? AND app_id!=? ORDER BY app_id",
+                (file_unique_id, app_id),
+            )
+            duplicates = [r[0] for r in await cur.fetchall()]
+            await db.execute(
+                """INSERT INTO receipts (app_id, user_tg_id, file_id, file_unique_id, file_type, chat_id, message_id, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (app_id, user_tg_id, file_id, file_unique_id, file_type, chat_id, message_id, now),
+            )
             await db.execute(
                 "UPDATE applications SET receipt_file_id=?, receipt_file_type=?, updated_at=? WHERE id=?",
-                (file_id, file_type, now_iso(), app_id),
+                (file_id, file_type, now, app_id),
             )
-            await db.commit()
+            return duplicates
 
-    async def expire_overdue(self) -> list[int]:
+        duplicates = await self.writer.run(write)
+        self.active.patch(app_id, receipt_file_id=file_id, receipt_file_type=file_type, updated_at=now)
+        return duplicates
+
+    async def get_receipt(self, app_id: int) -> Optional[dict[str, Any]]:
+        """Последний чек заявки и список других заявок с тем же файлом"""
+        async with self._connect() as db:
+            cur = await db.execute(
+                """SELECT id, file_id, file_unique_id, file_type, chat_id, message_id, created_at
+                   FROM receipts WHERE app_id=? ORDER BY id DESC LIMIT 1""",
+                (app_id,),
+            )
+            row = await cur.fetchone()
+            if not row:
+                return None
+            cur = await db.execute(
+                "SELECT DISTINCT app_id FROM receipts WHERE file_unique_id=? AND app_id!=? ORDER BY app_id",
+                (row[2], app_id),
+            )
+            duplicates = [r[0] for r in await cur.fetchall()]
+        keys = ["id", "file_id", "file_unique_id", "file_type", "chat_id", "message_id", "created_at"]
+        return {**dict(zip(keys, row)), "duplicate_app_ids": duplicates}
+
+    async def expire_overdue(self, fence: tuple[str, int] | None = None) -> list[int]:
+        """Закрыть просроченные заявки; fence=(аренда, token) — только пока аренда наша"""
         now = now_iso()
-        async with aiosqlite.connect(self.path) as db:
+
+        async def write(db) -> list[int]:
+            await check_fence(db, fence)
             cur = await db.execute(
                 "SELECT id FROM applications WHERE status='WAITING_PAYMENT' AND expires_at IS NOT NULL AND expires_at < ?",
                 (now,),
             )
-            rows = await cur.fetchall()
-            ids = [r[0] for r in rows]
+            ids = [r[0] for r in await cur.fetchall()]
             if ids:
                 await db.executemany(
                     "UPDATE applications SET status='EXPIRED', updated_at=? WHERE id=?",
                     [(now, _id) for _id in ids],
                 )
-                await db.commit()
             return ids
 
+        ids = await self.writer.run(write)
+        for app_id in ids:
+            self.active.discard(app_id)
+        return ids
+
     async def add_message(self, app_id: int, from_tg_id: int, to_tg_id: int, text: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT INTO messages (app_id, from_tg_id, to_tg_id, text, created_at) VALUES (?, ?, ?, ?, ?)",
-                (app_id, from_tg_id, to_tg_id, text, now_iso()),
-            )
-            await db.commit()
+        """Сохранить сообщение чата (write-behind, без отдельного соединения и commit)"""
+        self.defer(
+            "INSERT INTO messages (app_id, from_tg_id, to_tg_id, text, created_at) VALUES (?, ?, ?, ?, ?)",
+            (app_id, from_tg_id, to_tg_id, text, now_iso()),
+        )
+
+    async def list_messages(self, app_id: int, limit: int = 50, before_id: int | None = None) -> list[dict[str, Any]]:
+        """История чата по заявке, новые сначала; пагинация по id (индекс app_id, id)"""
+        await self.flush()
+        query = "SELECT id, from_tg_id, to_tg_id, text, created_at FROM messages WHERE app_id=?"
+        params: list[Any] = [app_id]
+        if before_id:
+            query += " AND id < ?"
+            params.append(before_id)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        async with self._connect() as db:
+            cur = await db.execute(query, params)
+            rows = await cur.fetchall()
+            return [
+                {"id": r[0], "from_tg_id": r[1], "to_tg_id": r[2], "text": r[3], "created_at": r[4]}
+                for r in rows
+            ]
+
+    async def get_chat_participants(self, app_id: int) -> Optional[dict[str, Any]]:
+        """Пользователь и мерчант заявки с username для проверки доступа к чату
+
+        Читаются из БД, не из индекса. Кэш на PARTICIPANTS_TTL секунд — только
+        при active_index: его сбрасывают свои записи и forget_apps, а без
+        индекса (API) назначение мерчанта ботом сюда не доходит.
+        """
+        cached = self._participants.get(app_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        view = await self._app_views.load(app_id)
+        if not view:
+            return None
+        participants = {
+            "user_tg_id": view["user_tg_id"],
+            "user_username": view["user_username"],
+            "merchant_tg_id": view["assigned_merchant_tg_id"],
+            "merchant_username": view["merchant_username"],
+        }
+        if not self.active.enabled:
+            return participants
+        now = time.monotonic()
+        if len(self._participants) > 10000:
+            self._participants = {k: v for k, v in self._participants.items() if v[0] > now}
+        self._participants[app_id] = (now + self.PARTICIPANTS_TTL, participants)
+        return participants
 
     # === Users ===
     async def user_exists(self, tg_id: int) -> bool:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute("SELECT 1 FROM users WHERE tg_id=? LIMIT 1", (tg_id,))
             row = await cur.fetchone()
             return bool(row)
 
     async def upsert_user(self, tg_id: int, username: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute("SELECT tg_id FROM users WHERE tg_id=?", (tg_id,))
-            row = await cur.fetchone()
-            if row:
-                await db.execute("UPDATE users SET username=? WHERE tg_id=?", (username, tg_id))
+        cur = await self.writer.execute(
+            """INSERT INTO users (tg_id, username, role, referral_code, created_at) VALUES (?, ?, 'USER', ?, ?)
+               ON CONFLICT(tg_id) DO UPDATE SET username=excluded.username
+               WHERE users.username IS NOT excluded.username""",
+            (tg_id, username, referral_code(tg_id), now_iso()),
+        )
+        if cur.rowcount:
+            self._forget_username(tg_id)
+
+    async def register_user(self, tg_id: int, username: str, referrer_tg_id: int | None = None,
+                            log_action: str | None = "START") -> dict[str, Any]:
+        """Регистрация по /start одной транзакцией: пользователь, реферал и запись в audit_log
+
+        Реферал привязывается только при первой регистрации и только если
+        пригласивший уже есть в базе. Возвращает {"created", "referred_by"}.
+        """
+        now = now_iso()
+        if referrer_tg_id == tg_id:
+            referrer_tg_id = None
+
+        async def write(db) -> dict[str, Any]:
+            # INSERT OR IGNORE вместо ON CONFLICT DO UPDATE ... RETURNING: в SQLite
+            # RETURNING не отличает вставку от обновления, а rowcount — отличает
+            cur = await db.execute(
+                """INSERT OR IGNORE INTO users (tg_id, username, role, referral_code, referred_by, created_at)
+                   VALUES (?, ?, 'USER', ?, (SELECT tg_id FROM users WHERE tg_id=?), ?)""",
+                (tg_id, username, referral_code(tg_id), referrer_tg_id, now),
+            )
+            created = cur.rowcount == 1
+            referred_by = None
+            renamed = False
+            if created:
+                if referrer_tg_id is not None:
+                    cur = await db.execute(
+                        """INSERT OR IGNORE INTO referrals (referrer_tg_id, referred_tg_id, bonus_uah, created_at)
+                           SELECT referred_by, tg_id, 0, ? FROM users WHERE tg_id=? AND referred_by IS NOT NULL""",
+                        (now, tg_id),
+                    )
+                    if cur.rowcount == 1:
+                        referred_by = referrer_tg_id
             else:
-                referral_code = f"REF{tg_id}"
+                cur = await db.execute(
+                    "UPDATE users SET username=? WHERE tg_id=? AND username IS NOT ?",
+                    (username, tg_id, username),
+                )
+                renamed = cur.rowcount == 1
+            if log_action:
                 await db.execute(
-                    "INSERT INTO users (tg_id, username, role, referral_code, created_at) VALUES (?, ?, 'USER', ?, ?)",
-                    (tg_id, username, referral_code, now_iso()),
+                    "INSERT INTO audit_log (tg_id, action, payload, created_at) VALUES (?, ?, ?, ?)",
+                    (tg_id, log_action, username, now),
                 )
-            await db.commit()
+            return {"created": created, "referred_by": referred_by, "renamed": renamed}
+
+        result = await self.writer.run(write)
+        if result.pop("renamed"):
+            self._forget_username(tg_id)
+        return result
+
+    def _forget_username(self, tg_id: int) -> None:
+        """username сменился — выбросить заявки, где он закэширован"""
+        self._participants.clear()
+        self.active.discard_where(
+            lambda view: tg_id in (view["user_tg_id"], view["assigned_merchant_tg_id"])
+        )
 
     async def get_user(self, tg_id: int) -> Optional[dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute(
                 "SELECT tg_id, username, role, balance_uah, referral_code, referred_by, created_at FROM users WHERE tg_id=?",
                 (tg_id,)
@@ -467,7 +1203,7 @@ class Database:
             }
 
     async def get_user_by_referral_code(self, referral_code: str) -> Optional[dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute(
                 "SELECT tg_id, username, role, balance_uah, referral_code, referred_by, created_at FROM users WHERE referral_code=?",
                 (referral_code,)
@@ -486,48 +1222,48 @@ class Database:
             }
 
     async def get_user_role(self, tg_id: int) -> str:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute("SELECT role FROM users WHERE tg_id=?", (tg_id,))
             row = await cur.fetchone()
             return row[0] if row else "USER"
 
     async def set_user_role(self, tg_id: int, role: str) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("UPDATE users SET role=? WHERE tg_id=?", (role, tg_id))
-            await db.commit()
+        await self.writer.execute("UPDATE users SET role=? WHERE tg_id=?", (role, tg_id))
 
     async def get_username(self, tg_id: int) -> str | None:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute("SELECT username FROM users WHERE tg_id=?", (tg_id,))
             row = await cur.fetchone()
             return row[0] if row else None
 
     async def update_balance(self, tg_id: int, amount: float) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "UPDATE users SET balance_uah = balance_uah + ? WHERE tg_id=?",
-                (amount, tg_id)
-            )
-            await db.commit()
+        await self.writer.execute(
+            "UPDATE users SET balance_uah = balance_uah + ? WHERE tg_id=?",
+            (amount, tg_id)
+        )
 
     # === Statistics ===
     async def get_stats(self) -> dict[str, Any]:
-        async with aiosqlite.connect(self.path) as db:
-            # Total applications
-            cur = await db.execute("SELECT COUNT(*) FROM applications")
-            total_apps = (await cur.fetchone())[0]
+        async with self._connect() as db:
+            # Totals from daily rollup (O(days), not O(applications))
+            cur = await db.execute(
+                f"""
+                SELECT COALESCE(SUM(apps_count), 0),
+                       COALESCE(SUM(CASE WHEN status IN ({",".join("?" * len(TURNOVER_STATUSES))})
+                                         THEN amount_uah ELSE 0 END), 0)
+                FROM daily_stats
+                """,
+                TURNOVER_STATUSES,
+            )
+            total_apps, turnover = await cur.fetchone()
 
             # Total users
             cur = await db.execute("SELECT COUNT(*) FROM users")
             total_users = (await cur.fetchone())[0]
 
-            # Total turnover
-            cur = await db.execute("SELECT COALESCE(SUM(amount_uah), 0) FROM applications WHERE status IN ('CONFIRMED', 'WAITING_PAYMENT', 'WAITING_RECEIPT', 'WAITING_CHECK')")
-            turnover = (await cur.fetchone())[0]
-
             # Today's applications
             today = dt.datetime.utcnow().strftime("%Y-%m-%d")
-            cur = await db.execute("SELECT COUNT(*) FROM applications WHERE created_at LIKE ?", (f"{today}%",))
+            cur = await db.execute("SELECT COALESCE(SUM(apps_count), 0) FROM daily_stats WHERE day=?", (today,))
             today_apps = (await cur.fetchone())[0]
 
             return {
@@ -537,8 +1273,95 @@ class Database:
                 "today_applications": today_apps
             }
 
+    async def get_analytics(self, date_from: str, date_to: str) -> dict[str, Any]:
+        """Оборот и конверсия за [date_from, date_to) по дням, банкам и странам из daily_stats"""
+        agg = """
+            SUM(d.apps_count),
+            SUM(CASE WHEN d.status='CONFIRMED' THEN d.apps_count ELSE 0 END),
+            SUM(CASE WHEN d.status IN ('REJECTED', 'EXPIRED') THEN d.apps_count ELSE 0 END),
+            SUM(CASE WHEN d.status='CONFIRMED' THEN d.amount_uah ELSE 0 END)
+        """
+
+        def row_to_dict(key: str, row: tuple) -> dict[str, Any]:
+            name, total, confirmed, failed, turnover = row
+            closed = confirmed + failed
+            return {
+                key: name,
+                "applications": total,
+                "confirmed": confirmed,
+                "closed": closed,
+                "turnover": turnover,
+                "confirmation_rate": round(confirmed / closed, 4) if closed else None,
+            }
+
+        async with self._connect() as db:
+            cur = await db.execute(
+                f"SELECT d.day, {agg} FROM daily_stats d WHERE d.day >= ? AND d.day < ? GROUP BY d.day ORDER BY d.day",
+                (date_from, date_to),
+            )
+            by_day = [row_to_dict("day", r) for r in await cur.fetchall()]
+
+            cur = await db.execute(
+                f"""
+                SELECT COALESCE(b.bank_name, '[UNKNOWN]'), {agg}
+                FROM daily_stats d LEFT JOIN bank_accounts b ON b.id=d.bank_id
+                WHERE d.day >= ? AND d.day < ?
+                GROUP BY d.bank_id ORDER BY 5 DESC
+                """,
+                (date_from, date_to),
+            )
+            by_bank = [row_to_dict("bank_name", r) for r in await cur.fetchall()]
+
+            cur = await db.execute(
+                f"""
+                SELECT COALESCE(c.name, '[UNKNOWN]'), {agg}
+                FROM daily_stats d
+                LEFT JOIN bank_accounts b ON b.id=d.bank_id
+                LEFT JOIN countries c ON c.id=b.country_id
+                WHERE d.day >= ? AND d.day < ?
+                GROUP BY c.id ORDER BY 5 DESC
+                """,
+                (date_from, date_to),
+            )
+            by_country = [row_to_dict("country_name", r) for r in await cur.fetchall()]
+
+        confirmed = sum(d["confirmed"] for d in by_day)
+        closed = sum(d["closed"] for d in by_day)
+        return {
+            "date_from": date_from,
+            "date_to": date_to,
+            "applications": sum(d["applications"] for d in by_day),
+            "confirmed": confirmed,
+            "turnover": sum(d["turnover"] for d in by_day),
+            "confirmation_rate": round(confirmed / closed, 4) if closed else None,
+            "by_day": by_day,
+            "by_bank": by_bank,
+            "by_country": by_country,
+        }
+
+    # === Search ===
+    async def search(self, query: str, limit: int = 20, offset: int = 0) -> list[dict[str, Any]]:
+        """Поиск по сообщениям, username и кодам/реквизитам заявок (ранжирование bm25)"""
+        match = fts_query(query)
+        if not self.has_search or not match:
+            return []
+        async with self._connect() as db:
+            cur = await db.execute(
+                """
+                SELECT kind, ref_id, app_id, snippet(search_index, 3, '[', ']', '…', 12), rank
+                FROM search_index WHERE search_index MATCH ?
+                ORDER BY rank LIMIT ? OFFSET ?
+                """,
+                (match, limit, offset),
+            )
+            rows = await cur.fetchall()
+            return [
+                {"kind": r[0], "ref_id": r[1], "app_id": r[2], "snippet": r[3], "rank": r[4]}
+                for r in rows
+            ]
+
     async def get_user_stats(self, tg_id: int) -> dict[str, Any]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             # Total user applications
             cur = await db.execute("SELECT COUNT(*) FROM applications WHERE user_tg_id=?", (tg_id,))
             total_apps = (await cur.fetchone())[0]
@@ -562,39 +1385,125 @@ class Database:
 
     # === Referrals ===
     async def get_referral_count(self, tg_id: int) -> int:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute("SELECT COUNT(*) FROM referrals WHERE referrer_tg_id=?", (tg_id,))
             return (await cur.fetchone())[0]
 
     async def add_referral(self, referrer_tg_id: int, referred_tg_id: int, bonus_uah: float = 0) -> bool:
-        async with aiosqlite.connect(self.path) as db:
-            try:
-                await db.execute(
-                    "INSERT INTO referrals (referrer_tg_id, referred_tg_id, bonus_uah, created_at) VALUES (?, ?, ?, ?)",
-                    (referrer_tg_id, referred_tg_id, bonus_uah, now_iso())
-                )
-                await db.execute(
-                    "UPDATE users SET referred_by = ? WHERE tg_id = ?",
-                    (referrer_tg_id, referred_tg_id)
-                )
-                await db.commit()
-                return True
-            except Exception:
-                return False
+        async def write(db) -> None:
+            await db.execute(
+                "INSERT INTO referrals (referrer_tg_id, referred_tg_id, bonus_uah, created_at) VALUES (?, ?, ?, ?)",
+                (referrer_tg_id, referred_tg_id, bonus_uah, now_iso())
+            )
+            await db.execute(
+                "UPDATE users SET referred_by = ? WHERE tg_id = ?",
+                (referrer_tg_id, referred_tg_id)
+            )
 
-    # === Notifications ===
-    async def create_notification(self, user_tg_id: int, type: str, title: str, message: str, data: str | None = None) -> int:
-        async with aiosqlite.connect(self.path) as db:
+        # Ошибка откатывает savepoint операции, остальная пачка писателя коммитится
+        try:
+            await self.writer.run(write)
+            return True
+        except Exception:
+            return False
+
+    # === Outbox ===
+    async def pending_events(self, limit: int = 100) -> list[dict[str, Any]]:
+        """Недоставленные живые события по порядку записи"""
+        async with self._connect() as db:
             cur = await db.execute(
-                """INSERT INTO notifications (user_tg_id, type, title, message, data, created_at)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (user_tg_id, type, title, message, data, now_iso())
+                """SELECT id, topic, payload, attempts FROM outbox
+                   WHERE delivered_at IS NULL AND dead_at IS NULL ORDER BY id LIMIT ?""",
+                (limit,),
             )
-            await db.commit()
-            return cur.lastrowid
+            rows = await cur.fetchall()
+        return [{"id": r[0], "topic": r[1], "payload": json.loads(r[2]), "attempts": r[3]} for r in rows]
+
+    async def finish_event(self, event_id: int, delivered: bool, max_attempts: int = 5) -> bool:
+        """Отметить доставку; неудача увеличивает attempts, событие повторится
+
+        Возвращает True, если событие исчерпало max_attempts и помечено dead.
+        """
+        if delivered:
+            await self.writer.execute("UPDATE outbox SET delivered_at=? WHERE id=?", (now_iso(), event_id))
+            return False
+
+        async def write(db) -> bool:
+            cur = await db.execute(
+                """UPDATE outbox SET attempts=attempts+1,
+                          dead_at=CASE WHEN attempts+1 >= ? THEN ? END
+                   WHERE id=? RETURNING dead_at IS NOT NULL""",
+                (max_attempts, now_iso(), event_id),
+            )
+            row = await cur.fetchone()
+            return bool(row and row[0])
+
+        return await self.writer.run(write)
+
+    async def dead_events(self, limit: int = 20) -> tuple[int, list[dict[str, Any]]]:
+        """Число dead-событий и последние из них"""
+        async with self._connect() as db:
+            cur = await db.execute("SELECT COUNT(*) FROM outbox WHERE dead_at IS NOT NULL")
+            total = (await cur.fetchone())[0]
+            cur = await db.execute(
+                """SELECT id, topic, payload, attempts, dead_at FROM outbox
+                   WHERE dead_at IS NOT NULL ORDER BY id DESC LIMIT ?""",
+                (limit,),
+            )
+            rows = await cur.fetchall()
+        keys = ("id", "topic", "payload", "attempts", "dead_at")
+        return total, [dict(zip(keys, r)) for r in rows]
+
+    async def replay_events(self, event_ids: list[int] | None = None) -> int:
+        """Вернуть dead-события в доставку (None — все); возвращает их число"""
+        sql = "UPDATE outbox SET dead_at=NULL, attempts=0 WHERE dead_at IS NOT NULL"
+        params: tuple = ()
+        if event_ids is not None:
+            if not event_ids:
+                return 0
+            sql += " AND id IN ({})".format(",".join("?" * len(event_ids)))
+            params = tuple(event_ids)
+        result = await self.writer.execute(sql, params)
+        return result.rowcount
+
+    # === Leases ===
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> int | None:
+        """Взять или продлить аренду на ttl секунд; fencing token или None, если она занята"""
+        now = time.time()
+
+        async def write(db) -> int | None:
+            cur = await db.execute(
+                """
+                INSERT INTO leases (name, owner, token, expires_at) VALUES (?, ?, 1, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    token = CASE WHEN owner = excluded.owner THEN token ELSE token + 1 END,
+                    owner = excluded.owner,
+                    expires_at = excluded.expires_at
+                WHERE owner = excluded.owner OR expires_at < ?
+                RETURNING token
+                """,
+                (name, owner, now + ttl, now),
+            )
+            row = await cur.fetchone()
+            return row[0] if row else None
+
+        return await self.writer.run(write)
+
+    async def release_lease(self, name: str, owner: str) -> None:
+        """Отдать аренду сразу, не дожидаясь истечения"""
+        await self.writer.execute("UPDATE leases SET expires_at=0 WHERE name=? AND owner=?", (name, owner))
+
+    # === Notifications ===
+    async def create_notification(self, user_tg_id: int, type: str, title: str, message: str, data: str | None = None) -> int:
+        cur = await self.writer.execute(
+            """INSERT INTO notifications (user_tg_id, type, title, message, data, created_at)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (user_tg_id, type, title, message, data, now_iso())
+        )
+        return cur.lastrowid
 
     async def get_user_notifications(self, user_tg_id: int, limit: int = 20) -> list[dict[str, Any]]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute(
                 """SELECT id, type, title, message, is_read, data, created_at
                    FROM notifications WHERE user_tg_id=? ORDER BY id DESC LIMIT ?""",
@@ -615,16 +1524,14 @@ class Database:
             ]
 
     async def mark_notification_read(self, notification_id: int, user_tg_id: int) -> bool:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                "UPDATE notifications SET is_read=1 WHERE id=? AND user_tg_id=?",
-                (notification_id, user_tg_id)
-            )
-            await db.commit()
-            return cur.rowcount == 1
+        cur = await self.writer.execute(
+            "UPDATE notifications SET is_read=1 WHERE id=? AND user_tg_id=?",
+            (notification_id, user_tg_id)
+        )
+        return cur.rowcount == 1
 
     async def get_unread_notifications_count(self, user_tg_id: int) -> int:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute(
                 "SELECT COUNT(*) FROM notifications WHERE user_tg_id=? AND is_read=0",
                 (user_tg_id,)
@@ -633,15 +1540,13 @@ class Database:
 
     # === Broadcast ===
     async def get_all_users(self) -> list[int]:
-        async with aiosqlite.connect(self.path) as db:
+        async with self._connect() as db:
             cur = await db.execute("SELECT tg_id FROM users")
             rows = await cur.fetchall()
             return [r[0] for r in rows]
 
     async def log(self, tg_id: int | None, action: str, payload: str | None = None) -> None:
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT INTO audit_log (tg_id, action, payload, created_at) VALUES (?, ?, ?, ?)",
-                (tg_id, action, payload, now_iso()),
-            )
-            await db.commit()
+        await self.writer.execute(
+            "INSERT INTO audit_log (tg_id, action, payload, created_at) VALUES (?, ?, ?, ?)",
+            (tg_id, action, payload, now_iso()),
+        )
@@ -0,0 +1,93 @@
+"""
+Доставка событий API -> бот
+
+API пишет событие в таблицу outbox той же транзакцией, что и изменение
+(Database.create_application(..., event=...)), и зовёт bus.wake(). В боте
+bus.relay() читает outbox по порядку, вызывает подписчиков темы и отмечает
+доставку в БД, так что событие не теряется при падении любого из процессов.
+
+- один процесс (run both: API в потоке рядом с ботом): wake() будит relay
+  сразу, задержка — один запрос к outbox;
+- раздельные процессы: wake() в API ничего не делает, relay опрашивает
+  outbox раз в POLL_INTERVAL.
+
+Доставка «хотя бы один раз»: упавший подписчик повторится, до MAX_ATTEMPTS.
+Потом событие помечается dead (outbox.dead_at): ERROR в лог, метрика
+outbox_dead_total, вернуть в доставку — /outbox replay у админа.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import logging
+from typing import Any, Awaitable, Callable
+
+from bot.metrics import registry
+
+APP_CREATED = "app.created"
+
+POLL_INTERVAL = 1.0
+BATCH = 100
+MAX_ATTEMPTS = 5
+
+Handler = Callable[[dict[str, Any]], Awaitable[None]]
+
+m_dead = registry.counter("outbox_dead_total", "Outbox events given up after MAX_ATTEMPTS")
+
+
+class EventBus:
+    def __init__(self):
+        self._handlers: dict[str, list[Handler]] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+
+    def subscribe(self, topic: str, handler: Handler) -> None:
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def wake(self) -> None:
+        """Сообщить relay о новом событии в outbox; можно звать из любого потока"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def dispatch(self, topic: str, payload: dict[str, Any]) -> None:
+        for handler in self._handlers.get(topic, ()):
+            await handler(payload)
+
+    async def relay(self, db, logger: logging.Logger, poll_interval: float = POLL_INTERVAL) -> None:
+        """Цикл доставки outbox подписчикам (запускается в процессе бота)"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                self._wakeup.clear()
+                try:
+                    events = await db.pending_events(BATCH)
+                    failed = False
+                    for event in events:
+                        try:
+                            await self.dispatch(event["topic"], event["payload"])
+                        except Exception:
+                            logger.exception("event #%s %s failed (attempt %d)",
+                                             event["id"], event["topic"], event["attempts"] + 1)
+                            if await db.finish_event(event["id"], False, MAX_ATTEMPTS):
+                                m_dead.inc()
+                                logger.error("event #%s %s is dead after %d attempts, payload %s; "
+                                             "replay with /outbox replay", event["id"], event["topic"],
+                                             MAX_ATTEMPTS, event["payload"])
+                            failed = True
+                        else:
+                            await db.finish_event(event["id"], True)
+                    # Полная пачка — в outbox есть ещё; после ошибок повтор ждёт опроса
+                    if len(events) == BATCH and not failed:
+                        continue
+                except Exception as e:
+                    logger.exception("outbox relay error: %s", e)
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), poll_interval)
+        finally:
+            self._loop = None
+
+
+bus = EventBus()
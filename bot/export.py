@@ -0,0 +1,89 @@
+"""
+Потоковая выгрузка заявок (CSV/JSONL) для админов
+"""
+from __future__ import annotations
+import csv
+import datetime as dt
+import io
+import json
+import zlib
+from typing import AsyncIterator
+
+EXPORT_COLUMNS = [
+    "id", "created_at", "updated_at", "status", "amount_uah", "payment_code",
+    "bank_id", "bank_name", "country_name",
+    "user_tg_id", "username", "assigned_merchant_tg_id", "merchant_username",
+    "requisites_sent_at", "expires_at",
+]
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+}
+
+CHUNK_SIZE = 500
+
+
+def parse_date_range(date_from: str | None, date_to: str | None, days: int = 30) -> tuple[str, str]:
+    """Возвращает [from, to) в формате YYYY-MM-DD; date_to включительно"""
+    today = dt.datetime.utcnow().date()
+    end = dt.date.fromisoformat(date_to) if date_to else today
+    start = dt.date.fromisoformat(date_from) if date_from else end - dt.timedelta(days=days - 1)
+    if start > end:
+        raise ValueError("date_from is after date_to")
+    return start.isoformat(), (end + dt.timedelta(days=1)).isoformat()
+
+
+def export_filename(date_from: str, date_to: str, fmt: str, compress: bool) -> str:
+    last_day = (dt.date.fromisoformat(date_to) - dt.timedelta(days=1)).isoformat()
+    name = f"applications_{date_from}_{last_day}.{FORMATS[fmt][1]}"
+    return name + ".gz" if compress else name
+
+
+def _encode_csv(rows: list[tuple]) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+
+def _encode_jsonl(rows: list[tuple]) -> str:
+    return "".join(
+        json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows
+    )
+
+
+async def export_stream(db, date_from: str, date_to: str, fmt: str = "csv",
+                        compress: bool = True, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Отдаёт выгрузку кусками; в памяти держится только текущий чанк строк"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    encode = _encode_csv if fmt == "csv" else _encode_jsonl
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def emit(text: str) -> bytes:
+        data = text.encode("utf-8")
+        return gz.compress(data) if gz else data
+
+    if fmt == "csv":
+        data = emit(_encode_csv([EXPORT_COLUMNS]))
+        if data:
+            yield data
+
+    async for rows in db.iter_export_rows(date_from, date_to, chunk_size=chunk_size):
+        data = emit(encode(rows))
+        if data:
+            yield data
+
+    if gz:
+        yield gz.flush()
+
+
+async def export_to_file(db, path: str, date_from: str, date_to: str, fmt: str = "csv",
+                         compress: bool = True) -> int:
+    """Пишет выгрузку в файл (для отправки документом в Telegram), возвращает размер"""
+    size = 0
+    with open(path, "wb") as f:
+        async for chunk in export_stream(db, date_from, date_to, fmt, compress):
+            f.write(chunk)
+            size += len(chunk)
+    return size
@@ -1,15 +1,23 @@
 from __future__ import annotations
+import os
+import tempfile
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.exceptions import TelegramBadRequest
 
 from bot.states import AdminFlow
+from bot.utils import escape_html
 from bot.keyboards import (
     admin_menu_kb, admin_banks_kb, admin_countries_kb, admin_roles_kb,
     admin_photos_kb, admin_bank_item_kb, admin_country_item_kb,
-    admin_choose_role_kb, admin_settings_kb, confirm_broadcast_kb
+    admin_choose_role_kb, admin_settings_kb, confirm_broadcast_kb, admin_export_kb,
+    admin_analytics_kb
 )
+from bot.notifications import NotificationManager
+from bot.events import bus
+from bot.export import FORMATS, parse_date_range, export_filename, export_to_file
+from bot.callbacks import callbacks, RoleCb, SettingCb, PhotoCb, ExportCb, AnalyticsCb
 
 router = Router()
 
@@ -30,7 +38,42 @@ async def admin_cmd(message: Message, config, db):
         return
     await message.answer("Админ-панель:", reply_markup=admin_menu_kb())
 
-@router.callback_query(F.data == "admin:back")
+@router.message(F.text.startswith("/sqlprofile"))
+async def admin_sqlprofile(message: Message, config, db):
+    if not is_admin(message.from_user.id, config):
+        await message.answer("Нет доступа.")
+        return
+    if db.profiler is None:
+        await message.answer("Профилирование SQL выключено (SQL_PROFILE=1).")
+        return
+    if message.text.split()[1:2] == ["reset"]:
+        db.profiler.reset()
+        await message.answer("✅ Статистика SQL сброшена.")
+        return
+    report = db.profiler.report(10)
+    await message.answer(f"<pre>{escape_html(report[:3500])}</pre>", parse_mode="HTML")
+
+@router.message(F.text.startswith("/outbox"))
+async def admin_outbox(message: Message, config, db):
+    """Dead-события outbox: список, /outbox replay — вернуть все в доставку"""
+    if not is_admin(message.from_user.id, config):
+        await message.answer("Нет доступа.")
+        return
+    if message.text.split()[1:2] == ["replay"]:
+        count = await db.replay_events()
+        bus.wake()
+        await message.answer(f"✅ Возвращено в доставку событий: {count}")
+        return
+    total, events = await db.dead_events()
+    if not total:
+        await message.answer("Недоставленных событий нет.")
+        return
+    lines = [f"Недоставленных событий: {total}"]
+    lines += [f"#{e['id']} {e['topic']} {e['payload']} ({e['dead_at'][:16]})" for e in events]
+    lines.append("\n/outbox replay — повторить доставку")
+    await message.answer(escape_html("\n".join(lines)))
+
+@callbacks("admin:back")
 async def admin_back(call: CallbackQuery):
     await safe_answer(call)
     try:
@@ -39,7 +82,7 @@ async def admin_back(call: CallbackQuery):
         await call.message.answer("Админ-панель:", reply_markup=admin_menu_kb())
 
 # === Banks ===
-@router.callback_query(F.data == "admin:banks")
+@callbacks("admin:banks")
 async def admin_banks(call: CallbackQuery):
     await safe_answer(call)
     try:
@@ -47,7 +90,7 @@ async def admin_banks(call: CallbackQuery):
     except TelegramBadRequest:
         pass
 
-@router.callback_query(F.data == "admin:add_bank")
+@callbacks("admin:add_bank")
 async def admin_add_bank(call: CallbackQuery, state: FSMContext):
     await safe_answer(call)
     await state.set_state(AdminFlow.entering_bank_name)
@@ -69,7 +112,7 @@ async def admin_requisites_entered(message: Message, state: FSMContext, db):
     await message.answer(f"✅ Банк '{bank_name}' добавлен/обновлен!")
     await state.clear()
 
-@router.callback_query(F.data == "admin:list_banks")
+@callbacks("admin:list_banks")
 async def admin_list_banks(call: CallbackQuery, db):
     await safe_answer(call)
     banks = await db.list_banks(active_only=False)
@@ -85,7 +128,7 @@ async def admin_list_banks(call: CallbackQuery, db):
     await call.message.answer(text)
 
 # === Countries ===
-@router.callback_query(F.data == "admin:countries")
+@callbacks("admin:countries")
 async def admin_countries(call: CallbackQuery):
     await safe_answer(call)
     try:
@@ -93,7 +136,7 @@ async def admin_countries(call: CallbackQuery):
     except TelegramBadRequest:
         pass
 
-@router.callback_query(F.data == "admin:add_country")
+@callbacks("admin:add_country")
 async def admin_add_country(call: CallbackQuery, state: FSMContext):
     await safe_answer(call)
     await state.set_state(AdminFlow.entering_country_name)
@@ -105,7 +148,7 @@ async def admin_country_name_entered(message: Message, state: FSMContext, db):
     await message.answer(f"✅ Страна '{message.text}' добавлена!")
     await state.clear()
 
-@router.callback_query(F.data == "admin:list_countries")
+@callbacks("admin:list_countries")
 async def admin_list_countries(call: CallbackQuery, db):
     await safe_answer(call)
     countries = await db.list_countries(active_only=False)
@@ -121,7 +164,7 @@ async def admin_list_countries(call: CallbackQuery, db):
     await call.message.answer(text)
 
 # === Roles ===
-@router.callback_query(F.data == "admin:roles")
+@callbacks("admin:roles")
 async def admin_roles(call: CallbackQuery):
     await safe_answer(call)
     try:
@@ -129,7 +172,7 @@ async def admin_roles(call: CallbackQuery):
     except TelegramBadRequest:
         pass
 
-@router.callback_query(F.data == "admin:set_role")
+@callbacks("admin:set_role")
 async def admin_set_role(call: CallbackQuery, state: FSMContext):
     await safe_answer(call)
     await state.set_state(AdminFlow.entering_user_id)
@@ -156,18 +199,17 @@ async def admin_user_id_entered(message: Message, state: FSMContext, db):
     except ValueError:
         await message.answer("Введите числовой ID.")
 
-@router.callback_query(F.data.startswith("admin:role:"))
-async def admin_role_selected(call: CallbackQuery, db):
+@callbacks(RoleCb)
+async def admin_role_selected(call: CallbackQuery, callback_data: RoleCb, db):
     await safe_answer(call)
-    parts = call.data.split(":")
-    tg_id = int(parts[2])
-    role = parts[3]
+    tg_id = callback_data.tg_id
+    role = callback_data.role
     
     await db.set_user_role(tg_id, role)
     await call.message.answer(f"✅ Роль пользователя {tg_id} изменена на {role}")
 
 # === Settings ===
-@router.callback_query(F.data == "admin:settings")
+@callbacks("admin:settings")
 async def admin_settings(call: CallbackQuery):
     await safe_answer(call)
     try:
@@ -175,10 +217,10 @@ async def admin_settings(call: CallbackQuery):
     except TelegramBadRequest:
         pass
 
-@router.callback_query(F.data.startswith("admin:setting:"))
-async def admin_setting_selected(call: CallbackQuery, state: FSMContext):
+@callbacks(SettingCb)
+async def admin_setting_selected(call: CallbackQuery, callback_data: SettingCb, state: FSMContext):
     await safe_answer(call)
-    setting_key = call.data.split(":")[2]
+    setting_key = callback_data.key
     await state.set_state(AdminFlow.entering_setting_value)
     await state.update_data(setting_key=setting_key)
     
@@ -204,7 +246,7 @@ async def admin_setting_value_entered(message: Message, state: FSMContext, db):
     await state.clear()
 
 # === Broadcast ===
-@router.callback_query(F.data == "admin:broadcast")
+@callbacks("admin:broadcast")
 async def admin_broadcast(call: CallbackQuery, state: FSMContext):
     await safe_answer(call)
     await state.set_state(AdminFlow.entering_broadcast)
@@ -219,28 +261,21 @@ async def admin_broadcast_message(message: Message, state: FSMContext):
         reply_markup=confirm_broadcast_kb()
     )
 
-@router.callback_query(F.data == "admin:broadcast_confirm")
+@callbacks("admin:broadcast_confirm")
 async def admin_broadcast_confirm(call: CallbackQuery, state: FSMContext, db, bot):
     await safe_answer(call)
     data = await state.get_data()
     message_text = data.get("broadcast_message")
     
     users = await db.get_all_users()
-    sent = 0
-    failed = 0
-    
-    for user_id in users:
-        try:
-            await bot.send_message(user_id, message_text)
-            sent += 1
-        except Exception:
-            failed += 1
+    # Полоса bulk: заявки и реквизиты не ждут, пока идёт рассылка
+    results = await NotificationManager(bot, db).broadcast_message(users, message_text, parse_mode=None)
     
-    await call.message.answer(f"✅ Рассылка завершена!\nОтправлено: {sent}\nНе удалось: {failed}")
+    await call.message.answer(f"✅ Рассылка завершена!\nОтправлено: {results['sent']}\nНе удалось: {results['failed']}")
     await state.clear()
 
 # === Photos ===
-@router.callback_query(F.data == "admin:photos")
+@callbacks("admin:photos")
 async def admin_photos(call: CallbackQuery):
     await safe_answer(call)
     try:
@@ -248,10 +283,10 @@ async def admin_photos(call: CallbackQuery):
     except TelegramBadRequest:
         pass
 
-@router.callback_query(F.data.startswith("admin:photo:"))
-async def admin_photo_selected(call: CallbackQuery, state: FSMContext):
+@callbacks(PhotoCb)
+async def admin_photo_selected(call: CallbackQuery, callback_data: PhotoCb, state: FSMContext):
     await safe_answer(call)
-    photo_type = call.data.split(":")[2]
+    photo_type = callback_data.kind
     await state.set_state(AdminFlow.entering_photo)
     await state.update_data(photo_type=photo_type)
     
@@ -277,3 +312,116 @@ async def admin_photo_received(message: Message, state: FSMContext, db):
     await db.set_setting(f"photo_{photo_type}", file_id)
     await message.answer(f"✅ Фото для '{photo_type}' сохранено!")
     await state.clear()
+
+# === Export ===
+async def _send_export(message: Message, db, start: str, end: str, fmt: str):
+    filename = export_filename(start, end, fmt, compress=True)
+    fd, path = tempfile.mkstemp(suffix=".gz")
+    os.close(fd)
+    try:
+        size = await export_to_file(db, path, start, end, fmt, compress=True)
+        await message.answer_document(
+            FSInputFile(path, filename=filename),
+            caption=f"📤 Заявки {filename} ({size / 1024:.1f} КБ)"
+        )
+    finally:
+        os.remove(path)
+
+@callbacks("admin:export")
+async def admin_export(call: CallbackQuery):
+    await safe_answer(call)
+    try:
+        await call.message.edit_text(
+            "Экспорт заявок.\nСвой период: /export 2024-01-01 2024-01-31 csv|jsonl",
+            reply_markup=admin_export_kb()
+        )
+    except TelegramBadRequest:
+        pass
+
+@callbacks(ExportCb)
+async def admin_export_preset(call: CallbackQuery, callback_data: ExportCb, db, config):
+    await safe_answer(call)
+    if not is_admin(call.from_user.id, config):
+        return
+    start, end = parse_date_range(None, None, days=callback_data.days)
+    await _send_export(call.message, db, start, end, callback_data.fmt)
+
+@router.message(F.text.startswith("/export"))
+async def admin_export_cmd(message: Message, db, config):
+    if not is_admin(message.from_user.id, config):
+        await message.answer("Нет доступа.")
+        return
+    args = message.text.split()[1:]
+    fmt = args.pop() if args and args[-1] in FORMATS else "csv"
+    try:
+        start, end = parse_date_range(args[0] if args else None, args[1] if len(args) > 1 else None)
+    except ValueError:
+        await message.answer("Формат: /export [YYYY-MM-DD] [YYYY-MM-DD] [csv|jsonl]")
+        return
+    await _send_export(message, db, start, end, fmt)
+
+# === Analytics ===
+def _rate(value) -> str:
+    return f"{value * 100:.0f}%" if value is not None else "—"
+
+def format_analytics(a: dict, days: int) -> str:
+    lines = [
+        f"📈 Аналитика за {days} дн.\n",
+        f"Заявок: {a['applications']} | подтверждено: {a['confirmed']} ({_rate(a['confirmation_rate'])})",
+        f"Оборот: {a['turnover']:.2f} грн\n",
+        "По дням:",
+    ]
+    for d in a["by_day"][-14:]:
+        lines.append(f"{d['day']}: {d['applications']} шт | {d['turnover']:.2f} грн | {_rate(d['confirmation_rate'])}")
+    lines.append("\nПо банкам:")
+    for b in a["by_bank"][:10]:
+        lines.append(f"{b['bank_name']}: {b['applications']} шт | {b['turnover']:.2f} грн | {_rate(b['confirmation_rate'])}")
+    lines.append("\nПо странам:")
+    for c in a["by_country"][:10]:
+        lines.append(f"{c['country_name']}: {c['applications']} шт | {c['turnover']:.2f} грн | {_rate(c['confirmation_rate'])}")
+    return "\n".join(lines)
+
+@callbacks("admin:analytics")
+@callbacks(AnalyticsCb)
+async def admin_analytics(call: CallbackQuery, db, config, callback_data: AnalyticsCb | None = None):
+    await safe_answer(call)
+    if not is_admin(call.from_user.id, config):
+        return
+    days = callback_data.days if callback_data else 7
+    start, end = parse_date_range(None, None, days=days)
+    text = format_analytics(await db.get_analytics(start, end), days)
+    try:
+        await call.message.edit_text(text[:4000], reply_markup=admin_analytics_kb())
+    except TelegramBadRequest:
+        pass
+
+# === Search ===
+SEARCH_ICONS = {"message": "💬", "user": "👤", "application": "📄"}
+
+@router.message(F.text.startswith("/find"))
+async def admin_find(message: Message, db, config):
+    if not is_admin(message.from_user.id, config):
+        await message.answer("Нет доступа.")
+        return
+    query = message.text.partition(" ")[2].strip()
+    if not query:
+        await message.answer("Формат: /find <текст, @username, код платежа или реквизиты>")
+        return
+    if not db.has_search:
+        await message.answer("Поиск недоступен: SQLite собран без FTS5.")
+        return
+
+    results = await db.search(query, limit=20)
+    if not results:
+        await message.answer("Ничего не найдено.")
+        return
+
+    lines = [f"🔎 {query}\n"]
+    for r in results:
+        icon = SEARCH_ICONS.get(r["kind"], "•")
+        if r["kind"] == "user":
+            username = r["snippet"].replace("[", "").replace("]", "")
+            lines.append(f"{icon} @{username} (id {r['ref_id']})")
+        else:
+            lines.append(f"{icon} #{r['app_id']}: {r['snippet']}")
+    await message.answer("\n".join(lines)[:4000])
@@ -4,6 +4,7 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.exceptions import TelegramBadRequest
 
 from bot.handlers.user import ensure_subscribed
+from bot.callbacks import callbacks
 
 router = Router()
 
@@ -62,7 +63,7 @@ async def my_apps(message: Message, db, config):
     else:
         await message.answer(text)
 
-@router.callback_query(F.data == "my_apps")
+@callbacks("my_apps")
 async def my_apps_callback(call: CallbackQuery, db, config):
     """Callback для кнопки 'Мои заявки'"""
     await safe_answer(call)
@@ -1,10 +1,11 @@
 from __future__ import annotations
-from aiogram import Router, F
+from aiogram import Router
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.exceptions import TelegramBadRequest
 
 from bot.states import ChatFlow
+from bot.callbacks import callbacks, ChatCb
 
 router = Router()
 
@@ -15,19 +16,19 @@ async def safe_answer(call: CallbackQuery):
     except TelegramBadRequest:
         pass
 
-@router.callback_query(F.data.startswith("chat:"))
-async def chat_callback(call: CallbackQuery, state: FSMContext, db):
+@callbacks(ChatCb)
+async def chat_callback(call: CallbackQuery, callback_data: ChatCb, state: FSMContext, db):
     await safe_answer(call)
-    app_id = int(call.data.split(":")[1])
+    app_id = callback_data.app_id
     
-    app = await db.get_application(app_id)
-    if not app:
+    parts = await db.get_chat_participants(app_id)
+    if not parts:
         await call.message.answer("Заявка не найдена.")
         return
     
     # Определяем, кто инициирует чат
-    is_user = call.from_user.id == app["user_tg_id"]
-    is_merchant = call.from_user.id == app.get("assigned_merchant_tg_id")
+    is_user = call.from_user.id == parts["user_tg_id"]
+    is_merchant = call.from_user.id == parts["merchant_tg_id"]
     
     if not (is_user or is_merchant):
         # Админ может писать всем
@@ -37,16 +38,19 @@ async def chat_callback(call: CallbackQuery, state: FSMContext, db):
             return
     
     await state.set_state(ChatFlow.chatting)
-    await state.update_data(
-        chat_app_id=app_id,
-        chat_partner_id=app["user_tg_id"] if not is_user else app.get("assigned_merchant_tg_id")
-    )
+    await state.update_data(chat_app_id=app_id)
     
     await call.message.answer(
         f"💬 Чат по заявке #{app_id}\n\n"
         f"Отправьте сообщение. Для выхода напишите /exit"
     )
 
+def resolve_partner(parts: dict, sender_id: int) -> int | None:
+    """Собеседник: для пользователя — мерчант, для мерчанта/админа — пользователь"""
+    if sender_id == parts["user_tg_id"]:
+        return parts["merchant_tg_id"]
+    return parts["user_tg_id"]
+
 @router.message(ChatFlow.chatting)
 async def chat_message(message: Message, state: FSMContext, db, bot):
     if message.text == "/exit":
@@ -56,19 +60,26 @@ async def chat_message(message: Message, state: FSMContext, db, bot):
     
     data = await state.get_data()
     app_id = data.get("chat_app_id")
-    partner_id = data.get("chat_partner_id")
+    parts = await db.get_chat_participants(app_id) if app_id else None
     
-    if not app_id or not partner_id:
+    if not parts:
         await message.answer("Ошибка чата. Начните заново.")
         await state.clear()
         return
     
-    # Сохраняем сообщение
-    await db.add_message(app_id, message.from_user.id, partner_id, message.text)
+    partner_id = resolve_partner(parts, message.from_user.id)
+    if not partner_id:
+        await message.answer("Мерчант ещё не назначен — сообщение некому доставить.")
+        return
+    
+    # Сохраняем сообщение (write-behind, пишется пачкой)
+    await db.add_message(app_id, message.from_user.id, partner_id, message.text or "")
     
     # Отправляем партнеру
     try:
-        sender = await db.get_username(message.from_user.id)
+        sender = message.from_user.username or (
+            parts["user_username"] if message.from_user.id == parts["user_tg_id"] else parts["merchant_username"]
+        )
         await bot.send_message(
             partner_id,
             f"💬 Сообщение по заявке #{app_id} от @{sender}:\n\n{message.text}"
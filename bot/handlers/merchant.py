@@ -1,6 +1,6 @@
 from __future__ import annotations
 import datetime as dt
-from aiogram import Router, F
+from aiogram import Router
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.exceptions import TelegramBadRequest
@@ -8,6 +8,8 @@ from aiogram.exceptions import TelegramBadRequest
 from bot.states import MerchantFlow
 from bot.keyboards import merchant_send_mode_kb, i_paid_kb, merchant_take_kb, merchant_taken_kb
 from bot.notifications import NotificationManager
+from bot.sender import CRITICAL, get_sender
+from bot.callbacks import callbacks, TakeCb, ReleaseCb, SendSavedCb, SendNewCb
 
 router = Router()
 
@@ -21,9 +23,9 @@ async def safe_answer(call: CallbackQuery):
     except TelegramBadRequest:
         pass
 
-@router.callback_query(F.data.startswith("take:"))
-async def take_app(call: CallbackQuery, state: FSMContext, db, config):
-    app_id = int(call.data.split(":")[1])
+@callbacks(TakeCb)
+async def take_app(call: CallbackQuery, callback_data: TakeCb, state: FSMContext, db, config):
+    app_id = callback_data.app_id
     role = await db.get_user_role(call.from_user.id)
     if not can_merchant(role, call.from_user.id, config):
         try:
@@ -32,7 +34,7 @@ async def take_app(call: CallbackQuery, state: FSMContext, db, config):
             pass
         return
 
-    app = await db.get_application(app_id)
+    app = await db.get_application_view(app_id)
     if not app:
         try:
             await call.answer("Заявка не найдена", show_alert=True)
@@ -82,10 +84,10 @@ async def take_app(call: CallbackQuery, state: FSMContext, db, config):
         except Exception:
             pass
 
-@router.callback_query(F.data.startswith("release:"))
-async def release_app(call: CallbackQuery, db, config):
+@callbacks(ReleaseCb)
+async def release_app(call: CallbackQuery, callback_data: ReleaseCb, db, config):
     await safe_answer(call)
-    app_id = int(call.data.split(":")[1])
+    app_id = callback_data.app_id
     role = await db.get_user_role(call.from_user.id)
     if not can_merchant(role, call.from_user.id, config):
         try:
@@ -94,7 +96,7 @@ async def release_app(call: CallbackQuery, db, config):
             pass
         return
 
-    app = await db.get_application(app_id)
+    app = await db.get_application_view(app_id)
     if not app:
         await call.message.answer("Заявка не найдена.")
         return
@@ -122,9 +124,8 @@ async def release_app(call: CallbackQuery, db, config):
             pass
         return
 
-    bank = await db.get_bank(app["bank_id"]) if app.get("bank_id") else None
-    bank_name = bank["bank_name"] if bank else str(app.get("bank_id") or "-")
-    from_username = await db.get_username(app["user_tg_id"])
+    bank_name = app["bank_name"] or str(app.get("bank_id") or "-")
+    from_username = app["user_username"]
     from_label = f"@{from_username}" if from_username else str(app["user_tg_id"])
 
     text = (
@@ -140,21 +141,21 @@ async def release_app(call: CallbackQuery, db, config):
         await call.message.edit_text(text)
         await call.message.edit_reply_markup(reply_markup=merchant_take_kb(app_id))
     except TelegramBadRequest:
-        await call.bot.send_message(config.merchant_chat_id, text, reply_markup=merchant_take_kb(app_id))
+        await get_sender(call.bot).send_message(config.merchant_chat_id, text, lane=CRITICAL,
+                                                reply_markup=merchant_take_kb(app_id))
 
     await db.log(call.from_user.id, "APP_RELEASED", f"app_id={app_id}")
 
-@router.callback_query(F.data.startswith("send_saved:"))
-async def send_saved(call: CallbackQuery, state: FSMContext, db, bot):
+@callbacks(SendSavedCb)
+async def send_saved(call: CallbackQuery, callback_data: SendSavedCb, state: FSMContext, db, bot):
     await safe_answer(call)
-    app_id = int(call.data.split(":")[1])
-    app = await db.get_application(app_id)
+    app_id = callback_data.app_id
+    app = await db.get_application_view(app_id)
     if not app:
         await call.message.answer("Заявка не найдена.")
         await state.clear()
         return
-    bank = await db.get_bank(app["bank_id"])
-    if not bank:
+    if app["bank_name"] is None:
         await call.message.answer("Банк не найден.")
         await state.clear()
         return
@@ -163,7 +164,7 @@ async def send_saved(call: CallbackQuery, state: FSMContext, db, bot):
         await state.clear()
         return
 
-    ok = await db.set_requisites_and_start_timer(app_id, bank["requisites_text"], ttl_minutes=20)
+    ok = await db.set_requisites_and_start_timer(app_id, app["requisites_text"], ttl_minutes=20)
     if not ok:
         await call.message.answer("Не удалось обновить заявку (возможно, статус изменился).")
         await state.clear()
@@ -175,31 +176,31 @@ async def send_saved(call: CallbackQuery, state: FSMContext, db, bot):
     await notif.notify_requisites_sent(
         app_id, 
         app["user_tg_id"], 
-        bank['bank_name'], 
+        app['bank_name'], 
         app['amount_uah'], 
-        bank["requisites_text"], 
+        app["requisites_text"], 
         expires_at
     )
 
     text = (
         f"✅ Реквизиты для оплаты\n\n"
-        f"🏦 Банк: {bank['bank_name']}\n"
+        f"🏦 Банк: {app['bank_name']}\n"
         f"💰 Сумма: {app['amount_uah']:.2f} грн\n"
         f"🔐 Код платежа: {app['payment_code']}\n\n"
-        f"Реквизиты:\n{bank['requisites_text']}\n\n"
+        f"Реквизиты:\n{app['requisites_text']}\n\n"
         f"После оплаты нажмите «Я оплатил» (у вас есть 20 минут)."
     )
     try:
-        await bot.send_message(app["user_tg_id"], text, reply_markup=i_paid_kb(app_id))
+        await get_sender(bot).send_message(app["user_tg_id"], text, lane=CRITICAL, reply_markup=i_paid_kb(app_id))
         await call.message.answer("Готово! Сохранённые реквизиты отправлены пользователю.")
     except Exception:
         await call.message.answer("Не смог отправить пользователю (возможно, он заблокировал бота).")
     await state.clear()
 
-@router.callback_query(F.data.startswith("send_new:"))
-async def send_new(call: CallbackQuery, state: FSMContext):
+@callbacks(SendNewCb)
+async def send_new(call: CallbackQuery, callback_data: SendNewCb, state: FSMContext):
     await safe_answer(call)
-    app_id = int(call.data.split(":")[1])
+    app_id = callback_data.app_id
     await state.clear()
     await state.set_state(MerchantFlow.entering_requisites)
     await state.update_data(app_id=app_id)
@@ -212,7 +213,7 @@ async def send_new(call: CallbackQuery, state: FSMContext):
 async def merchant_new_requisites(message: Message, state: FSMContext, db, bot):
     data = await state.get_data()
     app_id = int(data.get("app_id", 0))
-    app = await db.get_application(app_id)
+    app = await db.get_application_view(app_id)
     if not app:
         await message.answer("Заявка не найдена/устарела.")
         await state.clear()
@@ -237,9 +238,8 @@ async def merchant_new_requisites(message: Message, state: FSMContext, db, bot):
         await state.clear()
         return
 
-    bank = await db.get_bank(app["bank_id"])
-    if bank:
-        await db.upsert_bank(bank["bank_name"], requisites)
+    if app["bank_name"]:
+        await db.upsert_bank(app["bank_name"], requisites)
 
     # Отправляем push-уведомление пользователю
     notif = NotificationManager(bot, db)
@@ -247,7 +247,7 @@ async def merchant_new_requisites(message: Message, state: FSMContext, db, bot):
     await notif.notify_requisites_sent(
         app_id, 
         app["user_tg_id"], 
-        bank['bank_name'] if bank else 'Unknown', 
+        app['bank_name'] or 'Unknown', 
         app['amount_uah'], 
         requisites, 
         expires_at
@@ -255,14 +255,14 @@ async def merchant_new_requisites(message: Message, state: FSMContext, db, bot):
 
     text = (
         f"✅ Реквизиты для оплаты\n\n"
-        f"🏦 Банк: {bank['bank_name'] if bank else app['bank_id']}\n"
+        f"🏦 Банк: {app['bank_name'] or app['bank_id']}\n"
         f"💰 Сумма: {app['amount_uah']:.2f} грн\n"
         f"🔐 Код платежа: {app['payment_code']}\n\n"
         f"Реквизиты:\n{requisites}\n\n"
         f"После оплаты нажмите «Я оплатил» (у вас есть 20 минут)."
     )
     try:
-        await bot.send_message(app["user_tg_id"], text, reply_markup=i_paid_kb(app_id))
+        await get_sender(bot).send_message(app["user_tg_id"], text, lane=CRITICAL, reply_markup=i_paid_kb(app_id))
         await message.answer("Готово! Реквизиты отправлены пользователю и сохранены для банка.")
     except Exception:
         await message.answer("Не смог отправить пользователю (возможно, он заблокировал бота).")
@@ -7,6 +7,8 @@ from aiogram.exceptions import TelegramBadRequest
 from bot.keyboards import receipt_kb, check_kb
 from bot.notifications import NotificationManager
 from bot.states import AdminFlow
+from bot.sender import get_sender
+from bot.callbacks import callbacks, CancelCb, PaidCb, SkipReceiptCb, ReceiptCb, ApproveCb, RejectCb
 
 router = Router()
 
@@ -17,11 +19,11 @@ async def safe_answer(call: CallbackQuery):
     except TelegramBadRequest:
         pass
 
-@router.callback_query(F.data.startswith("cancel:"))
-async def cancel_app(call: CallbackQuery, db):
+@callbacks(CancelCb)
+async def cancel_app(call: CallbackQuery, callback_data: CancelCb, db):
     await safe_answer(call)
-    app_id = int(call.data.split(":")[1])
-    app = await db.get_application(app_id)
+    app_id = callback_data.app_id
+    app = await db.get_application_view(app_id)
     if not app or app["user_tg_id"] != call.from_user.id:
         return
     if app["status"] in ("CONFIRMED", "REJECTED", "EXPIRED"):
@@ -35,11 +37,11 @@ async def cancel_app(call: CallbackQuery, db):
         pass
     await call.message.answer(f"Заявка #{app_id} отменена.")
 
-@router.callback_query(F.data.startswith("paid:"))
-async def paid(call: CallbackQuery, db):
+@callbacks(PaidCb)
+async def paid(call: CallbackQuery, callback_data: PaidCb, db):
     await safe_answer(call)
-    app_id = int(call.data.split(":")[1])
-    app = await db.get_application(app_id)
+    app_id = callback_data.app_id
+    app = await db.get_application_view(app_id)
     if not app or app["user_tg_id"] != call.from_user.id:
         return
 
@@ -58,16 +60,16 @@ async def paid(call: CallbackQuery, db):
         pass
     await call.message.answer("Хотите прикрепить чек/скрин оплаты?", reply_markup=receipt_kb(app_id))
 
-@router.callback_query(F.data.startswith("skip_receipt:"))
-async def skip_receipt(call: CallbackQuery, db, bot, config, logger):
+@callbacks(SkipReceiptCb)
+async def skip_receipt(call: CallbackQuery, callback_data: SkipReceiptCb, db, bot, config, logger):
     await safe_answer(call)
-    app_id = int(call.data.split(":")[1])
+    app_id = callback_data.app_id
     await _send_to_check(call, db, bot, config, logger, app_id)
 
-@router.callback_query(F.data.startswith("receipt:"))
-async def receipt_hint(call: CallbackQuery):
+@callbacks(ReceiptCb)
+async def receipt_hint(call: CallbackQuery, callback_data: ReceiptCb):
     await safe_answer(call)
-    app_id = int(call.data.split(":")[1])
+    app_id = callback_data.app_id
     await call.message.answer(f"Пришлите фото/документ чека одним сообщением.\nЕсли отправляете не сразу после оплаты — добавьте в подпись: #{app_id}")
 
 @router.message(F.photo | F.document)
@@ -77,25 +79,15 @@ async def receipt_upload(message: Message, db, bot, config, logger):
     m = re.search(r"#(\d+)", caption)
     app_id = int(m.group(1)) if m else None
 
-    # Если ID не указан в подписи - ищем последнюю активную заявку пользователя
+    # Если ID не указан в подписи - берём последнюю активную заявку пользователя:
+    # сначала ожидающую чек, затем ожидающую оплату
     if not app_id:
-        rows = await db.list_user_apps(message.from_user.id, limit=20)
-        logger.info(f"Looking for app for user {message.from_user.id}, found {len(rows)} apps")
-        
-        # Сначала ищем заявку ожидающую чек
-        for app_id_cand, _bank, _amount, _code, status, _created in rows:
-            if status == "WAITING_RECEIPT":
-                app_id = int(app_id_cand)
-                logger.info(f"Found app {app_id} with status WAITING_RECEIPT")
+        active = await db.get_active_apps_for_user(message.from_user.id)
+        for status in ("WAITING_RECEIPT", "WAITING_PAYMENT"):
+            app_id = next((a["id"] for a in active if a["status"] == status), None)
+            if app_id:
+                logger.info(f"Found app {app_id} with status {status}")
                 break
-        
-        # Если не нашли - ищем заявку ожидающую оплату
-        if not app_id:
-            for app_id_cand, _bank, _amount, _code, status, _created in rows:
-                if status == "WAITING_PAYMENT":
-                    app_id = int(app_id_cand)
-                    logger.info(f"Found app {app_id} with status WAITING_PAYMENT")
-                    break
 
     if not app_id:
         await message.answer(
@@ -105,7 +97,7 @@ async def receipt_upload(message: Message, db, bot, config, logger):
         )
         return
 
-    app = await db.get_application(app_id)
+    app = await db.get_application_view(app_id)
     if not app or app["user_tg_id"] != message.from_user.id:
         await message.answer("❌ Заявка не найдена.")
         return
@@ -120,20 +112,28 @@ async def receipt_upload(message: Message, db, bot, config, logger):
 
     # Получаем file_id
     if message.photo:
-        file_id = message.photo[-1].file_id
+        media = message.photo[-1]
         ftype = "photo"
     elif message.document:
-        file_id = message.document.file_id
+        media = message.document
         ftype = "document"
     else:
         await message.answer("❌ Не удалось получить файл. Попробуйте ещё раз.")
         return
+    file_id = media.file_id
 
     logger.info(f"Saving receipt for app {app_id}: file_id={file_id}, type={ftype}")
     
-    # Сохраняем чек
-    await db.set_receipt(app_id, file_id, ftype)
+    # Сохраняем чек; file_unique_id одинаков у одного и того же файла — ловим повторы
+    duplicates = await db.add_receipt(
+        app_id, message.from_user.id, file_id, media.file_unique_id, ftype,
+        chat_id=message.chat.id, message_id=message.message_id,
+    )
     await db.log(message.from_user.id, "RECEIPT_UPLOADED", f"app_id={app_id};type={ftype}")
+    if duplicates:
+        logger.warning("Receipt for app %s was already used in apps %s", app_id, duplicates)
+        await db.log(message.from_user.id, "RECEIPT_DUPLICATE",
+                     f"app_id={app_id};apps={','.join(map(str, duplicates))}")
     
     # Если статус WAITING_PAYMENT - меняем на WAITING_RECEIPT
     if app["status"] == "WAITING_PAYMENT":
@@ -144,51 +144,69 @@ async def receipt_upload(message: Message, db, bot, config, logger):
     await _send_to_check(message, db, bot, config, logger, app_id)
 
 async def _send_to_check(ctx, db, bot, config, logger, app_id: int):
-    app = await db.get_application(app_id)
+    app = await db.get_application_view(app_id)
     if not app:
         return
     await db.set_app_status(app_id, "WAITING_CHECK")
 
-    bank = await db.get_bank(app["bank_id"])
     uname = getattr(ctx.from_user, "username", "")
     uid = getattr(ctx.from_user, "id", "")
     notify_text = (
         f"🧾 Заявка на проверку\n"
         f"ID: #{app_id}\n"
         f"Пользователь: @{uname} (id {uid})\n"
-        f"Банк: {bank['bank_name'] if bank else app['bank_id']}\n"
+        f"Банк: {app['bank_name'] or app['bank_id']}\n"
         f"Сумма: {app['amount_uah']:.2f} грн\n"
         f"Код: {app['payment_code']}\n"
         f"Статус: 🟡 На проверке (WAITING_CHECK)"
     )
 
+    receipt = await db.get_receipt(app_id)
+    if receipt and receipt["duplicate_app_ids"]:
+        notify_text += "\n\n⚠️ Этот чек уже прикладывали к заявкам: " + ", ".join(
+            f"#{d}" for d in receipt["duplicate_app_ids"]
+        )
+
     targets = set(config.admin_ids)
     if app.get("assigned_merchant_tg_id"):
         targets.add(int(app["assigned_merchant_tg_id"]))
 
-    for tid in targets:
-        try:
-            await bot.send_message(tid, notify_text, reply_markup=check_kb(app_id))
-            if app.get("receipt_file_id"):
-                if app.get("receipt_file_type") == "photo":
-                    await bot.send_photo(tid, app["receipt_file_id"], caption=f"Чек по заявке #{app_id}")
-                else:
-                    await bot.send_document(tid, app["receipt_file_id"], caption=f"Чек по заявке #{app_id}")
-        except Exception as e:
-            logger.warning("Failed to notify %s: %s", tid, e)
+    # Текст заявки уходит подписью к чеку: один вызов API на получателя
+    sender = get_sender(bot)
+    kb = check_kb(app_id)
+    file_id = receipt["file_id"] if receipt else app.get("receipt_file_id")
+    file_type = receipt["file_type"] if receipt else app.get("receipt_file_type")
+
+    async def send(tid: int):
+        if receipt and receipt["chat_id"]:
+            try:
+                return await sender.copy_message(
+                    tid, receipt["chat_id"], receipt["message_id"], caption=notify_text, reply_markup=kb
+                )
+            except TelegramBadRequest:
+                pass  # исходное сообщение удалено — отправляем по file_id
+        if file_id:
+            send_media = sender.send_photo if file_type == "photo" else sender.send_document
+            return await send_media(tid, file_id, caption=notify_text, reply_markup=kb)
+        return await sender.send_message(tid, notify_text, reply_markup=kb)
+
+    results = await sender.fanout(targets, send)
+    for tid, result in results.items():
+        if isinstance(result, Exception):
+            logger.warning("Failed to notify %s: %s", tid, result)
 
     try:
-        await bot.send_message(app["user_tg_id"], "Спасибо! Оплата отправлена на проверку. Ожидайте подтверждения.")
+        await sender.send_message(app["user_tg_id"], "Спасибо! Оплата отправлена на проверку. Ожидайте подтверждения.")
     except Exception:
         pass
 
-@router.callback_query(F.data.startswith("approve:"))
-async def approve_payment(call: CallbackQuery, db, bot, config):
+@callbacks(ApproveCb)
+async def approve_payment(call: CallbackQuery, callback_data: ApproveCb, db, bot, config):
     """Подтвердить платеж (админ/мерчант)"""
     await safe_answer(call)
     
-    app_id = int(call.data.split(":")[1])
-    app = await db.get_application(app_id)
+    app_id = callback_data.app_id
+    app = await db.get_application_view(app_id)
     
     if not app:
         await call.message.answer("Заявка не найдена.")
@@ -211,12 +229,11 @@ async def approve_payment(call: CallbackQuery, db, bot, config):
     await db.log(call.from_user.id, "PAYMENT_APPROVED", f"app_id={app_id}")
     
     # Отправляем уведомление пользователю
-    bank = await db.get_bank(app["bank_id"])
     notif = NotificationManager(bot, db)
     await notif.notify_payment_confirmed(
         app_id,
         app["user_tg_id"],
-        bank["bank_name"] if bank else "Unknown",
+        app["bank_name"] or "Unknown",
         app["amount_uah"]
     )
     
@@ -231,13 +248,13 @@ async def approve_payment(call: CallbackQuery, db, bot, config):
     
     await call.message.answer(f"✅ Заявка #{app_id} подтверждена!")
 
-@router.callback_query(F.data.startswith("reject:"))
-async def reject_payment(call: CallbackQuery, state: FSMContext, db, bot, config):
+@callbacks(RejectCb)
+async def reject_payment(call: CallbackQuery, callback_data: RejectCb, state: FSMContext, db, bot, config):
     """Отклонить платеж (админ/мерчант)"""
     await safe_answer(call)
     
-    app_id = int(call.data.split(":")[1])
-    app = await db.get_application(app_id)
+    app_id = callback_data.app_id
+    app = await db.get_application_view(app_id)
     
     if not app:
         await call.message.answer("Заявка не найдена.")
@@ -273,7 +290,7 @@ async def process_reject_reason(message: Message, state: FSMContext, db, bot, co
         await state.clear()
         return
     
-    app = await db.get_application(app_id)
+    app = await db.get_application_view(app_id)
     if not app:
         await message.answer("Заявка не найдена.")
         await state.clear()
@@ -284,12 +301,11 @@ async def process_reject_reason(message: Message, state: FSMContext, db, bot, co
     await db.log(message.from_user.id, "PAYMENT_REJECTED", f"app_id={app_id};reason={reason}")
     
     # Отправляем уведомление пользователю
-    bank = await db.get_bank(app["bank_id"])
     notif = NotificationManager(bot, db)
     await notif.notify_payment_rejected(
         app_id,
         app["user_tg_id"],
-        bank["bank_name"] if bank else "Unknown",
+        app["bank_name"] or "Unknown",
         app["amount_uah"],
         reason
     )
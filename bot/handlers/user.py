@@ -1,14 +1,16 @@
 from __future__ import annotations
-import datetime as dt
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from aiogram.filters import CommandObject, CommandStart
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, ChatMemberUpdated
 from aiogram.fsm.context import FSMContext
 from aiogram.exceptions import TelegramBadRequest
 
 from bot.keyboards import main_menu, banks_kb, countries_kb, subscribe_kb, i_paid_kb, webapp_button
 from bot.states import UserFlow
-from bot.utils import gen_payment_code
-from bot.notifications import NotificationManager
+from bot.utils import gen_payment_code, parse_referral_code
+from bot.notifications import NotificationManager, in_background
+from bot.subscriptions import subscriptions, SUBSCRIBED_STATUSES
+from bot.callbacks import callbacks, CountryCb, BankCb
 
 router = Router()
 
@@ -32,11 +34,20 @@ async def is_subscribed(bot, user_id: int, config, db) -> bool:
     channel_id = await db.get_setting("channel_id") or getattr(config, "channel_id", None)
     if not channel_id:
         return True
-    try:
-        member = await bot.get_chat_member(channel_id, user_id)
-        return member.status in ("member", "administrator", "creator")
-    except Exception:
-        return False
+    return await subscriptions.check(bot, channel_id, user_id)
+
+
+@router.chat_member()
+async def channel_member_updated(event: ChatMemberUpdated, config, db):
+    """Обновляет кэш подписки (приходит, если бот — админ канала)"""
+    channel_id = await db.get_setting("channel_id") or getattr(config, "channel_id", None)
+    if not channel_id or str(channel_id) not in (str(event.chat.id), f"@{event.chat.username}"):
+        return
+    subscriptions.set(
+        channel_id,
+        event.new_chat_member.user.id,
+        event.new_chat_member.status in SUBSCRIBED_STATUSES
+    )
 
 
 async def ensure_subscribed(message: Message, bot, config, db) -> bool:
@@ -98,31 +109,23 @@ async def work_with_us(message: Message, config, db):
     await message.answer(text, reply_markup=kb)
 
 
-@router.message(F.text == "/start")
-async def start(message: Message, state: FSMContext, db, config):
+@router.message(CommandStart())
+async def start(message: Message, command: CommandObject, state: FSMContext, db, config, logger):
     await state.clear()
 
-    # Проверяем реферальный код
-    args = message.text.split()[1] if len(message.text.split()) > 1 else None
-    if args and args.startswith("REF"):
-        referrer_code = args
-        referrer = await db.get_user_by_referral_code(referrer_code)
-        if referrer and referrer["tg_id"] != message.from_user.id:
-            await db.add_referral(referrer["tg_id"], message.from_user.id)
-            # Отправляем уведомление рефереру
-            from bot.notifications import NotificationManager
-            notif = NotificationManager(message.bot, db)
-            await notif.notify_new_referral(
-                referrer["tg_id"],
-                message.from_user.username or f"user_{message.from_user.id}"
-            )
+    # Реферальный код — REF{tg_id}, пригласившего берём прямо из него
+    referrer_tg_id = parse_referral_code(command.args.split()[0] if command.args else None)
 
     if not await ensure_username(message):
         return
 
-    first_time = not await db.user_exists(message.from_user.id)
-    await db.upsert_user(message.from_user.id, message.from_user.username)
-    await db.log(message.from_user.id, "START", message.from_user.username)
+    reg = await db.register_user(message.from_user.id, message.from_user.username, referrer_tg_id)
+    first_time = reg["created"]
+    if reg["referred_by"]:
+        # Реферальное уведомление не срочное (non_critical может ждать Bot API
+        # минутами) — /start его не ждёт
+        notif = NotificationManager(message.bot, db)
+        in_background(notif.notify_new_referral(reg["referred_by"], message.from_user.username), logger)
 
     if first_time:
         welcome_photo = await db.get_setting("photo_welcome")
@@ -140,9 +143,10 @@ async def start(message: Message, state: FSMContext, db, config):
     await message.answer("Выберите действие:", reply_markup=await main_menu(db))
 
 
-@router.callback_query(F.data == "check_sub")
+@callbacks("check_sub")
 async def check_sub(call: CallbackQuery, bot, config, db):
     await safe_answer(call)
+    subscriptions.invalidate(call.from_user.id)
     ok = await is_subscribed(bot, call.from_user.id, config, db)
     if not ok:
         channel_url = await db.get_setting("channel_url") or getattr(config, "channel_url", "https://t.me/your_channel")
@@ -180,10 +184,10 @@ async def get_requisites(message: Message, state: FSMContext, db, config):
     await state.update_data(main_message_id=msg.message_id, chat_id=msg.chat.id)
 
 
-@router.callback_query(UserFlow.choosing_country, F.data.startswith("country:"))
-async def country_chosen(call: CallbackQuery, state: FSMContext, db):
+@callbacks(CountryCb, state=UserFlow.choosing_country)
+async def country_chosen(call: CallbackQuery, callback_data: CountryCb, state: FSMContext, db):
     await safe_answer(call)
-    country_id = int(call.data.split(":")[1])
+    country_id = callback_data.country_id
     country = await db.get_country(country_id)
 
     if not country or not country["is_active"]:
@@ -217,10 +221,10 @@ async def country_chosen(call: CallbackQuery, state: FSMContext, db):
         )
 
 
-@router.callback_query(UserFlow.choosing_bank, F.data.startswith("bank:"))
-async def bank_chosen(call: CallbackQuery, state: FSMContext, db):
+@callbacks(BankCb, state=UserFlow.choosing_bank)
+async def bank_chosen(call: CallbackQuery, callback_data: BankCb, state: FSMContext, db):
     await safe_answer(call)
-    bank_id = int(call.data.split(":")[1])
+    bank_id = callback_data.bank_id
     bank = await db.get_bank(bank_id)
 
     if not bank or not bank["is_active"]:
@@ -282,17 +286,18 @@ async def amount_entered(message: Message, state: FSMContext, db, bot, config, l
 
     if has_requisites:
         # АВТОВЫДАЧА
-        app_id = await db.create_application(message.from_user.id, bank_id, amount, payment_code)
-        await db.set_requisites_and_start_timer(app_id, requisites, ttl_minutes=20)
-        await db.set_app_status(app_id, "WAITING_PAYMENT")
+        # Заявка, реквизиты, уведомление и audit — одной транзакцией
+        app = await db.create_and_issue_application(
+            message.from_user.id, bank_id, amount, payment_code, requisites, ttl_minutes=20
+        )
+        app_id = app["id"]
 
-        # Отправляем push-уведомление
+        # Отправляем push-уведомление (запись в notifications уже сделана)
         from bot.notifications import NotificationManager
         notif = NotificationManager(bot, db)
-        expires_at = (dt.datetime.utcnow() + dt.timedelta(minutes=20)).isoformat() + "Z"
         await notif.notify_requisites_sent(
             app_id, message.from_user.id, bank['bank_name'],
-            amount, requisites, expires_at
+            amount, requisites, app["expires_at"], store=False
         )
 
         # Проверяем есть ли фото для реквизитов
@@ -351,6 +356,7 @@ async def amount_entered(message: Message, state: FSMContext, db, bot, config, l
 
         if merchant_chat_id:
             from bot.keyboards import merchant_take_kb
+            from bot.sender import CRITICAL, get_sender
             merch_text = (
                 f"🆕 Новая заявка\n"
                 f"ID: #{app_id}\n"
@@ -361,9 +367,10 @@ async def amount_entered(message: Message, state: FSMContext, db, bot, config, l
                 f"Нажмите «Взять заявку», затем выдайте реквизиты."
             )
             try:
-                await bot.send_message(
+                await get_sender(bot).send_message(
                     merchant_chat_id,
                     merch_text,
+                    lane=CRITICAL,
                     reply_markup=merchant_take_kb(app_id)
                 )
                 logger.info(f"Sent app #{app_id} to merchant chat {merchant_chat_id}")
@@ -420,54 +427,9 @@ async def webapp_data_handler(message: Message, db, config, bot, logger):
         action = data.get('action')
 
         if action == 'new_app_merchant':
-            # WebApp создал заявку без автовыдачи, нужно отправить в чат мерчантов
-            app_id = data.get('app_id')
-            bank_name = data.get('bank_name', 'Unknown')
-            amount = data.get('amount', 0)
-            country_name = data.get('country_name', 'Unknown')
-
-            # Получаем детали заявки из БД
-            app = await db.get_application(app_id)
-            if not app:
-                await message.answer("❌ Ошибка: заявка не найдена")
-                return
-
-            # Отправляем в чат мерчантов
-            merchant_chat_id = await db.get_setting("merchant_chat_id")
-            if not merchant_chat_id and config.merchant_chat_id:
-                merchant_chat_id = config.merchant_chat_id
-
-            if merchant_chat_id:
-                try:
-                    if isinstance(merchant_chat_id, str) and merchant_chat_id.lstrip("-").isdigit():
-                        merchant_chat_id = int(merchant_chat_id)
-
-                    from bot.keyboards import merchant_take_kb
-
-                    merch_text = (
-                        f"🆕 Новая заявка (через WebApp)\n"
-                        f"ID: #{app_id}\n"
-                        f"Банк: 🏦 {bank_name}\n"
-                        f"Сумма: {float(amount):.2f} грн\n"
-                        f"Код: {app['payment_code']}\n"
-                        f"От: @{message.from_user.username} (id {message.from_user.id})\n\n"
-                        f"Нажмите «Взять заявку», затем выдайте реквизиты."
-                    )
-
-                    await bot.send_message(
-                        merchant_chat_id,
-                        merch_text,
-                        reply_markup=merchant_take_kb(app_id)
-                    )
-                    logger.info(f"WebApp app #{app_id} sent to merchant chat {merchant_chat_id}")
-                    await message.answer(f"✅ Заявка #{app_id} отправлена оператору!")
-
-                except Exception as e:
-                    logger.error(f"Failed to send WebApp app to merchants: {e}")
-                    await message.answer(f"⚠️ Заявка #{app_id} создана, но не удалось отправить операторам.")
-            else:
-                logger.warning("merchant_chat_id not configured")
-                await message.answer(f"⚠️ Чат операторов не настроен. Обратитесь в поддержку.")
+            # Старые версии WebApp: заявку в чат мерчантов уже передал API
+            # (событие app.created), повторно не отправляем
+            await message.answer(f"✅ Заявка #{data.get('app_id')} отправлена оператору!")
 
         elif action == 'app_created':
             await message.answer(
@@ -1,18 +1,46 @@
 from __future__ import annotations
+import functools
+from typing import Callable
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from bot.callbacks import (
+    TakeCb, ReleaseCb, SendSavedCb, SendNewCb, PaidCb, CancelCb, ReceiptCb, SkipReceiptCb,
+    ApproveCb, RejectCb, ChatCb, CountryCb, BankCb, RoleCb, SettingCb, PhotoCb, ExportCb,
+    AnalyticsCb
+)
 
-async def main_menu(db=None) -> ReplyKeyboardMarkup:
-    """Главное меню с опциональной кнопкой WebApp"""
+# Объекты aiogram неизменяемые (frozen), поэтому готовые клавиатуры можно
+# переиспользовать между апдейтами:
+#  - статические строятся один раз (functools.cache);
+#  - клавиатуры по заявке собираются из прототипа, меняется только callback_data;
+#  - каталожные (страны/банки) кэшируются по содержимому каталога.
+
+
+def per_app(build: Callable[[], InlineKeyboardMarkup]) -> Callable[[int], InlineKeyboardMarkup]:
+    """Строит прототип с плейсхолдером {app_id} (AppCb.template) и дальше только подставляет id"""
+    proto = build()
+    rows = [[(btn, btn.callback_data) for btn in row] for row in proto.inline_keyboard]
+
+    @functools.wraps(build)
+    def make(app_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup.model_construct(inline_keyboard=[
+            [btn.model_copy(update={"callback_data": data.format(app_id=app_id)}) if data else btn
+             for btn, data in row]
+            for row in rows
+        ])
+
+    return make
 
+
+@functools.lru_cache(maxsize=4)
+def _main_menu(webapp_url: str) -> ReplyKeyboardMarkup:
     keyboard = []
 
     # Добавляем кнопку WebApp первой (в верхнем ряду), только если есть валидный URL
-    if db:
-        webapp_url = await db.get_setting("webapp_url", "")
-        if webapp_url and webapp_url.startswith("https://"):
-            keyboard.append([KeyboardButton(text="🚀 Открыть WebApp Lab", web_app=WebAppInfo(url=webapp_url))])
+    if webapp_url and webapp_url.startswith("https://"):
+        keyboard.append([KeyboardButton(text="🚀 Открыть WebApp Lab", web_app=WebAppInfo(url=webapp_url))])
 
     # Основные кнопки
     keyboard.extend([
@@ -27,6 +55,13 @@ async def main_menu(db=None) -> ReplyKeyboardMarkup:
     )
 
 
+async def main_menu(db=None) -> ReplyKeyboardMarkup:
+    """Главное меню с опциональной кнопкой WebApp"""
+    webapp_url = await db.get_setting("webapp_url", "") if db else ""
+    return _main_menu(webapp_url)
+
+
+@functools.lru_cache(maxsize=4)
 def webapp_button(url: str) -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="🌐 Открыть Mini App", web_app=WebAppInfo(url=url))
@@ -34,62 +69,78 @@ def webapp_button(url: str) -> InlineKeyboardMarkup:
 
 
 def countries_kb(countries: list[tuple[int, str, int]]) -> InlineKeyboardMarkup:
+    return _countries_kb(tuple(map(tuple, countries)))
+
+
+@functools.lru_cache(maxsize=8)
+def _countries_kb(countries: tuple[tuple[int, str, int], ...]) -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     for country_id, name, _active in countries:
-        b.button(text=name, callback_data=f"country:{country_id}")
+        b.button(text=name, callback_data=CountryCb(country_id=country_id))
     b.adjust(2)
     return b.as_markup()
 
 
 def banks_kb(banks: list[tuple[int, str, int]]) -> InlineKeyboardMarkup:
+    return _banks_kb(tuple(map(tuple, banks)))
+
+
+@functools.lru_cache(maxsize=64)
+def _banks_kb(banks: tuple[tuple[int, str, int], ...]) -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     for bank_id, bank_name, _active in banks:
-        b.button(text=bank_name, callback_data=f"bank:{bank_id}")
+        b.button(text=bank_name, callback_data=BankCb(bank_id=bank_id))
     b.adjust(2)
     return b.as_markup()
 
 
-def merchant_take_kb(app_id: int) -> InlineKeyboardMarkup:
+@per_app
+def merchant_take_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="🤝 Взять заявку", callback_data=f"take:{app_id}")
+    b.button(text="🤝 Взять заявку", callback_data=TakeCb.template())
     return b.as_markup()
 
 
-def merchant_send_mode_kb(app_id: int) -> InlineKeyboardMarkup:
+@per_app
+def merchant_send_mode_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="📤 Отправить сохранённые реквизиты", callback_data=f"send_saved:{app_id}")
-    b.button(text="✍️ Ввести новые реквизиты", callback_data=f"send_new:{app_id}")
+    b.button(text="📤 Отправить сохранённые реквизиты", callback_data=SendSavedCb.template())
+    b.button(text="✍️ Ввести новые реквизиты", callback_data=SendNewCb.template())
     b.adjust(1)
     return b.as_markup()
 
 
-def i_paid_kb(app_id: int) -> InlineKeyboardMarkup:
+@per_app
+def i_paid_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="✅ Я оплатил", callback_data=f"paid:{app_id}")
-    b.button(text="✉️ Чат", callback_data=f"chat:{app_id}")
-    b.button(text="❌ Отмена", callback_data=f"cancel:{app_id}")
+    b.button(text="✅ Я оплатил", callback_data=PaidCb.template())
+    b.button(text="✉️ Чат", callback_data=ChatCb.template())
+    b.button(text="❌ Отмена", callback_data=CancelCb.template())
     b.adjust(2, 1)
     return b.as_markup()
 
 
-def receipt_kb(app_id: int) -> InlineKeyboardMarkup:
+@per_app
+def receipt_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="📎 Прикрепить чек", callback_data=f"receipt:{app_id}")
-    b.button(text="Пропустить", callback_data=f"skip_receipt:{app_id}")
+    b.button(text="📎 Прикрепить чек", callback_data=ReceiptCb.template())
+    b.button(text="Пропустить", callback_data=SkipReceiptCb.template())
     b.adjust(1)
     return b.as_markup()
 
 
-def check_kb(app_id: int) -> InlineKeyboardMarkup:
+@per_app
+def check_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="✅ Подтвердить", callback_data=f"approve:{app_id}")
-    b.button(text="❌ Отклонить", callback_data=f"reject:{app_id}")
-    b.button(text="✉️ Ответить", callback_data=f"chat:{app_id}")
+    b.button(text="✅ Подтвердить", callback_data=ApproveCb.template())
+    b.button(text="❌ Отклонить", callback_data=RejectCb.template())
+    b.button(text="✉️ Ответить", callback_data=ChatCb.template())
     b.adjust(2, 1)
     return b.as_markup()
 
 
 # Admin keyboards
+@functools.cache
 def admin_menu_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="🏦 Банки/реквизиты", callback_data="admin:banks")
@@ -98,10 +149,36 @@ def admin_menu_kb() -> InlineKeyboardMarkup:
     b.button(text="📢 Рассылка", callback_data="admin:broadcast")
     b.button(text="⚙️ Настройки", callback_data="admin:settings")
     b.button(text="🖼 Управление фото", callback_data="admin:photos")
-    b.adjust(2, 2, 2)
+    b.button(text="📈 Аналитика", callback_data="admin:analytics")
+    b.button(text="📤 Экспорт заявок", callback_data="admin:export")
+    b.adjust(2, 2, 2, 2)
+    return b.as_markup()
+
+
+@functools.cache
+def admin_analytics_kb() -> InlineKeyboardMarkup:
+    b = InlineKeyboardBuilder()
+    b.button(text="7 дней", callback_data=AnalyticsCb(days=7))
+    b.button(text="30 дней", callback_data=AnalyticsCb(days=30))
+    b.button(text="90 дней", callback_data=AnalyticsCb(days=90))
+    b.button(text="⬅️ Назад", callback_data="admin:back")
+    b.adjust(3, 1)
+    return b.as_markup()
+
+
+@functools.cache
+def admin_export_kb() -> InlineKeyboardMarkup:
+    b = InlineKeyboardBuilder()
+    b.button(text="Сегодня (CSV)", callback_data=ExportCb(days=1, fmt="csv"))
+    b.button(text="7 дней (CSV)", callback_data=ExportCb(days=7, fmt="csv"))
+    b.button(text="30 дней (CSV)", callback_data=ExportCb(days=30, fmt="csv"))
+    b.button(text="30 дней (JSONL)", callback_data=ExportCb(days=30, fmt="jsonl"))
+    b.button(text="⬅️ Назад", callback_data="admin:back")
+    b.adjust(2, 2, 1)
     return b.as_markup()
 
 
+@functools.cache
 def admin_banks_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="➕ Добавить/обновить банк", callback_data="admin:add_bank")
@@ -111,6 +188,7 @@ def admin_banks_kb() -> InlineKeyboardMarkup:
     return b.as_markup()
 
 
+@functools.cache
 def admin_countries_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="➕ Добавить страну", callback_data="admin:add_country")
@@ -120,6 +198,7 @@ def admin_countries_kb() -> InlineKeyboardMarkup:
     return b.as_markup()
 
 
+@functools.cache
 def admin_roles_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="✏️ Назначить роль", callback_data="admin:set_role")
@@ -128,12 +207,13 @@ def admin_roles_kb() -> InlineKeyboardMarkup:
     return b.as_markup()
 
 
+@functools.cache
 def admin_photos_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="🎭 Приветствие", callback_data="admin:photo:welcome")
-    b.button(text="💳 Реквизиты", callback_data="admin:photo:requisites")
-    b.button(text="⏳ Ожидание", callback_data="admin:photo:waiting")
-    b.button(text="✅ Успех", callback_data="admin:photo:success")
+    b.button(text="🎭 Приветствие", callback_data=PhotoCb(kind="welcome"))
+    b.button(text="💳 Реквизиты", callback_data=PhotoCb(kind="requisites"))
+    b.button(text="⏳ Ожидание", callback_data=PhotoCb(kind="waiting"))
+    b.button(text="✅ Успех", callback_data=PhotoCb(kind="success"))
     b.button(text="⬅️ Назад", callback_data="admin:back")
     b.adjust(2, 2, 1)
     return b.as_markup()
@@ -162,24 +242,26 @@ def admin_country_item_kb(country_id: int, is_active: bool) -> InlineKeyboardMar
 def admin_choose_role_kb(tg_id: int) -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     for role in ["USER", "MERCHANT", "ADMIN"]:
-        b.button(text=role, callback_data=f"admin:role:{tg_id}:{role}")
+        b.button(text=role, callback_data=RoleCb(tg_id=tg_id, role=role))
     b.adjust(3)
     return b.as_markup()
 
 
+@functools.cache
 def admin_settings_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="📢 Канал (URL)", callback_data="admin:setting:channel_url")
-    b.button(text="👨‍💻 Команда (URL)", callback_data="admin:setting:team_url")
-    b.button(text="📜 Правила (URL)", callback_data="admin:setting:rules_url")
-    b.button(text="🌐 WebApp URL", callback_data="admin:setting:webapp_url")
-    b.button(text="📱 ID Канала", callback_data="admin:setting:channel_id")
-    b.button(text="💬 Чат мерчантов", callback_data="admin:setting:merchant_chat_id")
+    b.button(text="📢 Канал (URL)", callback_data=SettingCb(key="channel_url"))
+    b.button(text="👨‍💻 Команда (URL)", callback_data=SettingCb(key="team_url"))
+    b.button(text="📜 Правила (URL)", callback_data=SettingCb(key="rules_url"))
+    b.button(text="🌐 WebApp URL", callback_data=SettingCb(key="webapp_url"))
+    b.button(text="📱 ID Канала", callback_data=SettingCb(key="channel_id"))
+    b.button(text="💬 Чат мерчантов", callback_data=SettingCb(key="merchant_chat_id"))
     b.button(text="⬅️ Назад", callback_data="admin:back")
     b.adjust(2, 2, 2, 1)
     return b.as_markup()
 
 
+@functools.cache
 def confirm_broadcast_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="✅ Подтвердить рассылку", callback_data="admin:broadcast_confirm")
@@ -188,12 +270,14 @@ def confirm_broadcast_kb() -> InlineKeyboardMarkup:
     return b.as_markup()
 
 
-def chat_kb(app_id: int) -> InlineKeyboardMarkup:
+@per_app
+def chat_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="✉️ Написать", callback_data=f"chat:{app_id}")
+    b.button(text="✉️ Написать", callback_data=ChatCb.template())
     return b.as_markup()
 
 
+@functools.lru_cache(maxsize=4)
 def subscribe_kb(channel_url: str) -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
     b.button(text="📢 Подписаться", url=channel_url)
@@ -202,7 +286,8 @@ def subscribe_kb(channel_url: str) -> InlineKeyboardMarkup:
     return b.as_markup()
 
 
-def merchant_taken_kb(app_id: int) -> InlineKeyboardMarkup:
+@per_app
+def merchant_taken_kb() -> InlineKeyboardMarkup:
     b = InlineKeyboardBuilder()
-    b.button(text="↩️ Вернуть в очередь", callback_data=f"release:{app_id}")
+    b.button(text="↩️ Вернуть в очередь", callback_data=ReleaseCb.template())
     return b.as_markup()
@@ -0,0 +1,98 @@
+"""
+Лидер среди процессов бота: аренда в таблице leases
+
+Фоновые циклы (истечение заявок, outbox, уведомления) должны работать в
+одном процессе, сколько бы экземпляров бота ни было запущено. Каждый
+процесс раз в ttl/3 пытается взять или продлить аренду (Database.
+acquire_lease): её получает тот, кто уже владеет ею, или любой, если срок
+истёк. Лидер запускает задания, проигравшие ждут. Упавший лидер перестаёт
+продлевать аренду — через ttl её забирает другой процесс.
+
+При смене владельца token растёт (fencing token). Задания получают пару
+(имя аренды, token) и передают её в записи (Database.expire_overdue(fence=)):
+бывший лидер, ещё не заметивший потерю аренды, не сможет ничего записать.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable
+
+LEASE_TTL = 10.0
+
+# Задание лидера: корутина, получает fence = (имя аренды, token)
+Job = Callable[[tuple[str, int]], Awaitable[None]]
+
+
+class Leader:
+    def __init__(self, db, name: str, jobs: list[Job], ttl: float = LEASE_TTL,
+                 owner: str | None = None, logger: logging.Logger | None = None):
+        self.db = db
+        self.name = name
+        self.jobs = jobs
+        self.ttl = ttl
+        self.renew_every = ttl / 3
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.logger = logger or logging.getLogger("paydesk.lease")
+        self.token: int | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._runner: asyncio.Task | None = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None
+
+    def start(self) -> None:
+        if self._runner is None:
+            self._runner = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        """Остановить задания и отдать аренду (до закрытия Database)"""
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+
+    async def run(self) -> None:
+        """Бороться за аренду до отмены; при отмене аренда отдаётся сразу"""
+        valid_until = 0.0
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    token = await self.db.acquire_lease(self.name, self.owner, self.ttl)
+                except Exception as e:
+                    # БД недоступна: лидер остаётся лидером, пока не истёк уже продлённый срок
+                    self.logger.warning("lease %s renewal failed: %s", self.name, e)
+                    token = self.token if time.monotonic() < valid_until else None
+                else:
+                    if token is not None:
+                        valid_until = started + self.ttl
+                if token != self.token:
+                    await self._stop()
+                    if self.token is not None:
+                        self.logger.warning("lease %s lost (token %s)", self.name, self.token)
+                    self.token = token
+                    if token is not None:
+                        self.logger.info("lease %s acquired by %s (token %s)", self.name, self.owner, token)
+                        self._start((self.name, token))
+                await asyncio.sleep(self.renew_every)
+        finally:
+            await self._stop()
+            if self.token is not None:
+                self.token = None
+                with contextlib.suppress(Exception):
+                    await self.db.release_lease(self.name, self.owner)
+
+    def _start(self, fence: tuple[str, int]) -> None:
+        self._tasks = [asyncio.create_task(job(fence)) for job in self.jobs]
+
+    async def _stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,58 @@
+"""
+Пакетная загрузка по ключам в стиле DataLoader
+
+Все load(key), вызванные за один проход цикла событий (параллельные апдейты,
+asyncio.gather в обработчике), собираются и уходят одним вызовом batch_fn —
+одним запросом вида WHERE id IN (...). Результаты не кэшируются между
+проходами: каждый следующий load читает свежие данные.
+"""
+from __future__ import annotations
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, Iterable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class BatchLoader(Generic[K, V]):
+    def __init__(self, batch_fn: Callable[[list[K]], Awaitable[dict[K, V]]], max_batch: int = 500):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self._pending: dict[K, list[asyncio.Future]] = {}
+        self._scheduled = False
+
+    async def load(self, key: K) -> V | None:
+        """Значение по ключу или None, если batch_fn его не вернула"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append(future)
+        if not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self._dispatch)
+        return await future
+
+    async def load_many(self, keys: Iterable[K]) -> list[V | None]:
+        return list(await asyncio.gather(*(self.load(k) for k in keys)))
+
+    def _dispatch(self) -> None:
+        pending, self._pending = self._pending, {}
+        self._scheduled = False
+        keys = list(pending)
+        for i in range(0, len(keys), self.max_batch):
+            batch = {k: pending[k] for k in keys[i:i + self.max_batch]}
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: dict[K, list[asyncio.Future]]) -> None:
+        try:
+            results = await self.batch_fn(list(batch))
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for key, futures in batch.items():
+            value = results.get(key)
+            for future in futures:
+                if not future.done():
+                    future.set_result(value)
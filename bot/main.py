@@ -1,12 +1,21 @@
 from __future__ import annotations
 import asyncio
 import logging
+import signal
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 
 from bot.config import load_config
-from bot.db import Database
-from bot.notifications import NotificationManager
+from bot.db import Database, LeaseLost
+from bot.lease import Leader
+from bot.events import APP_CREATED, bus
+from bot.metrics import registry, serve as serve_metrics
+from bot.notifications import NotificationManager, resolve_merchant_chat_id
+from bot.profiler import QueryProfiler
+from bot.callbacks import callbacks
+from bot.session import build_session
+from bot.scheduler import UpdateScheduler
+from bot.throttling import ThrottlingMiddleware
 
 from bot.handlers.user import router as user_router
 from bot.handlers.apps import router as apps_router
@@ -15,15 +24,16 @@ from bot.handlers.payments import router as payments_router
 from bot.handlers.admin import router as admin_router
 from bot.handlers.chat import router as chat_router
 
-async def _expire_loop(bot: Bot, db: Database, logger: logging.Logger):
-    """Цикл проверки истекших заявок"""
+async def _expire_loop(bot: Bot, db: Database, logger: logging.Logger, fence: tuple[str, int] | None = None):
+    """Цикл проверки истекших заявок (только у держателя аренды fence)"""
     notif_manager = NotificationManager(bot, db)
     
     while True:
         try:
-            expired_ids = await db.expire_overdue()
+            expired_ids = await db.expire_overdue(fence)
+            apps = await db.get_application_views(expired_ids)
             for app_id in expired_ids:
-                app = await db.get_application(app_id)
+                app = apps.get(app_id)
                 if app:
                     # Отправляем уведомление пользователю
                     await notif_manager.notify_app_expired(app_id, app["user_tg_id"])
@@ -37,10 +47,24 @@ async def _expire_loop(bot: Bot, db: Database, logger: logging.Logger):
                         pass
             if expired_ids:
                 logger.info("Expired apps: %s", expired_ids)
+        except LeaseLost:
+            # Аренду забрал другой процесс; Leader остановит цикл при продлении
+            logger.warning("expire loop: lease lost, skipping")
         except Exception as e:
             logger.exception("expire loop error: %s", e)
         await asyncio.sleep(30)
 
+async def _index_loop(db: Database, logger: logging.Logger):
+    """Сверка индекса активных заявок с БД — в каждом процессе, индекс у каждого свой"""
+    while True:
+        await asyncio.sleep(30)
+        try:
+            # Заявки, созданные или изменённые API, попадают в индекс и без этого
+            # (промах читает БД), сверка лишь убирает устаревшие записи
+            await db.load_active_apps()
+        except Exception as e:
+            logger.exception("index loop error: %s", e)
+
 async def _notification_loop(bot: Bot, db: Database, logger: logging.Logger):
     """Цикл обработки уведомлений"""
     notif_manager = NotificationManager(bot, db)
@@ -54,21 +78,47 @@ async def _notification_loop(bot: Bot, db: Database, logger: logging.Logger):
             logger.exception("notification loop error: %s", e)
         await asyncio.sleep(60)
 
-async def _run():
-    config = load_config()
+def _merchant_dispatch(bot: Bot, db: Database, config, logger: logging.Logger):
+    """Подписчик app.created: заявка, созданная в WebApp, уходит в чат мерчантов"""
+    notif_manager = NotificationManager(bot, db)
+
+    async def on_app_created(payload: dict) -> None:
+        app = await db.get_application_view(payload["app_id"])
+        if not app or app["status"] != "WAITING_MERCHANT":
+            # Заявку уже взяли или отменили, пока событие ждало доставки
+            return
+        merchant_chat_id = await resolve_merchant_chat_id(db, config)
+        if merchant_chat_id is None:
+            logger.warning("merchant_chat_id not configured, app #%s not dispatched", app["id"])
+            return
+        if not await notif_manager.notify_merchants_new_app(merchant_chat_id, app, via_webapp=True):
+            # Исключение оставляет событие в outbox: relay повторит доставку
+            raise RuntimeError(f"failed to send app #{app['id']} to merchant chat")
+        logger.info("WebApp app #%s sent to merchant chat %s", app["id"], merchant_chat_id)
+
+    return on_app_created
+
+def setup_logging(name: str = "paydesk") -> logging.Logger:
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        format="%(asctime)s [%(levelname)s] %(processName)s %(name)s: %(message)s",
         handlers=[logging.FileHandler("bot.log", encoding="utf-8"), logging.StreamHandler()],
     )
-    logger = logging.getLogger("paydesk")
-
-    bot = Bot(token=config.bot_token)
-    dp = Dispatcher(storage=MemoryStorage())
+    return logging.getLogger(name)
 
-    db = Database(config.db_path)
+async def open_database(config, logger: logging.Logger, seed: bool = True) -> Database:
+    profiler = QueryProfiler(slow_ms=config.sql_slow_ms) if config.sql_profile else None
+    db = Database(config.db_path, profiler=profiler)
     await db.init()
 
+    if profiler and hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> -> top-N запросов в лог
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, lambda: logger.info("%s", profiler.report(20))
+        )
+
+    if not seed:
+        return db
     # seed countries if empty
     countries = await db.list_countries(active_only=False)
     if not countries:
@@ -80,8 +130,11 @@ async def _run():
         if not banks:
             await db.upsert_bank("Моно Банк", "Карта: ....\nФИО: ....\nНазначение: ....", default_country_id)
             await db.upsert_bank("Приват Банк", "Карта: ....\nФИО: ....\nНазначение: ....", default_country_id)
+    return db
 
-    # Include routers
+def include_routers(dp: Dispatcher) -> None:
+    # Include routers: все callback_query идут через единую таблицу
+    dp.include_router(callbacks.router)
     dp.include_router(user_router)
     dp.include_router(apps_router)
     dp.include_router(merchant_router)
@@ -89,12 +142,63 @@ async def _run():
     dp.include_router(admin_router)
     dp.include_router(chat_router)
 
-    # Start background tasks
-    asyncio.create_task(_expire_loop(bot, db, logger))
-    asyncio.create_task(_notification_loop(bot, db, logger))
+def build_dispatcher(config) -> tuple[Dispatcher, UpdateScheduler]:
+    dp = Dispatcher(storage=MemoryStorage())
+
+    # Апдейты одного пользователя (заявки — для кнопок мерчантов) по порядку,
+    # разных — параллельно на ограниченном числе обработчиков
+    scheduler = UpdateScheduler(config.sched_workers, config.sched_queue_limit, config.sched_overflow)
+    dp.update.outer_middleware(scheduler)
+
+    # Троттлинг до фильтров и обработчиков; админов не ограничиваем
+    throttling = ThrottlingMiddleware(config.throttle_rate, config.throttle_burst, exempt=set(config.admin_ids))
+    dp.message.outer_middleware(throttling)
+    dp.callback_query.outer_middleware(throttling)
+
+    include_routers(dp)
+    return dp, scheduler
+
+def start_background(bot: Bot, db: Database, config, logger: logging.Logger) -> Leader:
+    """Фоновые циклы: общие — только у лидера (аренда в БД), сверка индекса — везде"""
+    asyncio.create_task(_index_loop(db, logger))
+    # События от API (заявки из WebApp) через outbox
+    bus.subscribe(APP_CREATED, _merchant_dispatch(bot, db, config, logger))
+    leader = Leader(db, "background", [
+        lambda fence: _expire_loop(bot, db, logger, fence),
+        lambda fence: _notification_loop(bot, db, logger),
+        lambda fence: bus.relay(db, logger),
+    ], ttl=config.lease_ttl, logger=logger)
+    leader.start()
+    return leader
+
+async def _run():
+    config = load_config()
+    logger = setup_logging()
+
+    bot = Bot(token=config.bot_token, session=build_session(config))
+    db = await open_database(config, logger)
+    dp, scheduler = build_dispatcher(config)
+    leader = start_background(bot, db, config, logger)
+
+    scheduler.start()
+    metrics_runner = await serve_metrics(registry, port=config.metrics_port) if config.metrics_port else None
 
     logger.info("Bot v5.0 started with WebApp support")
-    await dp.start_polling(bot, config=config, db=db, logger=logger)
+    try:
+        # Обработку запускает планировщик: поллинг только раскладывает апдейты
+        # по очередям и при переполнении ждёт (handle_as_tasks=False)
+        await dp.start_polling(
+            bot, config=config, db=db, logger=logger,
+            allowed_updates=dp.resolve_used_update_types(),
+            handle_as_tasks=False,
+        )
+    finally:
+        await scheduler.close()
+        await leader.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await db.close()
+        await bot.session.close()
 
 def main():
     asyncio.run(_run())
@@ -0,0 +1,161 @@
+"""
+Метрики процесса в текстовом формате Prometheus
+
+Счётчики, gauge и гистограммы без меток — ровно то, что нужно очередям и
+пулам бота. Значение gauge может вычисляться функцией при каждом чтении
+(длина очереди и т.п.), тогда его не нужно обновлять вручную.
+
+Бот отдаёт registry по HTTP на METRICS_PORT (serve()), если порт задан.
+"""
+from __future__ import annotations
+import bisect
+import math
+from typing import Callable
+
+# Границы гистограмм времени, секунды
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n: float = 1) -> None:
+        self.value += n
+
+    def samples(self) -> list[tuple[str, float]]:
+        return [(self.name, self.value)]
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float] | None = None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self._value = 0.0
+
+    @property
+    def value(self) -> float:
+        return self.fn() if self.fn is not None else self._value
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def inc(self, n: float = 1) -> None:
+        self._value += n
+
+    def dec(self, n: float = 1) -> None:
+        self._value -= n
+
+    def samples(self) -> list[tuple[str, float]]:
+        return [(self.name, self.value)]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> list[tuple[str, float]]:
+        out = []
+        total = 0
+        for bound, n in zip((*self.buckets, math.inf), self.counts):
+            total += n
+            out.append((f'{self.name}_bucket{{le="{_fmt(bound)}"}}', total))
+        out.append((f"{self.name}_sum", self.sum))
+        out.append((f"{self.name}_count", self.count))
+        return out
+
+
+class Registry:
+    """Метрики по имени; повторная регистрация возвращает уже созданную
+
+    Второй BotSession или Sender в процессе (тесты, шард с несколькими ботами)
+    пишет в те же счётчики и гистограммы. Gauge с fn переключается на fn
+    последнего зарегистрировавшего. Одно имя с другим типом — ValueError.
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def _get(self, name: str, cls):
+        metric = self._metrics.get(name)
+        if metric is not None and not isinstance(metric, cls):
+            raise ValueError(f"Metric {name!r} is already registered as {metric.kind}")
+        return metric
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        metric = self._get(name, Counter)
+        return metric if metric is not None else self._add(Counter(name, help))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float] | None = None) -> Gauge:
+        metric = self._get(name, Gauge)
+        if metric is None:
+            return self._add(Gauge(name, help, fn))
+        if fn is not None:
+            metric.fn = fn
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = TIME_BUCKETS) -> Histogram:
+        metric = self._get(name, Histogram)
+        if metric is not None and metric.buckets != tuple(sorted(buckets)):
+            raise ValueError(f"Metric {name!r} is already registered with other buckets")
+        return metric if metric is not None else self._add(Histogram(name, help, buckets))
+
+    def unregister(self, name: str) -> None:
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name} {_fmt(value)}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+async def serve(registry: Registry, host: str = "0.0.0.0", port: int = 9100):
+    """HTTP /metrics на aiohttp (зависимость aiogram); возвращает runner для cleanup()"""
+    from aiohttp import web
+
+    async def metrics(_request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"Cache-Control": "no-store"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# Один registry на процесс
+registry = Registry()
@@ -3,10 +3,116 @@
 """
 from __future__ import annotations
 import asyncio
+import logging
 from typing import Optional
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+from bot.sender import BULK, CRITICAL, TRANSACTIONAL, get_sender
+from bot.session import non_critical
+
+# Одновременных отправок в рассылке; темп задаёт полоса bulk в Sender
+BROADCAST_CONCURRENCY = 20
+
+# Ссылки на фоновые отправки, чтобы задачи не собрал GC до завершения
+_background: set[asyncio.Task] = set()
+
+
+def in_background(coro, logger: logging.Logger) -> asyncio.Task:
+    """Отправка без ожидания: обработчик не ждёт медленный или лежащий Bot API"""
+    task = asyncio.create_task(coro)
+    _background.add(task)
+
+    def done(task: asyncio.Task) -> None:
+        _background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("background notification failed", exc_info=task.exception())
+
+    task.add_done_callback(done)
+    return task
+
+# Шаблоны текстов и неизменяемые клавиатуры — собираются один раз при импорте
+NOTIFICATION_TEMPLATE = "🔔 <b>{title}</b>\n\n{message}"
+
+REQUISITES_TEMPLATE = (
+    "✅ <b>Заявка #{app_id}</b>\n\n"
+    "🏦 Банк: {bank_name}\n"
+    "💰 Сумма: {amount:.2f} грн\n\n"
+    "<b>Реквизиты:</b>\n"
+    "<code>{requisites}</code>\n\n"
+    "⏳ Оплатите до: {expires}"
+)
+
+CONFIRMED_TEMPLATE = (
+    "✅ <b>Заявка #{app_id} подтверждена!</b>\n\n"
+    "🏦 Банк: {bank_name}\n"
+    "💰 Сумма: {amount:.2f} грн\n\n"
+    "Спасибо за использование NightLab!"
+)
+
+REJECTED_TEMPLATE = (
+    "❌ <b>Заявка #{app_id} отклонена</b>\n\n"
+    "🏦 Банк: {bank_name}\n"
+    "💰 Сумма: {amount:.2f} грн\n"
+)
+
+EXPIRED_TEMPLATE = (
+    "⏰ <b>Заявка #{app_id}</b>\n\n"
+    "Время на оплату истекло.\n"
+    "Заявка автоматически закрыта.\n\n"
+    "Создайте новую заявку, если нужно."
+)
+
+MERCHANT_ASSIGNED_TEMPLATE = (
+    "🆕 <b>Новая заявка #{app_id}</b>\n\n"
+    "🏦 Банк: {bank_name}\n"
+    "💰 Сумма: {amount:.2f} грн\n"
+    "👤 Пользователь: @{user_username}\n\n"
+    "Выдайте реквизиты как можно скорее!"
+)
+
+RECEIPT_TEMPLATE = (
+    "📎 <b>Новый чек к заявке #{app_id}</b>\n\n"
+    "👤 Пользователь: @{user_username}\n"
+    "💰 Сумма: {amount:.2f} грн\n\n"
+    "Проверьте чек и подтвердите платеж!"
+)
+
+NEW_APP_MERCHANTS_TEMPLATE = (
+    "🆕 Новая заявка{source}\n"
+    "ID: #{app_id}\n"
+    "Банк: 🏦 {bank_name}\n"
+    "Сумма: {amount:.2f} грн\n"
+    "Код: {payment_code}\n"
+    "От: @{user_username} (id {user_tg_id})\n\n"
+    "Нажмите «Взять заявку», затем выдайте реквизиты."
+)
+
+REFERRAL_TEMPLATE = (
+    "🎉 <b>Поздравляем!</b>\n\n"
+    "@{referred_username} присоединился по вашей ссылке!"
+)
+
+MY_APPS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📄 Мои заявки", callback_data="my_apps")]
+])
+SUPPORT_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🆘 Поддержка", callback_data="support")]
+])
+NEW_APP_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💳 Новая заявка", callback_data="new_app")]
+])
+
+async def resolve_merchant_chat_id(db, config) -> int | str | None:
+    """Чат мерчантов: настройка из БД, иначе MERCHANT_CHAT_ID из конфига"""
+    chat_id = await db.get_setting("merchant_chat_id")
+    if not chat_id:
+        return config.merchant_chat_id
+    if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+        return int(chat_id)
+    return chat_id
+
+
 class NotificationManager:
     """Менеджер уведомлений для пользователей"""
     
@@ -16,21 +122,28 @@ class NotificationManager:
     
     async def send_notification(self, user_tg_id: int, title: str, message: str, 
                                  reply_markup: Optional[InlineKeyboardMarkup] = None,
-                                 notification_type: str = "general") -> bool:
-        """Отправить уведомление пользователю"""
+                                 notification_type: str = "general", store: bool = True,
+                                 lane: str = TRANSACTIONAL) -> bool:
+        """Отправить уведомление пользователю
+
+        store=False — запись в notifications уже сделана вместе с изменением
+        заявки, остаётся только сообщение в Telegram. lane — полоса Sender.
+        """
         try:
             # Сохраняем в БД
-            await self.db.create_notification(
-                user_tg_id=user_tg_id,
-                type=notification_type,
-                title=title,
-                message=message
-            )
+            if store:
+                await self.db.create_notification(
+                    user_tg_id=user_tg_id,
+                    type=notification_type,
+                    title=title,
+                    message=message
+                )
             
             # Отправляем в Telegram
-            await self.bot.send_message(
-                chat_id=user_tg_id,
-                text=f"🔔 <b>{title}</b>\n\n{message}",
+            await get_sender(self.bot).send_message(
+                user_tg_id,
+                NOTIFICATION_TEMPLATE.format(title=title, message=message),
+                lane=lane,
                 parse_mode="HTML",
                 reply_markup=reply_markup
             )
@@ -41,18 +154,14 @@ class NotificationManager:
     
     async def notify_requisites_sent(self, app_id: int, user_tg_id: int, 
                                       bank_name: str, amount: float, 
-                                      requisites: str, expires_at: str) -> bool:
+                                      requisites: str, expires_at: str, store: bool = True) -> bool:
         """Уведомление о выдаче реквизитов"""
         from bot.keyboards import i_paid_kb
         
         title = "Реквизиты получены"
-        message = (
-            f"✅ <b>Заявка #{app_id}</b>\n\n"
-            f"🏦 Банк: {bank_name}\n"
-            f"💰 Сумма: {amount:.2f} грн\n\n"
-            f"<b>Реквизиты:</b>\n"
-            f"<code>{requisites}</code>\n\n"
-            f"⏳ Оплатите до: {expires_at[:16].replace('T', ' ')}"
+        message = REQUISITES_TEMPLATE.format(
+            app_id=app_id, bank_name=bank_name, amount=amount,
+            requisites=requisites, expires=expires_at[:16].replace('T', ' ')
         )
         
         return await self.send_notification(
@@ -60,30 +169,24 @@ class NotificationManager:
             title=title,
             message=message,
             reply_markup=i_paid_kb(app_id),
-            notification_type="requisites"
+            notification_type="requisites",
+            store=store,
+            lane=CRITICAL
         )
     
     async def notify_payment_confirmed(self, app_id: int, user_tg_id: int,
                                         bank_name: str, amount: float) -> bool:
         """Уведомление о подтверждении платежа"""
         title = "Платеж подтвержден"
-        message = (
-            f"✅ <b>Заявка #{app_id} подтверждена!</b>\n\n"
-            f"🏦 Банк: {bank_name}\n"
-            f"💰 Сумма: {amount:.2f} грн\n\n"
-            f"Спасибо за использование NightLab!"
-        )
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📄 Мои заявки", callback_data=f"my_apps")]
-        ])
+        message = CONFIRMED_TEMPLATE.format(app_id=app_id, bank_name=bank_name, amount=amount)
         
         return await self.send_notification(
             user_tg_id=user_tg_id,
             title=title,
             message=message,
-            reply_markup=keyboard,
-            notification_type="confirmed"
+            reply_markup=MY_APPS_KB,
+            notification_type="confirmed",
+            lane=CRITICAL
         )
     
     async def notify_payment_rejected(self, app_id: int, user_tg_id: int,
@@ -91,47 +194,30 @@ class NotificationManager:
                                        reason: str = "") -> bool:
         """Уведомление об отклонении платежа"""
         title = "Платеж отклонен"
-        message = (
-            f"❌ <b>Заявка #{app_id} отклонена</b>\n\n"
-            f"🏦 Банк: {bank_name}\n"
-            f"💰 Сумма: {amount:.2f} грн\n"
-        )
+        message = REJECTED_TEMPLATE.format(app_id=app_id, bank_name=bank_name, amount=amount)
         if reason:
             message += f"\nПричина: {reason}"
         
         message += "\n\nОбратитесь в поддержку для уточнения."
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🆘 Поддержка", callback_data=f"support")]
-        ])
-        
         return await self.send_notification(
             user_tg_id=user_tg_id,
             title=title,
             message=message,
-            reply_markup=keyboard,
+            reply_markup=SUPPORT_KB,
             notification_type="rejected"
         )
     
     async def notify_app_expired(self, app_id: int, user_tg_id: int) -> bool:
         """Уведомление об истечении времени заявки"""
         title = "Время заявки истекло"
-        message = (
-            f"⏰ <b>Заявка #{app_id}</b>\n\n"
-            f"Время на оплату истекло.\n"
-            f"Заявка автоматически закрыта.\n\n"
-            f"Создайте новую заявку, если нужно."
-        )
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💳 Новая заявка", callback_data=f"new_app")]
-        ])
+        message = EXPIRED_TEMPLATE.format(app_id=app_id)
         
         return await self.send_notification(
             user_tg_id=user_tg_id,
             title=title,
             message=message,
-            reply_markup=keyboard,
+            reply_markup=NEW_APP_KB,
             notification_type="expired"
         )
     
@@ -140,19 +226,15 @@ class NotificationManager:
                                         user_username: str) -> bool:
         """Уведомление мерчанту о назначении заявки"""
         try:
-            message = (
-                f"🆕 <b>Новая заявка #{app_id}</b>\n\n"
-                f"🏦 Банк: {bank_name}\n"
-                f"💰 Сумма: {amount:.2f} грн\n"
-                f"👤 Пользователь: @{user_username}\n\n"
-                f"Выдайте реквизиты как можно скорее!"
+            message = MERCHANT_ASSIGNED_TEMPLATE.format(
+                app_id=app_id, bank_name=bank_name, amount=amount, user_username=user_username
             )
             
             from bot.keyboards import merchant_send_mode_kb
             
-            await self.bot.send_message(
-                chat_id=merchant_tg_id,
-                text=message,
+            await get_sender(self.bot).send_message(
+                merchant_tg_id,
+                message,
                 parse_mode="HTML",
                 reply_markup=merchant_send_mode_kb(app_id)
             )
@@ -161,22 +243,41 @@ class NotificationManager:
             print(f"Failed to notify merchant {merchant_tg_id}: {e}")
             return False
     
+    async def notify_merchants_new_app(self, merchant_chat_id: int | str, app: dict,
+                                       via_webapp: bool = False) -> bool:
+        """Новая заявка (ApplicationView) в чат мерчантов с кнопкой «Взять заявку»"""
+        try:
+            message = NEW_APP_MERCHANTS_TEMPLATE.format(
+                source=" (через WebApp)" if via_webapp else "", app_id=app["id"],
+                bank_name=app["bank_name"] or "[UNKNOWN]", amount=app["amount_uah"],
+                payment_code=app["payment_code"], user_username=app["user_username"],
+                user_tg_id=app["user_tg_id"],
+            )
+
+            from bot.keyboards import merchant_take_kb
+
+            await get_sender(self.bot).send_message(
+                merchant_chat_id,
+                message,
+                lane=CRITICAL,
+                reply_markup=merchant_take_kb(app["id"])
+            )
+            return True
+        except Exception as e:
+            print(f"Failed to send app #{app['id']} to merchant chat {merchant_chat_id}: {e}")
+            return False
+    
     async def notify_receipt_received(self, app_id: int, admin_chat_id: int,
                                        user_username: str, amount: float) -> bool:
         """Уведомление админу о получении чека"""
         try:
-            message = (
-                f"📎 <b>Новый чек к заявке #{app_id}</b>\n\n"
-                f"👤 Пользователь: @{user_username}\n"
-                f"💰 Сумма: {amount:.2f} грн\n\n"
-                f"Проверьте чек и подтвердите платеж!"
-            )
+            message = RECEIPT_TEMPLATE.format(app_id=app_id, user_username=user_username, amount=amount)
             
             from bot.keyboards import check_kb
             
-            await self.bot.send_message(
-                chat_id=admin_chat_id,
-                text=message,
+            await get_sender(self.bot).send_message(
+                admin_chat_id,
+                message,
                 parse_mode="HTML",
                 reply_markup=check_kb(app_id)
             )
@@ -190,36 +291,38 @@ class NotificationManager:
                                    bonus_uah: float = 0) -> bool:
         """Уведомление о новом реферале"""
         title = "Новый реферал"
-        message = (
-            f"🎉 <b>Поздравляем!</b>\n\n"
-            f"@{referred_username} присоединился по вашей ссылке!"
-        )
+        message = REFERRAL_TEMPLATE.format(referred_username=referred_username)
         if bonus_uah > 0:
             message += f"\n💰 Вы получили бонус: {bonus_uah:.2f} грн"
         
-        return await self.send_notification(
-            user_tg_id=referrer_tg_id,
-            title=title,
-            message=message,
-            notification_type="referral"
-        )
+        # Не срочно: при сбоях Bot API подождёт восстановления
+        with non_critical():
+            return await self.send_notification(
+                user_tg_id=referrer_tg_id,
+                title=title,
+                message=message,
+                notification_type="referral",
+                lane=BULK
+            )
     
     async def broadcast_message(self, user_ids: list[int], message: str,
-                                 parse_mode: str = "HTML") -> dict:
-        """Массовая рассылка сообщений"""
+                                 parse_mode: str | None = "HTML") -> dict:
+        """Массовая рассылка сообщений (полоса bulk: не задерживает заявки)"""
         results = {"sent": 0, "failed": 0}
-        
-        for user_id in user_ids:
-            try:
-                await self.bot.send_message(
-                    chat_id=user_id,
-                    text=message,
-                    parse_mode=parse_mode
-                )
-                results["sent"] += 1
-                await asyncio.sleep(0.05)  # Rate limiting
-            except Exception as e:
-                print(f"Failed to broadcast to {user_id}: {e}")
-                results["failed"] += 1
+        sender = get_sender(self.bot)
+        pending = iter(user_ids)
+
+        async def worker():
+            for user_id in pending:
+                try:
+                    await sender.send_message(user_id, message, lane=BULK, parse_mode=parse_mode)
+                    results["sent"] += 1
+                except Exception as e:
+                    print(f"Failed to broadcast to {user_id}: {e}")
+                    results["failed"] += 1
+
+        # Рассылка не срочная: при сбоях Bot API ждёт восстановления, а не теряется
+        with non_critical():
+            await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
         
         return results
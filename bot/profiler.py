@@ -0,0 +1,258 @@
+"""
+Профилировщик SQL-запросов для Database
+
+Включается через SQL_PROFILE=1. Когда выключен, Database открывает обычные
+соединения aiosqlite и профилировщик не участвует в запросах вообще.
+"""
+from __future__ import annotations
+import functools
+import logging
+import re
+import sys
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any
+
+import aiosqlite
+
+logger = logging.getLogger("paydesk.sql")
+
+# Python-модуль sqlite3 не отдаёт sqlite3_stmt_status, поэтому объём работы
+# оцениваем по числу инструкций VDBE через progress handler.
+PROGRESS_STEP = 1000
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WS_RE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=512)
+def normalize_sql(sql: str) -> str:
+    """Приводит SQL к шаблону: литералы и списки IN заменяются на ?"""
+    q = _STRING_RE.sub("?", sql)
+    q = _NUMBER_RE.sub("?", q)
+    q = _IN_LIST_RE.sub("(?, ...)", q)
+    return _WS_RE.sub(" ", q).strip()
+
+
+def params_shape(params: Any) -> str:
+    """Форма параметров без значений: (int,str,NoneType)"""
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ",".join(sorted(params)) + "}"
+    return "(" + ",".join(type(p).__name__ for p in params) + ")"
+
+
+def _caller() -> str:
+    """Имя метода Database и того, кто его вызвал"""
+    names = []
+    frame = sys._getframe(1)
+    while frame is not None and len(names) < 2:
+        name = frame.f_code.co_name
+        if frame.f_code.co_filename != __file__ and not name.startswith("_"):
+            names.append(name)
+        frame = frame.f_back
+    return " <- ".join(names) or "?"
+
+
+@dataclass
+class QueryStats:
+    sql: str
+    calls: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    steps: int = 0
+    shapes: set[str] = field(default_factory=set)
+    callers: set[str] = field(default_factory=set)
+
+
+class _Record:
+    """Одно выполнение запроса: execute + последующие fetch*"""
+
+    __slots__ = ("stats", "caller", "shape", "elapsed_ms", "logged")
+
+    def __init__(self, stats: QueryStats, caller: str, shape: str):
+        self.stats = stats
+        self.caller = caller
+        self.shape = shape
+        self.elapsed_ms = 0.0
+        self.logged = False
+
+
+class QueryProfiler:
+    """Собирает статистику по нормализованным запросам и пишет slow-query лог"""
+
+    def __init__(self, slow_ms: float = 200.0):
+        self.slow_ms = slow_ms
+        self.stats: dict[str, QueryStats] = {}
+        self.started_at = time.time()
+
+    def _begin(self, sql: str, params: Any, caller: str) -> _Record:
+        key = normalize_sql(sql)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = QueryStats(sql=key)
+        stats.calls += 1
+        shape = params_shape(params)
+        stats.shapes.add(shape)
+        stats.callers.add(caller)
+        return _Record(stats, caller, shape)
+
+    def _account(self, rec: _Record, elapsed_ms: float, steps: int) -> None:
+        rec.elapsed_ms += elapsed_ms
+        stats = rec.stats
+        stats.total_ms += elapsed_ms
+        stats.steps += steps
+        if rec.elapsed_ms > stats.max_ms:
+            stats.max_ms = rec.elapsed_ms
+        if not rec.logged and rec.elapsed_ms >= self.slow_ms:
+            rec.logged = True
+            logger.warning(
+                "slow query %.1f ms [%s] %s params=%s",
+                rec.elapsed_ms, rec.caller, stats.sql[:500], rec.shape,
+            )
+
+    @asynccontextmanager
+    async def connect(self, path: str):
+        async with aiosqlite.connect(path) as conn:
+            pconn = ProfiledConnection(conn, self)
+            await conn.set_progress_handler(pconn._on_progress, PROGRESS_STEP)
+            yield pconn
+
+    def reset(self) -> None:
+        self.stats.clear()
+        self.started_at = time.time()
+
+    def top(self, n: int = 10, key: str = "total_ms") -> list[QueryStats]:
+        return sorted(self.stats.values(), key=lambda s: getattr(s, key), reverse=True)[:n]
+
+    def report(self, n: int = 10) -> str:
+        """Текстовый отчёт по top-N запросам (по суммарному времени)"""
+        uptime = time.time() - self.started_at
+        lines = [f"SQL profile: {len(self.stats)} queries, {uptime:.0f}s"]
+        for s in self.top(n):
+            avg = s.total_ms / s.calls if s.calls else 0.0
+            lines.append(
+                f"{s.total_ms:9.1f} ms | {s.calls:6d} calls | avg {avg:7.2f} | max {s.max_ms:7.2f} "
+                f"| ~{s.steps} vm | {', '.join(sorted(s.callers))[:120]}\n    {s.sql[:300]}"
+            )
+        return "\n".join(lines)
+
+
+class ProfiledCursor:
+    """Обёртка над aiosqlite.Cursor, досчитывающая время выборки строк"""
+
+    def __init__(self, cursor: aiosqlite.Cursor, conn: "ProfiledConnection", rec: _Record):
+        self._cursor = cursor
+        self._conn = conn
+        self._rec = rec
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    async def _timed(self, coro):
+        steps = self._conn._steps
+        t0 = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self._conn.profiler._account(
+                self._rec,
+                (time.perf_counter() - t0) * 1000,
+                (self._conn._steps - steps) * PROGRESS_STEP,
+            )
+
+    async def fetchone(self):
+        return await self._timed(self._cursor.fetchone())
+
+    async def fetchmany(self, size: int | None = None):
+        return await self._timed(self._cursor.fetchmany(size))
+
+    async def fetchall(self):
+        return await self._timed(self._cursor.fetchall())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._cursor.close()
+
+
+class _ExecuteResult:
+    """Результат execute(): как у aiosqlite — можно await, можно async with"""
+
+    __slots__ = ("_coro", "_cursor")
+
+    def __init__(self, coro):
+        self._coro = coro
+        self._cursor = None
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self) -> ProfiledCursor:
+        self._cursor = await self._coro
+        return self._cursor
+
+    async def __aexit__(self, *exc):
+        await self._cursor.close()
+
+
+class ProfiledConnection:
+    """Обёртка над aiosqlite.Connection: профилирует execute/executemany/executescript"""
+
+    def __init__(self, conn: aiosqlite.Connection, profiler: QueryProfiler):
+        self._conn = conn
+        self.profiler = profiler
+        self._steps = 0
+
+    def _on_progress(self) -> int:
+        self._steps += 1
+        return 0
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    async def _run(self, sql: str, params: Any, coro) -> tuple[Any, _Record]:
+        rec = self.profiler._begin(sql, params, _caller())
+        steps = self._steps
+        t0 = time.perf_counter()
+        try:
+            result = await coro
+        finally:
+            self.profiler._account(
+                rec, (time.perf_counter() - t0) * 1000, (self._steps - steps) * PROGRESS_STEP
+            )
+        return result, rec
+
+    def execute(self, sql: str, parameters: Any = None) -> _ExecuteResult:
+        return _ExecuteResult(self._execute(sql, parameters))
+
+    def executemany(self, sql: str, parameters: Any) -> _ExecuteResult:
+        return _ExecuteResult(self._executemany(sql, parameters))
+
+    async def _execute(self, sql: str, parameters: Any) -> ProfiledCursor:
+        cur, rec = await self._run(sql, parameters, self._conn.execute(sql, parameters))
+        return ProfiledCursor(cur, self, rec)
+
+    async def _executemany(self, sql: str, parameters: Any) -> ProfiledCursor:
+        parameters = list(parameters)
+        shape = f"{len(parameters)}x{params_shape(parameters[0]) if parameters else '()'}"
+        rec = self.profiler._begin(sql, None, _caller())
+        rec.shape = shape
+        steps = self._steps
+        t0 = time.perf_counter()
+        try:
+            cur = await self._conn.executemany(sql, parameters)
+        finally:
+            self.profiler._account(
+                rec, (time.perf_counter() - t0) * 1000, (self._steps - steps) * PROGRESS_STEP
+            )
+        return ProfiledCursor(cur, self, rec)
+
+    async def executescript(self, sql_script: str):
+        cur, _rec = await self._run(sql_script, None, self._conn.executescript(sql_script))
+        return cur
@@ -0,0 +1,99 @@
+"""
+Token bucket: лимиты отправки в Bot API и троттлинг входящих запросов
+"""
+from __future__ import annotations
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, n: float = 1) -> float:
+        """Забирает n токенов; возвращает 0 или сколько секунд подождать"""
+        self._refill(time.monotonic())
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def delay(self, n: float = 1) -> float:
+        """Через сколько секунд будет n токенов; ничего не забирает"""
+        self._refill(time.monotonic())
+        return max(0.0, (n - self.tokens) / self.rate)
+
+    async def acquire(self, n: float = 1) -> None:
+        while (wait := self.try_acquire(n)) > 0:
+            await asyncio.sleep(wait)
+
+    @property
+    def idle(self) -> bool:
+        """Ведро полное — состояние можно выбросить без потери информации"""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class BucketStore:
+    """Общее хранилище token bucket по ключу
+
+    Ключ включает пространство имён: ("msg", user_id), ("api-ip", ip), ...
+    Параметры ведра задаёт вызывающий при каждом обращении. Вёдра, которые
+    успели наполниться до краёв, ничем не отличаются от новых — их
+    периодически (раз в sweep_interval) выбрасываем. Сверх max_keys ключей
+    вытесняется давно не использованное ведро (LRU): поток новых ключей не
+    раздувает память и не превращает каждый запрос в полный обход.
+    """
+
+    def __init__(self, sweep_interval: float = 60.0, max_keys: int = 100_000):
+        self.sweep_interval = sweep_interval
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _bucket(self, key: Hashable, rate: float, capacity: float | None) -> TokenBucket:
+        if time.monotonic() >= self._next_sweep:
+            self.sweep()
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets.move_to_end(key)
+            return bucket
+        while len(self._buckets) >= self.max_keys:
+            self._buckets.popitem(last=False)
+        bucket = self._buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+    def hit(self, key: Hashable, rate: float, capacity: float | None = None, n: float = 1) -> float:
+        """0 — запрос разрешён, иначе через сколько секунд повторить"""
+        return self._bucket(key, rate, capacity).try_acquire(n)
+
+    async def acquire(self, key: Hashable, rate: float, capacity: float | None = None, n: float = 1) -> None:
+        await self._bucket(key, rate, capacity).acquire(n)
+
+    def sweep(self) -> int:
+        """Удаляет простаивающие вёдра, возвращает сколько удалено"""
+        idle = [key for key, bucket in self._buckets.items() if bucket.idle]
+        for key in idle:
+            del self._buckets[key]
+        self._next_sweep = time.monotonic() + self.sweep_interval
+        return len(idle)
+
+
+# Одно хранилище на процесс: троттлинг бота, API и лимиты отправки
+buckets = BucketStore()
@@ -0,0 +1,177 @@
+"""
+Планировщик апдейтов: порядок внутри ключа, параллельность между ключами
+
+Outer middleware на уровне Update. Апдейт не обрабатывается в задаче
+поллинга, а ставится в очередь своего ключа:
+  - пользователь (event_from_user) — его сообщения и кнопки идут строго
+    по порядку, FSM не видит гонок;
+  - заявка (app_id) для кнопок мерчантов и проверки чека — два мерчанта,
+    нажавшие «Взять» на одной заявке, обрабатываются по очереди.
+Готовые ключи разбирают workers обработчиков — не больше, чем столько
+одновременно открытых соединений с БД и запросов к Bot API.
+
+Всего в очередях не больше queue_limit апдейтов. Поллинг запускается с
+handle_as_tasks=False, поэтому при overflow="wait" переполнение
+останавливает getUpdates (обратное давление: апдейты ждут у Telegram), а
+при overflow="drop" лишние апдейты отбрасываются.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from bot.callbacks import (
+    ApproveCb, ReleaseCb, RejectCb, SendNewCb, SendSavedCb, TakeCb, callbacks,
+)
+from bot.metrics import Registry, registry as default_registry
+
+logger = logging.getLogger("paydesk.scheduler")
+
+# Кнопки, которые нажимают разные люди над одной заявкой: ключ — заявка
+APP_KEYED_CALLBACKS = (TakeCb, ReleaseCb, SendSavedCb, SendNewCb, ApproveCb, RejectCb)
+
+OVERFLOW_POLICIES = ("wait", "drop")
+OVERLOAD_TEXT = "⏳ Бот перегружен, попробуйте через минуту."
+
+Job = tuple[Callable[[], Awaitable[Any]], float]
+
+
+class UpdateScheduler(BaseMiddleware):
+    def __init__(self, workers: int = 16, queue_limit: int = 1000, overflow: str = "wait",
+                 metrics: Registry = default_registry):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}")
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.overflow = overflow
+        # key -> очередь апдейтов; ключ есть в словаре, пока в нём есть работа
+        self._queues: dict[Hashable, deque[Job]] = {}
+        self._ready: asyncio.Queue[Hashable] = asyncio.Queue()
+        self._pending = 0
+        self._running = 0
+        self._space = asyncio.Condition()
+        self._tasks: list[asyncio.Task] = []
+
+        self.m_depth = metrics.gauge("updates_queue_depth", "Updates waiting in scheduler queues",
+                                     fn=lambda: self._pending)
+        self.m_keys = metrics.gauge("updates_queue_keys", "Users/apps with queued updates",
+                                    fn=lambda: len(self._queues))
+        self.m_running = metrics.gauge("updates_running", "Updates being handled now",
+                                       fn=lambda: self._running)
+        self.m_wait = metrics.histogram("update_wait_seconds", "Time from receive to handler start")
+        self.m_handle = metrics.histogram("update_handle_seconds", "Handler run time")
+        self.m_total = metrics.counter("updates_total", "Updates accepted by scheduler")
+        self.m_dropped = metrics.counter("updates_dropped_total", "Updates dropped on overflow")
+
+    @staticmethod
+    def key(update: Update, data: dict[str, Any]) -> Hashable | None:
+        call = update.callback_query
+        if call is not None and call.data:
+            found = callbacks.resolve(call.data)
+            if found is not None and isinstance(found[1], APP_KEYED_CALLBACKS):
+                return "app", found[1].app_id
+        # event_from_user у chat_member — тот, кто изменил статус, а обработчик
+        # правит кэш подписки участника; my_chat_member касается всего чата.
+        # shard_of (bot/shard.py) раскладывает эти апдейты по тем же ключам
+        if update.chat_member is not None:
+            return "user", update.chat_member.new_chat_member.user.id
+        if update.my_chat_member is not None:
+            return "chat", update.my_chat_member.chat.id
+        user = data.get("event_from_user")
+        if user is not None:
+            return "user", user.id
+        chat = data.get("event_chat")
+        if chat is not None:
+            return "chat", chat.id
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        key = self.key(event, data)
+        if key is None or not self._tasks:
+            # Без ключа порядок не нужен; до start() — обычная обработка
+            return await handler(event, data)
+
+        if self._pending >= self.queue_limit:
+            if self.overflow == "drop":
+                self.m_dropped.inc()
+                logger.warning("scheduler overloaded (%d queued), update %s dropped", self._pending, event.update_id)
+                if event.callback_query is not None:
+                    # Без ответа клиент крутит часики на кнопке
+                    asyncio.create_task(self._answer_overload(event.callback_query))
+                return None
+            async with self._space:
+                await self._space.wait_for(lambda: self._pending < self.queue_limit)
+
+        async def run() -> Any:
+            if "state" in data:
+                # raw_state прочитан при получении апдейта, а предыдущий апдейт
+                # этого пользователя мог сменить состояние FSM
+                data["raw_state"] = await data["state"].get_state()
+            return await handler(event, data)
+
+        self._pending += 1
+        self.m_total.inc()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append((run, time.monotonic()))
+        return None
+
+    @staticmethod
+    async def _answer_overload(call) -> None:
+        with contextlib.suppress(Exception):
+            await call.answer(OVERLOAD_TEXT)
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Дождаться разбора очередей (не дольше timeout) и остановить workers"""
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._drained(), timeout)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _drained(self) -> None:
+        while self._pending or self._running:
+            await asyncio.sleep(0.05)
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            run, received = queue.popleft()
+            self._pending -= 1
+            self._running += 1
+            async with self._space:
+                self._space.notify()
+            started = time.monotonic()
+            self.m_wait.observe(started - received)
+            try:
+                await run()
+            except Exception:
+                logger.exception("update handler failed (key=%s)", key)
+            finally:
+                self._running -= 1
+                self.m_handle.observe(time.monotonic() - started)
+                # Ключ возвращается в конец очереди готовых: один активный
+                # пользователь не занимает worker, пока ждут остальные
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
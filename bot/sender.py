@@ -0,0 +1,195 @@
+"""
+Отправка сообщений с учётом лимитов Telegram
+
+Bot API допускает ~30 сообщений в секунду на бота и ~1 в секунду в один чат.
+Sender держит общий лимит на бота и per-chat вёдра в общем BucketStore,
+повторяет вызов после TelegramRetryAfter и умеет рассылать одно сообщение
+нескольким получателям параллельно.
+
+Общий лимит поделён на полосы (lane):
+  - critical — реквизиты, «платёж подтверждён», заявки в чат мерчантов;
+  - transactional — остальные сообщения по заявкам (по умолчанию);
+  - bulk — рассылки и реферальные уведомления.
+Когда отправок больше лимита, LaneLimiter раздаёт токены по весам полос
+(LANE_WEIGHTS), а пока ждёт хоть одно critical-сообщение, bulk не получает
+ничего. Полосы, кроме critical, не занимают больше 1 - CRITICAL_RESERVE
+лимита: даже посреди рассылки у критичных сообщений есть запас токенов.
+Время ожидания и доставки по полосам — метрики sender_<lane>_*.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import logging
+import time
+import weakref
+from collections import deque
+from typing import Any, Awaitable, Callable, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from bot.metrics import Registry, registry as default_registry
+from bot.ratelimit import TokenBucket, BucketStore, buckets
+
+logger = logging.getLogger("paydesk.sender")
+
+GLOBAL_RATE = 25
+CHAT_RATE = 1
+CHAT_BURST = 3
+MAX_RETRIES = 3
+
+CRITICAL, TRANSACTIONAL, BULK = "critical", "transactional", "bulk"
+LANES = (CRITICAL, TRANSACTIONAL, BULK)
+# Доли полос, когда все ждут токенов
+LANE_WEIGHTS = {CRITICAL: 6, TRANSACTIONAL: 3, BULK: 1}
+# Часть лимита, которую transactional и bulk не занимают никогда
+CRITICAL_RESERVE = 0.2
+
+
+class LaneLimiter:
+    """Общий лимит отправки: взвешенная очередь по полосам с резервом для critical"""
+
+    def __init__(self, rate: float, weights: dict[str, float] = LANE_WEIGHTS,
+                 reserve: float = CRITICAL_RESERVE):
+        self.weights = weights
+        self._global = TokenBucket(rate)
+        # Второе ведро для некритичных полос: не больше (1 - reserve) лимита
+        self._shared = TokenBucket(rate * (1 - reserve))
+        self._waiters: dict[str, deque[asyncio.Future]] = {lane: deque() for lane in LANES}
+        # Виртуальное время полос (WFQ): обслуживается полоса с наименьшим
+        self._vtime = dict.fromkeys(LANES, 0.0)
+        self._clock = 0.0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+
+    def queued(self, lane: str) -> int:
+        return len(self._waiters[lane])
+
+    def _delay(self, lane: str) -> float:
+        delay = self._global.delay()
+        if lane != CRITICAL:
+            delay = max(delay, self._shared.delay())
+        return delay
+
+    def _take(self, lane: str) -> None:
+        self._global.try_acquire()
+        if lane != CRITICAL:
+            self._shared.try_acquire()
+
+    async def acquire(self, lane: str) -> None:
+        if self._dispatcher is None and self._delay(lane) == 0:
+            self._take(lane)
+            return
+        waiters = self._waiters[lane]
+        if not waiters:
+            # Простаивавшая полоса не копит «кредит» за время простоя
+            self._vtime[lane] = max(self._vtime[lane], self._clock)
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        self._wakeup.set()
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    def _eligible(self) -> list[str]:
+        for waiters in self._waiters.values():
+            while waiters and waiters[0].done():
+                waiters.popleft()  # вызывающий отменён
+        lanes = [lane for lane in LANES if self._waiters[lane]]
+        if self._waiters[CRITICAL]:
+            # bulk ждёт, пока в critical есть очередь
+            lanes = [lane for lane in lanes if lane != BULK]
+        return sorted(lanes, key=self._vtime.__getitem__)
+
+    async def _dispatch(self) -> None:
+        try:
+            while lanes := self._eligible():
+                self._wakeup.clear()
+                ready = next((lane for lane in lanes if self._delay(lane) == 0), None)
+                if ready is None:
+                    # Новое сообщение в очереди (например, critical) будит раньше
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._wakeup.wait(), min(map(self._delay, lanes)))
+                    continue
+                self._take(ready)
+                self._waiters[ready].popleft().set_result(None)
+                self._clock = self._vtime[ready]
+                self._vtime[ready] += 1 / self.weights[ready]
+        finally:
+            self._dispatcher = None
+
+
+class Sender:
+    def __init__(self, bot: Bot, rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, store: BucketStore = buckets,
+                 metrics: Registry = default_registry):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.store = store
+        self.limiter = LaneLimiter(rate)
+        self.m_queued = {}
+        self.m_wait = {}
+        self.m_latency = {}
+        self.m_sent = {}
+        for lane in LANES:
+            self.m_queued[lane] = metrics.gauge(f"sender_{lane}_queued", f"Messages waiting for {lane} lane budget",
+                                                fn=lambda lane=lane: self.limiter.queued(lane))
+            self.m_wait[lane] = metrics.histogram(f"sender_{lane}_wait_seconds",
+                                                  f"Time waiting for {lane} lane rate budget")
+            self.m_latency[lane] = metrics.histogram(f"sender_{lane}_latency_seconds",
+                                                     f"Time from send call to delivery, {lane} lane")
+            self.m_sent[lane] = metrics.counter(f"sender_{lane}_sent_total", f"Messages delivered, {lane} lane")
+
+    async def call(self, chat_id: int, method: Callable[..., Awaitable[Any]], *args: Any,
+                   lane: str = TRANSACTIONAL, **kwargs: Any) -> Any:
+        """Вызывает метод Bot API для chat_id в полосе lane, соблюдая лимиты"""
+        started = time.monotonic()
+        for attempt in range(MAX_RETRIES + 1):
+            await self.store.acquire(("send", self.bot.id, chat_id), self.chat_rate, self.chat_burst)
+            queued = time.monotonic()
+            await self.limiter.acquire(lane)
+            self.m_wait[lane].observe(time.monotonic() - queued)
+            try:
+                result = await method(*args, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                logger.warning("flood control for %s, retry in %ss", chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            else:
+                self.m_latency[lane].observe(time.monotonic() - started)
+                self.m_sent[lane].inc()
+                return result
+
+    async def send_message(self, chat_id: int | str, text: str, lane: str = TRANSACTIONAL, **kwargs: Any):
+        return await self.call(chat_id, self.bot.send_message, chat_id, text, lane=lane, **kwargs)
+
+    async def copy_message(self, chat_id: int, from_chat_id: int, message_id: int,
+                           lane: str = TRANSACTIONAL, **kwargs: Any):
+        return await self.call(chat_id, self.bot.copy_message, chat_id, from_chat_id, message_id,
+                               lane=lane, **kwargs)
+
+    async def send_photo(self, chat_id: int, photo: str, lane: str = TRANSACTIONAL, **kwargs: Any):
+        return await self.call(chat_id, self.bot.send_photo, chat_id, photo, lane=lane, **kwargs)
+
+    async def send_document(self, chat_id: int, document: str, lane: str = TRANSACTIONAL, **kwargs: Any):
+        return await self.call(chat_id, self.bot.send_document, chat_id, document, lane=lane, **kwargs)
+
+    async def fanout(self, chat_ids: Iterable[int],
+                     send: Callable[[int], Awaitable[Any]]) -> dict[int, Any]:
+        """Параллельная отправка; результат или исключение по каждому chat_id"""
+        chat_ids = list(dict.fromkeys(chat_ids))
+        results = await asyncio.gather(*(send(cid) for cid in chat_ids), return_exceptions=True)
+        return dict(zip(chat_ids, results))
+
+
+_senders: weakref.WeakKeyDictionary[Bot, Sender] = weakref.WeakKeyDictionary()
+
+
+def get_sender(bot: Bot) -> Sender:
+    """Один Sender на экземпляр Bot — лимиты общие для всех обработчиков"""
+    sender = _senders.get(bot)
+    if sender is None:
+        sender = _senders[bot] = Sender(bot)
+    return sender
@@ -0,0 +1,258 @@
+"""
+HTTP-сессия Bot API: пул соединений, таймауты по методам, circuit breaker
+
+build_session(config) собирает AiohttpSession под нагрузку бота:
+  - пул из BOT_API_POOL соединений к одному хосту с keep-alive (TLS
+    рукопожатие не повторяется на каждое сообщение) и кэшем DNS;
+  - таймаут по умолчанию BOT_API_TIMEOUT вместо 60 с aiogram, загрузка
+    файлов — дольше (METHOD_TIMEOUTS);
+  - BOT_API_URL — свой сервер Bot API (локальный telegram-bot-api или
+    тестовый фейк) вместо api.telegram.org.
+
+Circuit breaker считает сетевые ошибки и ответы 5xx в окне WINDOW секунд.
+Когда их доля превышает FAILURE_RATIO, цепь размыкается на OPEN_FOR секунд:
+запросы сразу получают CircuitOpen (это TelegramNetworkError, обработчики
+уже умеют его переживать) вместо ожидания таймаута. Потом один пробный
+запрос решает, замкнуть цепь или подождать ещё.
+
+Некритичные отправки (рассылки, реферальные уведомления) выполняются внутри
+non_critical(): при разомкнутой цепи они не падают, а ждут её восстановления
+(не дольше DEFER_TIMEOUT, в ожидании не больше DEFER_LIMIT запросов).
+Неудачу пробного запроса получает вызвавший его, даже некритичный: повтор
+мог бы продублировать сообщение, которое Telegram всё-таки принял.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import contextvars
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Iterator
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+
+from bot.metrics import Registry, registry as default_registry
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+    from aiogram.methods import TelegramMethod
+
+POOL_SIZE = 100
+KEEPALIVE = 60.0
+DNS_TTL = 300
+TIMEOUT = 10.0
+# Загрузка файлов и медиагрупп идёт дольше обычного сообщения
+METHOD_TIMEOUTS = {
+    "sendPhoto": 60.0,
+    "sendDocument": 60.0,
+    "sendMediaGroup": 60.0,
+    "sendVideo": 60.0,
+    "answerCallbackQuery": 5.0,
+}
+# getUpdates не проходит через breaker: у поллинга свой backoff
+BREAKER_EXEMPT = frozenset({"getUpdates"})
+
+WINDOW = 30.0
+MIN_CALLS = 20
+FAILURE_RATIO = 0.5
+OPEN_FOR = 15.0
+DEFER_TIMEOUT = 120.0
+DEFER_LIMIT = 1000
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+_deferrable: contextvars.ContextVar[bool] = contextvars.ContextVar("bot_api_deferrable", default=False)
+
+
+@contextlib.contextmanager
+def non_critical() -> Iterator[None]:
+    """Запросы внутри блока при разомкнутой цепи ждут, а не падают сразу"""
+    token = _deferrable.set(True)
+    try:
+        yield
+    finally:
+        _deferrable.reset(token)
+
+
+class CircuitOpen(TelegramNetworkError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, window: float = WINDOW, min_calls: int = MIN_CALLS,
+                 failure_ratio: float = FAILURE_RATIO, open_for: float = OPEN_FOR):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_for = open_for
+        self.state = CLOSED
+        # (время, успех) за последние window секунд
+        self._calls: deque[tuple[float, bool]] = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._closed = asyncio.Event()
+        self._closed.set()
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос сейчас; в HALF_OPEN пропускает один пробный"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < self.open_for:
+                return False
+            self.state = HALF_OPEN
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record(self, ok: bool | None) -> None:
+        """Итог запроса: True/False; None — запрос отменён, результата нет"""
+        now = time.monotonic()
+        if self.state == HALF_OPEN and self._probing:
+            self._probing = False
+            if ok:
+                self._close()
+            elif ok is False:
+                self._open(now)
+            return
+        if self.state != CLOSED or ok is None:
+            # Ответы на запросы, ушедшие до размыкания, окно не меняют
+            return
+        self._calls.append((now, ok))
+        if not ok:
+            self._failures += 1
+        while self._calls and self._calls[0][0] < now - self.window:
+            if not self._calls.popleft()[1]:
+                self._failures -= 1
+        if len(self._calls) >= self.min_calls and self._failures >= self.failure_ratio * len(self._calls):
+            self._open(now)
+
+    def retry_in(self) -> float:
+        """Через сколько секунд имеет смысл снова спросить allow()"""
+        if self.state == OPEN:
+            return max(0.0, self._opened_at + self.open_for - time.monotonic())
+        return 0.0 if self.state == CLOSED else 0.5
+
+    async def wait(self, timeout: float) -> None:
+        """Ждать замыкания цепи, не дольше timeout"""
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._closed.wait(), timeout)
+
+    def _open(self, now: float) -> None:
+        self.state = OPEN
+        self._opened_at = now
+        self._closed.clear()
+
+    def _close(self) -> None:
+        self.state = CLOSED
+        self._calls.clear()
+        self._failures = 0
+        self._closed.set()
+
+
+class BotSession(AiohttpSession):
+    def __init__(self, api: TelegramAPIServer = PRODUCTION, limit: int = POOL_SIZE,
+                 timeout: float = TIMEOUT, keepalive: float = KEEPALIVE, dns_ttl: int = DNS_TTL,
+                 method_timeouts: dict[str, float] | None = None,
+                 breaker: CircuitBreaker | None = None, metrics: Registry = default_registry):
+        super().__init__(api=api, limit=limit, timeout=timeout)
+        self._connector_init.update(
+            limit_per_host=limit,
+            keepalive_timeout=keepalive,
+            use_dns_cache=True,
+            ttl_dns_cache=dns_ttl,
+        )
+        self.limit = limit
+        self.method_timeouts = METHOD_TIMEOUTS if method_timeouts is None else method_timeouts
+        self.breaker = breaker or CircuitBreaker()
+        self._in_flight = 0
+        self._deferred = 0
+
+        self.m_requests = metrics.counter("bot_api_requests_total", "Bot API requests sent")
+        self.m_errors = metrics.counter("bot_api_errors_total", "Bot API network errors and 5xx responses")
+        self.m_rejected = metrics.counter("bot_api_rejected_total", "Bot API requests failed fast by open circuit")
+        self.m_seconds = metrics.histogram("bot_api_request_seconds", "Bot API request time")
+        self.m_in_flight = metrics.gauge("bot_api_in_flight", "Bot API requests in progress",
+                                         fn=lambda: self._in_flight)
+        self.m_deferred = metrics.gauge("bot_api_deferred", "Non-critical requests waiting for the circuit",
+                                        fn=lambda: self._deferred)
+        self.m_pool_limit = metrics.gauge("bot_api_pool_limit", "Bot API connection pool size",
+                                          fn=lambda: self.limit)
+        self.m_pool_in_use = metrics.gauge("bot_api_pool_in_use", "Bot API connections in use",
+                                           fn=lambda: self._pool_stats()[0])
+        self.m_pool_idle = metrics.gauge("bot_api_pool_idle", "Bot API keep-alive connections idle",
+                                         fn=lambda: self._pool_stats()[1])
+        self.m_circuit = metrics.gauge("bot_api_circuit_state", "Circuit breaker: 0 closed, 1 half-open, 2 open",
+                                       fn=lambda: (CLOSED, HALF_OPEN, OPEN).index(self.breaker.state))
+
+    def _pool_stats(self) -> tuple[int, int]:
+        # Внутренние поля aiohttp: при их смене метрики покажут 0, а не упадут
+        connector = self._session.connector if self._session is not None else None
+        if connector is None or connector.closed:
+            return 0, 0
+        in_use = len(getattr(connector, "_acquired", ()))
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        return in_use, idle
+
+    async def _admit(self, method: TelegramMethod) -> None:
+        if self.breaker.allow():
+            return
+        if not _deferrable.get() or self._deferred >= DEFER_LIMIT:
+            self.m_rejected.inc()
+            raise CircuitOpen(method=method, message="Bot API circuit is open")
+        self._deferred += 1
+        try:
+            deadline = time.monotonic() + DEFER_TIMEOUT
+            while not self.breaker.allow():
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    self.m_rejected.inc()
+                    raise CircuitOpen(method=method, message="Bot API circuit is open")
+                await self.breaker.wait(min(left, self.breaker.retry_in() or 0.5))
+        finally:
+            self._deferred -= 1
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        name = method.__api_method__
+        if timeout is None:
+            timeout = self.method_timeouts.get(name, self.timeout)
+        if name in BREAKER_EXEMPT:
+            return await super().make_request(bot, method, timeout)
+
+        await self._admit(method)
+        ok = None
+        self._in_flight += 1
+        self.m_requests.inc()
+        started = time.monotonic()
+        try:
+            result = await super().make_request(bot, method, timeout)
+            ok = True
+            return result
+        except (TelegramNetworkError, TelegramServerError):
+            ok = False
+            self.m_errors.inc()
+            raise
+        except Exception:
+            # 4xx, flood control: Telegram отвечает, цепь в порядке
+            ok = True
+            raise
+        finally:
+            self._in_flight -= 1
+            self.m_seconds.observe(time.monotonic() - started)
+            self.breaker.record(ok)
+
+
+def api_server(config) -> TelegramAPIServer:
+    """Сервер Bot API из BOT_API_URL, по умолчанию api.telegram.org"""
+    if config.bot_api_url:
+        return TelegramAPIServer.from_base(config.bot_api_url)
+    return PRODUCTION
+
+
+def build_session(config, metrics: Registry = default_registry) -> BotSession:
+    return BotSession(api=api_server(config), limit=config.bot_api_pool,
+                      timeout=config.bot_api_timeout, metrics=metrics)
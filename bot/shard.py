@@ -0,0 +1,438 @@
+"""
+Шардированный запуск бота: ingress + N процессов-воркеров
+
+    python main.py shards --workers 4
+
+Ingress — лёгкий процесс без БД и обработчиков: long polling getUpdates
+сырым JSON (без разбора в модели aiogram) и раскладка апдейтов по воркерам
+через Unix-сокет. Шард выбирается по from_user.id (для апдейтов без
+пользователя — по chat.id; chat_member — по участнику, как в UpdateScheduler),
+номер стабилен между перезапусками, поэтому FSM (MemoryStorage), троттлинг и
+кэши пользователя остаются в одном процессе.
+
+Воркер — обычный бот (build_dispatcher, UpdateScheduler, свой Database и
+писатель), только апдейты он читает из сокета, а не из getUpdates. Фоновые
+циклы (истечение заявок, outbox) работают в одном воркере — у держателя
+аренды (bot/lease.py).
+
+Индекс активных заявок у каждого воркера свой: после записи воркер шлёт id
+изменённых заявок в ingress, тот рассылает их остальным, и они выбрасывают
+заявки из индекса (Database.forget_apps).
+
+Ingress перезапускает упавшие воркеры с экспоненциальной задержкой; пока
+воркер недоступен, его апдейты копятся в очереди шарда (до QUEUE_LIMIT, затем
+поллинг ждёт). Апдейты, уже отправленные упавшему воркеру, теряются — как и
+при падении процесса с обычным поллингом.
+
+Протокол сокета: JSON по строке на сообщение.
+  воркер -> ingress: {"shard": i} при подключении, {"inv": [id, ...] | null}
+  ingress -> воркер: {"u": update}, {"inv": [id, ...] | null}
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import Any, Awaitable, Callable
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: тогда json
+    orjson = None
+
+from bot.metrics import Registry, registry, serve as serve_metrics
+
+logger = logging.getLogger("paydesk.shard")
+
+POLL_TIMEOUT = 25
+QUEUE_LIMIT = 10_000
+RESTART_DELAY = (1.0, 30.0)
+# Воркер, проработавший дольше, перезапускается без накопленной задержки
+STABLE_UPTIME = 60.0
+STREAM_LIMIT = 4 * 1024 * 1024
+
+WorkerTarget = Callable[[int, str], None]
+
+
+def dumps(msg: dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(msg) + b"\n"
+    return json.dumps(msg, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def shard_of(update: dict[str, Any], shards: int) -> int:
+    """Номер шарда апдейта: по пользователю, иначе по чату, иначе 0
+
+    Ключ тот же, что у UpdateScheduler.key: chat_member — по участнику, чей
+    статус изменился, my_chat_member — по чату.
+    """
+    for key, payload in update.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        if key == "chat_member":
+            return payload["new_chat_member"]["user"]["id"] % shards
+        if key == "my_chat_member":
+            return payload["chat"]["id"] % shards
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"] % shards
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"] % shards
+    return 0
+
+
+class Ingress:
+    def __init__(self, config, shards: int, socket_path: str | None = None,
+                 target: WorkerTarget | None = None, queue_limit: int = QUEUE_LIMIT,
+                 metrics: Registry = registry):
+        self.config = config
+        self.shards = shards
+        self.socket_path = socket_path or os.path.join(tempfile.gettempdir(), f"paydesk-shards-{os.getpid()}.sock")
+        self.target = target or run_worker
+        self._queues = [asyncio.Queue(maxsize=queue_limit) for _ in range(shards)]
+        self._writers: list[asyncio.StreamWriter | None] = [None] * shards
+        self._connected = [asyncio.Event() for _ in range(shards)]
+        self._procs: list[multiprocessing.Process | None] = [None] * shards
+        self._tasks: list[asyncio.Task] = []
+        self._server: asyncio.AbstractServer | None = None
+        self._stopping = False
+
+        self.m_updates = metrics.counter("ingress_updates_total", "Updates routed to shards")
+        self.m_restarts = metrics.counter("ingress_worker_restarts_total", "Worker process restarts")
+        self.m_depth = metrics.gauge("ingress_queue_depth", "Updates waiting for a worker",
+                                      fn=lambda: sum(q.qsize() for q in self._queues))
+
+    # === Запуск ===
+    async def start(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._accept, self.socket_path, limit=STREAM_LIMIT)
+        for index in range(self.shards):
+            self._tasks.append(asyncio.create_task(self._send_loop(index)))
+            self._tasks.append(asyncio.create_task(self._supervise(index)))
+
+    async def run(self) -> None:
+        """Запустить воркеры и поллинг; работает до отмены"""
+        await self.start()
+        try:
+            await self._poll()
+        finally:
+            await self.close()
+
+    async def close(self, timeout: float = 15.0) -> None:
+        """Закрыть сокеты (воркеры дорабатывают очереди и выходят) и дождаться процессов"""
+        self._stopping = True
+        # Уже принятые апдейты дописываем подключённым воркерам
+        deadline = time.monotonic() + timeout / 3
+        while time.monotonic() < deadline and any(
+            q.qsize() and self._writers[i] is not None for i, q in enumerate(self._queues)
+        ):
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._server is not None:
+            self._server.close()
+        for writer in self._writers:
+            if writer is not None:
+                writer.close()
+        deadline = time.monotonic() + timeout
+        for proc in self._procs:
+            if proc is None:
+                continue
+            await asyncio.to_thread(proc.join, max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                proc.terminate()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+    # === Маршрутизация ===
+    async def route(self, update: dict[str, Any]) -> None:
+        """Поставить апдейт в очередь шарда; при переполнении ждёт (обратное давление)"""
+        await self._queues[shard_of(update, self.shards)].put(dumps({"u": update}))
+        self.m_updates.inc()
+
+    async def _poll(self) -> None:
+        import aiohttp
+        from aiogram import Dispatcher
+        from bot.main import include_routers
+        from bot.session import api_server
+
+        probe = Dispatcher()
+        include_routers(probe)
+        allowed = probe.resolve_used_update_types()
+        url = api_server(self.config).api_url(self.config.bot_token, "getUpdates")
+        offset = None
+        delay = RESTART_DELAY[0]
+        timeout = aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                try:
+                    async with session.post(url, json={"offset": offset, "timeout": POLL_TIMEOUT,
+                                                       "allowed_updates": allowed}) as resp:
+                        data = await resp.json(loads=loads, content_type=None)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logger.warning("getUpdates failed: %s, retry in %.0fs", e, delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RESTART_DELAY[1])
+                    continue
+                if not data.get("ok"):
+                    logger.error("getUpdates error: %s", data.get("description"))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RESTART_DELAY[1])
+                    continue
+                delay = RESTART_DELAY[0]
+                for update in data["result"]:
+                    await self.route(update)
+                    offset = update["update_id"] + 1
+
+    async def _send_loop(self, index: int) -> None:
+        queue = self._queues[index]
+        while True:
+            line = await queue.get()
+            while True:
+                await self._connected[index].wait()
+                writer = self._writers[index]
+                if writer is None:
+                    continue
+                try:
+                    writer.write(line)
+                    await writer.drain()
+                    break
+                except (ConnectionError, RuntimeError):
+                    # Воркер упал: ждём перезапуска и отправляем ему этот же апдейт
+                    self._disconnect(index, writer)
+
+    def _broadcast(self, source: int, line: bytes) -> None:
+        """Инвалидация — мимо очередей апдейтов, чтобы не ждать за их хвостом"""
+        for index, writer in enumerate(self._writers):
+            if index != source and writer is not None and not writer.is_closing():
+                writer.write(line)
+
+    # === Воркеры ===
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        index = None
+        try:
+            hello = await reader.readline()
+            index = loads(hello)["shard"]
+            if self._writers[index] is not None:
+                self._writers[index].close()
+            self._writers[index] = writer
+            self._connected[index].set()
+            logger.info("shard %d connected", index)
+            while line := await reader.readline():
+                if "inv" in loads(line):
+                    self._broadcast(index, line)
+        except (ConnectionError, ValueError, KeyError, IndexError) as e:
+            logger.warning("shard %s link error: %s", index, e)
+        finally:
+            if index is not None:
+                self._disconnect(index, writer)
+            writer.close()
+
+    def _disconnect(self, index: int, writer: asyncio.StreamWriter | None) -> None:
+        if self._writers[index] is writer:
+            self._writers[index] = None
+            self._connected[index].clear()
+
+    async def _supervise(self, index: int) -> None:
+        ctx = multiprocessing.get_context("spawn")
+        delay = RESTART_DELAY[0]
+        while not self._stopping:
+            proc = ctx.Process(target=self.target, args=(index, self.socket_path),
+                               name=f"shard-{index}", daemon=True)
+            proc.start()
+            self._procs[index] = proc
+            started = time.monotonic()
+            await asyncio.to_thread(proc.join)
+            if self._stopping:
+                return
+            if time.monotonic() - started > STABLE_UPTIME:
+                delay = RESTART_DELAY[0]
+            logger.warning("shard %d exited with code %s, restart in %.0fs", index, proc.exitcode, delay)
+            self.m_restarts.inc()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESTART_DELAY[1])
+
+
+class WorkerLink:
+    """Сторона воркера: апдейты из ingress, инвалидация индекса в обе стороны"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, socket_path: str, index: int) -> "WorkerLink":
+        reader, writer = await asyncio.open_unix_connection(socket_path, limit=STREAM_LIMIT)
+        writer.write(dumps({"shard": index}))
+        await writer.drain()
+        return cls(reader, writer)
+
+    def publish(self, app_ids: list[int] | None) -> None:
+        """listener ActiveApps: сообщить остальным шардам об изменённых заявках"""
+        if not self.writer.is_closing():
+            self.writer.write(dumps({"inv": app_ids}))
+
+    async def run(self, feed: Callable[[dict[str, Any]], Awaitable[Any]],
+                  forget: Callable[[list[int] | None], None]) -> None:
+        """Читать сокет до закрытия ingress"""
+        while line := await self.reader.readline():
+            msg = loads(line)
+            if "u" in msg:
+                try:
+                    await feed(msg["u"])
+                except Exception:
+                    logger.exception("update %s failed", msg["u"].get("update_id"))
+            elif "inv" in msg:
+                forget(msg["inv"])
+        self.writer.close()
+
+
+def run_worker(index: int, socket_path: str) -> None:
+    """Точка входа процесса-воркера"""
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(_worker_main(index, socket_path))
+
+
+async def _worker_main(index: int, socket_path: str) -> None:
+    from aiogram import Bot
+    from bot.config import load_config
+    from bot.main import build_dispatcher, open_database, setup_logging, start_background
+    from bot.session import build_session
+
+    config = load_config()
+    log = setup_logging()
+    bot = Bot(token=config.bot_token, session=build_session(config))
+    db = await open_database(config, log, seed=index == 0)
+    dp, scheduler = build_dispatcher(config)
+    leader = start_background(bot, db, config, log)
+
+    link = await WorkerLink.connect(socket_path, index)
+    db.active.listener = link.publish
+    scheduler.start()
+    metrics_runner = None
+    if config.metrics_port:
+        metrics_runner = await serve_metrics(registry, port=config.metrics_port + 1 + index)
+
+    kwargs = {"config": config, "db": db, "logger": log}
+    log.info("shard %d started", index)
+    try:
+        await link.run(lambda update: dp.feed_raw_update(bot, update, **kwargs), db.forget_apps)
+    finally:
+        await scheduler.close()
+        await leader.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await db.close()
+        await bot.session.close()
+
+
+async def run_ingress(shards: int) -> None:
+    from bot.config import load_config
+    from bot.main import setup_logging
+
+    config = load_config()
+    setup_logging()
+    ingress = Ingress(config, shards)
+    metrics_runner = await serve_metrics(registry, port=config.metrics_port) if config.metrics_port else None
+    logger.info("ingress started with %d shards", shards)
+    try:
+        await ingress.run()
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+def main(shards: int | None = None) -> None:
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(run_ingress(shards or os.cpu_count() or 1))
+
+
+# === Бенчмарк: python -m bot.shard --bench [--workers N] ===
+def _bench_worker(index: int, socket_path: str) -> None:
+    """Воркер бенчмарка: разбор апдейта aiogram + CPU-работа обработчика вместо БД и Bot API"""
+    async def main() -> None:
+        from aiogram import Bot, Dispatcher, Router
+        from aiogram.types import Message
+        from bot.metrics import Registry
+        from bot.scheduler import UpdateScheduler
+
+        work = float(os.environ.get("SHARD_BENCH_WORK_MS", "1")) / 1000
+        dp = Dispatcher()
+        scheduler = UpdateScheduler(metrics=Registry())
+        dp.update.outer_middleware(scheduler)
+        router = Router()
+        dp.include_router(router)
+
+        @router.message()
+        async def handle(message: Message) -> None:
+            until = time.perf_counter() + work
+            while time.perf_counter() < until:
+                pass
+            if message.text == "last":
+                open(f"{socket_path}.{index}.done", "w").close()
+
+        bot = Bot(token="1:BENCH")
+        scheduler.start()
+        link = await WorkerLink.connect(socket_path, index)
+        await link.run(lambda update: dp.feed_raw_update(bot, update), lambda _ids: None)
+        await scheduler.close()
+        await bot.session.close()
+
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(main())
+
+
+async def bench(shards: int, updates: int = 20_000, users: int = 1000) -> float:
+    """Прогнать updates апдейтов через ingress и N воркеров; возвращает апдейтов в секунду"""
+    ingress = Ingress(None, shards, target=_bench_worker, metrics=Registry())
+    await ingress.start()
+    while not all(e.is_set() for e in ingress._connected):
+        await asyncio.sleep(0.05)
+
+    def update(i: int, user: int, text: str) -> dict[str, Any]:
+        return {"update_id": i, "message": {
+            "message_id": i, "date": 0, "text": text,
+            "chat": {"id": user, "type": "private"},
+            "from": {"id": user, "is_bot": False, "first_name": "u"},
+        }}
+
+    started = time.perf_counter()
+    for i in range(updates):
+        await ingress.route(update(i, i % users + 1, "x"))
+    # Последний апдейт каждого шарда: воркер отмечает завершение файлом
+    for index in range(shards):
+        await ingress.route(update(updates + index, index or shards, "last"))
+    done = [f"{ingress.socket_path}.{index}.done" for index in range(shards)]
+    while not all(os.path.exists(path) for path in done):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    for path in done:
+        os.unlink(path)
+    await ingress.close()
+    return (updates + shards) / elapsed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Шардированный запуск бота")
+    parser.add_argument("--workers", type=int, default=None, help="число воркеров (по умолчанию — число ядер)")
+    parser.add_argument("--bench", action="store_true", help="бенчмарк 1..N воркеров на синтетических апдейтах")
+    args = parser.parse_args()
+    if args.bench:
+        top = args.workers or os.cpu_count() or 1
+        for n in sorted({1, *(2 ** k for k in range(top.bit_length()) if 2 ** k <= top), top}):
+            print(f"{n:3d} workers: {asyncio.run(bench(n)):9.0f} updates/s")
+    else:
+        main(args.workers)
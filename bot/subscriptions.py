@@ -0,0 +1,63 @@
+"""
+Кэш проверки подписки на канал (get_chat_member)
+"""
+from __future__ import annotations
+import asyncio
+import time
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+class SubscriptionCache:
+    """Кэширует результат get_chat_member и склеивает одновременные запросы.
+
+    Положительный ответ живёт positive_ttl секунд, отрицательный — negative_ttl
+    (чтобы только что подписавшийся пользователь не ждал долго). Если бот админ
+    канала, обновления chat_member приходят сразу и кэш правится через set().
+    """
+
+    def __init__(self, positive_ttl: float = 600, negative_ttl: float = 30, max_size: int = 50000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: dict[tuple[str, int], tuple[bool, float]] = {}
+        self._inflight: dict[tuple[str, int], asyncio.Task] = {}
+
+    def set(self, channel_id, user_id: int, subscribed: bool) -> None:
+        now = time.monotonic()
+        if len(self._entries) >= self.max_size:
+            self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        self._entries[(str(channel_id), user_id)] = (subscribed, now + ttl)
+
+    def invalidate(self, user_id: int) -> None:
+        for key in [k for k in self._entries if k[1] == user_id]:
+            del self._entries[key]
+
+    async def check(self, bot, channel_id, user_id: int) -> bool:
+        key = (str(channel_id), user_id)
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        # Запрос идёт отдельной задачей: отмена одного из ждущих не трогает
+        # остальных и не превращается для них в «не подписан»
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._lookup(bot, channel_id, user_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, bot, channel_id, user_id: int) -> bool:
+        try:
+            member = await bot.get_chat_member(channel_id, user_id)
+        except Exception:
+            # Ошибку API не кэшируем
+            return False
+        subscribed = member.status in SUBSCRIBED_STATUSES
+        self.set(channel_id, user_id, subscribed)
+        return subscribed
+
+
+subscriptions = SubscriptionCache()
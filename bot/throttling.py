@@ -0,0 +1,64 @@
+"""
+Троттлинг входящих апдейтов (outer middleware aiogram)
+
+Сообщения ограничиваются по пользователю, нажатия кнопок — по паре
+(пользователь, префикс callback_data), чтобы частые «Я оплатил» не блокировали
+чат. Лишние апдейты отбрасываются до фильтров и обработчиков, так что спам
+одного клиента не нагружает БД и Bot API.
+"""
+from __future__ import annotations
+import math
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from bot.ratelimit import BucketStore, buckets
+
+# Предупреждение «слишком часто» — не чаще раза в WARN_INTERVAL секунд
+WARN_INTERVAL = 10.0
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate: float = 1.0, burst: float = 10.0,
+                 exempt: set[int] | None = None, store: BucketStore = buckets):
+        self.rate = rate
+        self.burst = burst
+        self.exempt = exempt or set()
+        self.store = store
+
+    @staticmethod
+    def scope(event: TelegramObject) -> str:
+        if isinstance(event, CallbackQuery):
+            return "cb:" + (event.data or "").partition(":")[0]
+        return "msg"
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        retry_after = self.store.hit((self.scope(event), user.id), self.rate, self.burst)
+        if not retry_after:
+            return await handler(event, data)
+
+        if not self.store.hit(("throttle-warn", user.id), 1 / WARN_INTERVAL, 1):
+            text = f"⏳ Слишком много запросов. Подождите {math.ceil(retry_after)} с."
+            try:
+                if isinstance(event, (CallbackQuery, Message)):
+                    await event.answer(text)
+            except TelegramAPIError:
+                pass
+        elif isinstance(event, CallbackQuery):
+            # Без ответа клиент Telegram крутит часики на кнопке
+            try:
+                await event.answer()
+            except TelegramAPIError:
+                pass
+        return None
@@ -16,3 +16,13 @@ def format_amount(amount: float) -> str:
 def escape_html(text: str) -> str:
     """Экранирует HTML-символы"""
     return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def referral_code(tg_id: int) -> str:
+    """Реферальный код пользователя"""
+    return f"REF{tg_id}"
+
+def parse_referral_code(code: str | None) -> int | None:
+    """tg_id пригласившего из кода REF{tg_id} или None"""
+    if code and code.startswith("REF") and code[3:].isdigit():
+        return int(code[3:])
+    return None
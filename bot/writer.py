@@ -0,0 +1,144 @@
+"""
+Единственный писатель SQLite с group commit
+
+SQLite допускает одного писателя, а каждый commit — это fsync. Writer держит
+одно соединение и очередь операций: всё, что пришло, пока шёл предыдущий
+commit (и за окно window, если оно задано), выполняется одной транзакцией.
+Каждая операция обёрнута в SAVEPOINT — ошибка откатывает только её, остальные
+коммитятся. Future вызывающего разрешается после COMMIT, так что следующее
+чтение уже видит запись.
+
+Операция — корутина fn(conn), она получает соединение писателя и не должна
+сама вызывать commit(), executescript() или снова обращаться к Writer.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import logging
+from dataclasses import dataclass
+from typing import Any, AsyncContextManager, Awaitable, Callable, Iterable, TypeVar
+
+logger = logging.getLogger("paydesk.writer")
+
+T = TypeVar("T")
+
+# Окно ожидания после первой операции пачки. 0 — пачку набирает сам commit:
+# пока идёт fsync, новые операции копятся в очереди. Под нагрузкой этого
+# достаточно, а одиночная запись не ждёт лишнего.
+WINDOW = 0.0
+MAX_BATCH = 256
+
+
+@dataclass(frozen=True)
+class WriteResult:
+    rowcount: int
+    lastrowid: int | None
+
+
+class Writer:
+    def __init__(self, connect: Callable[[], AsyncContextManager], window: float = WINDOW,
+                 max_batch: int = MAX_BATCH):
+        self._connect = connect
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue[tuple[Callable[[Any], Awaitable[Any]], asyncio.Future]] | None = None
+        self._task: asyncio.Task | None = None
+        # Счётчики для /metrics и отладки: транзакций и операций в них
+        self.batches = 0
+        self.ops = 0
+
+    async def run(self, fn: Callable[[Any], Awaitable[T]]) -> T:
+        """Выполнить операцию в ближайшей транзакции писателя и дождаться COMMIT"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, future))
+        return await future
+
+    async def execute(self, sql: str, params: Iterable[Any] = ()) -> WriteResult:
+        async def op(conn) -> WriteResult:
+            cur = await conn.execute(sql, tuple(params))
+            return WriteResult(cur.rowcount, cur.lastrowid)
+        return await self.run(op)
+
+    async def executemany(self, sql: str, rows: Iterable[Iterable[Any]]) -> WriteResult:
+        async def op(conn) -> WriteResult:
+            cur = await conn.executemany(sql, [tuple(r) for r in rows])
+            return WriteResult(cur.rowcount, None)
+        return await self.run(op)
+
+    async def close(self) -> None:
+        """Дописать очередь и закрыть соединение"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        with contextlib.suppress(Exception):
+            await self._task
+        self._task = None
+
+    async def _collect(self) -> list[tuple[Callable, asyncio.Future]] | None:
+        first = await self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        if self.window:
+            await asyncio.sleep(self.window)
+        while len(batch) < self.max_batch and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is None:
+                # close(): дописываем собранное, затем выходим
+                self._queue.put_nowait(None)
+                break
+            batch.append(item)
+        return batch
+
+    async def _loop(self) -> None:
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                conn = await stack.enter_async_context(self._connect())
+                while (batch := await self._collect()) is not None:
+                    await self._commit(conn, batch)
+        except Exception as e:
+            # Соединение не открылось/упало: никто не должен ждать вечно
+            logger.exception("writer stopped")
+            while not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is not None and not item[1].done():
+                    item[1].set_exception(e)
+            raise
+
+    async def _commit(self, conn, batch: list[tuple[Callable, asyncio.Future]]) -> None:
+        results: list[tuple[asyncio.Future, bool, Any]] = []
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                await conn.execute("SAVEPOINT op")
+                try:
+                    result = await fn(conn)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO op")
+                    await conn.execute("RELEASE op")
+                    results.append((future, False, e))
+                else:
+                    await conn.execute("RELEASE op")
+                    results.append((future, True, result))
+            await conn.commit()
+        except Exception as e:
+            # Не удалось начать или закоммитить транзакцию — падают все операции пачки
+            logger.exception("write batch of %d failed", len(batch))
+            with contextlib.suppress(Exception):
+                await conn.rollback()
+            for _fn, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.ops += len(batch)
+        for future, ok, value in results:
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
@@ -32,14 +32,25 @@ def run_both():
     from bot.main import main
     main()
 
+def run_shards(workers: int | None):
+    """Ingress + N процессов-воркеров (шардирование по пользователю)"""
+    from bot.shard import main
+    main(workers)
+
 def main():
     parser = argparse.ArgumentParser(description="NightLab Bot Launcher")
     parser.add_argument(
         "mode",
-        choices=["bot", "api", "both"],
+        choices=["bot", "api", "both", "shards"],
         default="bot",
         nargs="?",
-        help="Что запустить: bot (только бот), api (только API), both (оба)"
+        help="Что запустить: bot (только бот), api (только API), both (оба), shards (бот в N процессах)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Число процессов-воркеров для режима shards (по умолчанию — число ядер)"
     )
     
     args = parser.parse_args()
@@ -52,6 +63,8 @@ def main():
         run_api()
     elif args.mode == "both":
         run_both()
+    elif args.mode == "shards":
+        run_shards(args.workers)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,64 @@
+import asyncio
+
+from bot.db import Database
+
+
+def test_active_apps_see_app_created_by_other_process(tmp_path):
+    """Заявка, созданная другим Database (API), видна боту при непустом индексе"""
+
+    async def scenario():
+        path = str(tmp_path / "t.db")
+        bot_db = Database(path)
+        api_db = Database(path)
+        await bot_db.init()
+        await api_db.init()
+        try:
+            await bot_db.upsert_user(5, "u5")
+            first = await bot_db.create_application(5, None, 10.0, "C1")
+            assert [a["id"] for a in await bot_db.get_active_apps_for_user(5)] == [first]
+
+            second = await api_db.create_application(5, None, 20.0, "C2")
+            await api_db.set_app_status(second, "WAITING_PAYMENT")
+
+            apps = await bot_db.get_active_apps_for_user(5)
+            assert [a["id"] for a in apps] == [second, first]
+            assert apps[0]["status"] == "WAITING_PAYMENT"
+
+            # Закрытая другим процессом заявка пропадает из ответа
+            await api_db.set_app_status(first, "REJECTED")
+            assert [a["id"] for a in await bot_db.get_active_apps_for_user(5)] == [second]
+        finally:
+            await api_db.close()
+            await bot_db.close()
+
+    asyncio.run(scenario())
+
+
+def test_api_without_index_sees_bot_changes(tmp_path):
+    """API (active_index=False) видит статус и мерчанта, которые выставил бот"""
+
+    async def scenario():
+        path = str(tmp_path / "t.db")
+        bot_db = Database(path)
+        api_db = Database(path, active_index=False)
+        await bot_db.init()
+        await api_db.init()
+        try:
+            await bot_db.upsert_user(5, "u5")
+            await bot_db.upsert_user(20, "m20")
+            app_id = await bot_db.create_application(5, None, 10.0, "C1")
+            assert (await api_db.get_application_view(app_id))["status"] == "WAITING_MERCHANT"
+            assert (await api_db.get_chat_participants(app_id))["merchant_tg_id"] is None
+
+            assert await bot_db.assign_merchant(app_id, 20)
+            parts = await api_db.get_chat_participants(app_id)
+            assert (parts["merchant_tg_id"], parts["merchant_username"]) == (20, "m20")
+
+            await bot_db.set_app_status(app_id, "CONFIRMED")
+            assert (await api_db.get_application_view(app_id))["status"] == "CONFIRMED"
+            assert len(api_db.active) == 0
+        finally:
+            await api_db.close()
+            await bot_db.close()
+
+    asyncio.run(scenario())
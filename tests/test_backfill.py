@@ -0,0 +1,72 @@
+import asyncio
+import sqlite3
+
+from bot.db import Database
+
+
+def test_daily_stats_backfill_retried_until_marked(tmp_path):
+    """Таблица создана, бэкфилл не выполнен (упали между ними) — init() его повторит"""
+    path = str(tmp_path / "t.db")
+
+    async def init_and_create():
+        db = Database(path)
+        await db.init()
+        await db.upsert_user(5, "u5")
+        await db.create_application(5, None, 10.0, "C1")
+        await db.create_application(5, None, 20.0, "C2")
+        await db.close()
+
+    async def init_and_count():
+        db = Database(path)
+        await db.init()
+        await db.close()
+        with sqlite3.connect(path) as conn:
+            return conn.execute("SELECT SUM(apps_count), SUM(amount_uah) FROM daily_stats").fetchone()
+
+    asyncio.run(init_and_create())
+    with sqlite3.connect(path) as conn:
+        conn.execute("DELETE FROM daily_stats")
+        conn.execute("DELETE FROM settings WHERE key='backfill:daily_stats'")
+    assert asyncio.run(init_and_count()) == (2, 30.0)
+
+    # Отметка есть — повторный init() историю не пересчитывает
+    with sqlite3.connect(path) as conn:
+        conn.execute("DELETE FROM daily_stats")
+    assert asyncio.run(init_and_count()) == (None, None)
+
+
+def test_search_backfill_retried_until_marked(tmp_path):
+    """Индекс поиска создан пустым (бэкфилл не дошёл) — init() проиндексирует историю"""
+    path = str(tmp_path / "t.db")
+
+    async def init_and_create():
+        db = Database(path)
+        await db.init()
+        await db.upsert_user(5, "findme")
+        await db.close()
+
+    async def init_and_count():
+        db = Database(path)
+        await db.init()
+        await db.close()
+        with sqlite3.connect(path) as conn:
+            return conn.execute("SELECT COUNT(*) FROM search_index WHERE search_index MATCH 'findme'").fetchone()[0]
+
+    asyncio.run(init_and_create())
+    with sqlite3.connect(path) as conn:
+        conn.execute("DELETE FROM search_index")
+        conn.execute("DELETE FROM settings WHERE key='backfill:search_index'")
+    assert asyncio.run(init_and_count()) == 1
+
+
+def test_concurrent_init_backfills_once(tmp_path):
+    """Воркеры и API стартуют одновременно на новой базе"""
+
+    async def scenario():
+        dbs = [Database(str(tmp_path / "t.db")) for _ in range(4)]
+        await asyncio.gather(*(db.init() for db in dbs))
+        assert all(db.has_search for db in dbs)
+        for db in dbs:
+            await db.close()
+
+    asyncio.run(scenario())
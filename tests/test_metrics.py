@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+from bot.metrics import Registry
+from bot.sender import Sender
+from bot.session import BotSession
+
+
+def test_second_session_and_sender_share_metrics():
+    """Второй BotSession/Sender в процессе не падает на повторной регистрации"""
+
+    async def scenario():
+        metrics = Registry()
+        first = BotSession(metrics=metrics)
+        second = BotSession(metrics=metrics)
+        assert first.m_requests is second.m_requests
+        assert metrics.render().count("# TYPE bot_api_requests_total") == 1
+        Sender(object(), metrics=metrics)
+        Sender(object(), metrics=metrics)
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+def test_same_name_other_kind_rejected():
+    metrics = Registry()
+    metrics.counter("x_total", "x")
+    with pytest.raises(ValueError):
+        metrics.gauge("x_total", "x")
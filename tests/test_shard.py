@@ -0,0 +1,29 @@
+from aiogram.types import Update
+
+from bot.scheduler import UpdateScheduler
+from bot.shard import shard_of
+
+CHAT = {"id": -100500, "type": "channel", "title": "c"}
+
+
+def member(user_id, status):
+    return {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "u"}}
+
+
+def test_chat_member_routed_by_member_not_actor():
+    """Админ (from) добавил участника: апдейт идёт в шард и очередь участника"""
+    raw = {"update_id": 1, "chat_member": {
+        "chat": CHAT, "from": {"id": 7, "is_bot": False, "first_name": "admin"}, "date": 0,
+        "old_chat_member": member(12, "left"), "new_chat_member": member(12, "member"),
+    }}
+    assert shard_of(raw, 5) == 12 % 5
+    assert UpdateScheduler.key(Update.model_validate(raw), {}) == ("user", 12)
+
+
+def test_my_chat_member_routed_by_chat():
+    raw = {"update_id": 2, "my_chat_member": {
+        "chat": CHAT, "from": {"id": 7, "is_bot": False, "first_name": "admin"}, "date": 0,
+        "old_chat_member": member(99, "left"), "new_chat_member": member(99, "member"),
+    }}
+    assert shard_of(raw, 5) == CHAT["id"] % 5
+    assert UpdateScheduler.key(Update.model_validate(raw), {}) == ("chat", CHAT["id"])
@@ -9,11 +9,17 @@ const CONFIG = {
     // API_URL: 'http://localhost:8000',
 };
 
+const APPS_PAGE_SIZE = 20;
+const APPS_POLL_INTERVAL = 30000;
+
 // ===== Global Variables =====
 let tg = null;
 let currentUser = null;
 let initData = '';
 let appsOffset = 0;
+let appsList = null;
+let appsHasMore = false;
+let appsLoading = false;
 let currentFilter = 'all';
 let selectedCountry = null;
 let selectedBank = null;
@@ -25,6 +31,7 @@ document.addEventListener('DOMContentLoaded', () => {
     setupFilters();
     setupHapticFeedback();
     loadInitialData();
+    setInterval(pollApplications, APPS_POLL_INTERVAL);
 });
 
 function initTelegramWebApp() {
@@ -140,12 +147,12 @@ async function loadInitialData() {
 
 async function loadStats() {
     try {
-        const stats = await apiGet('/api/stats');
-        
-        animateCounter('stat-total-apps', stats.total_applications);
-        animateCurrency('stat-turnover', stats.turnover);
-        animateCounter('stat-users', stats.total_users);
-        animateCounter('stat-today', stats.today_applications);
+        await apiCached('/api/stats', stats => {
+            animateCounter('stat-total-apps', stats.total_applications);
+            animateCurrency('stat-turnover', stats.turnover);
+            animateCounter('stat-users', stats.total_users);
+            animateCounter('stat-today', stats.today_applications);
+        });
     } catch (error) {
         console.error('Failed to load stats:', error);
     }
@@ -153,76 +160,135 @@ async function loadStats() {
 
 async function loadProfile() {
     try {
-        const [profile, userStats] = await Promise.all([
-            apiGet('/api/user/profile'),
-            apiGet('/api/user/stats')
+        await Promise.all([
+            apiCached('/api/user/profile', renderProfile),
+            apiCached('/api/user/stats', renderUserStats)
         ]);
-        
-        // Profile
-        document.getElementById('profile-username').textContent = `@${profile.username}`;
-        document.getElementById('profile-role').textContent = profile.role;
-        document.getElementById('profile-balance').textContent = formatCurrency(profile.balance_uah);
-        document.getElementById('profile-avatar-text').textContent = profile.username.charAt(0).toUpperCase();
-        
-        // Stats
-        document.getElementById('user-stat-apps').textContent = userStats.total_applications;
-        document.getElementById('user-stat-confirmed').textContent = userStats.confirmed_applications;
-        document.getElementById('user-stat-spent').textContent = formatCurrency(userStats.total_spent);
-        
-        // Referral
-        document.getElementById('referral-count').textContent = 
-            `${profile.referral_count} приглашённых`;
-        document.getElementById('referral-link').value = profile.referral_link;
-        
     } catch (error) {
         console.error('Failed to load profile:', error);
         showToast('Ошибка загрузки профиля', 'error');
     }
 }
 
+function renderProfile(profile) {
+    document.getElementById('profile-username').textContent = `@${profile.username}`;
+    document.getElementById('profile-role').textContent = profile.role;
+    document.getElementById('profile-balance').textContent = formatCurrency(profile.balance_uah);
+    document.getElementById('profile-avatar-text').textContent = profile.username.charAt(0).toUpperCase();
+    
+    // Referral
+    document.getElementById('referral-count').textContent = 
+        `${profile.referral_count} приглашённых`;
+    document.getElementById('referral-link').value = profile.referral_link;
+}
+
+function renderUserStats(userStats) {
+    document.getElementById('user-stat-apps').textContent = userStats.total_applications;
+    document.getElementById('user-stat-confirmed').textContent = userStats.confirmed_applications;
+    document.getElementById('user-stat-spent').textContent = formatCurrency(userStats.total_spent);
+}
+
+function getAppsList() {
+    if (!appsList) {
+        appsList = new VirtualList(document.getElementById('applications-list'), {
+            renderRow: createAppCard,
+            onNearEnd: () => {
+                if (appsHasMore && !appsLoading) {
+                    loadMoreApps();
+                }
+            }
+        });
+    }
+    return appsList;
+}
+
+function appsEndpoint(offset) {
+    const params = new URLSearchParams({
+        limit: APPS_PAGE_SIZE.toString(),
+        offset: offset.toString()
+    });
+    
+    if (currentFilter !== 'all') {
+        params.append('status', currentFilter);
+    }
+    
+    return `/api/applications?${params}`;
+}
+
 async function loadApplications() {
-    const container = document.getElementById('applications-list');
+    const list = getAppsList();
+    const filter = currentFilter;
+    const offset = appsOffset;
+    appsLoading = true;
     
     try {
-        const params = new URLSearchParams({
-            limit: '20',
-            offset: appsOffset.toString()
-        });
-        
-        if (currentFilter !== 'all') {
-            params.append('status', currentFilter);
+        // Первая страница — из кэша с перепроверкой, следующие дописываются один раз
+        if (offset === 0) {
+            await apiCached(appsEndpoint(0), apps => {
+                if (filter === currentFilter) renderApplications(apps, true);
+            });
+        } else {
+            const apps = await apiGet(appsEndpoint(offset));
+            if (filter === currentFilter) renderApplications(apps, false);
         }
         
-        const apps = await apiGet(`/api/applications?${params}`);
-        
-        if (appsOffset === 0) {
-            container.innerHTML = '';
+    } catch (error) {
+        console.error('Failed to load applications:', error);
+        if (offset === 0) {
+            list.showPlaceholder('<div class="empty-state">Ошибка загрузки</div>');
+        } else if (appsOffset === offset) {
+            appsOffset -= APPS_PAGE_SIZE;
         }
-        
-        if (apps.length === 0 && appsOffset === 0) {
-            container.innerHTML = `
-                <div class="empty-state">
-                    <div class="empty-state-icon">📄</div>
-                    <p>У вас пока нет заявок</p>
-                </div>
-            `;
-            document.getElementById('load-more').style.display = 'none';
-            return;
+    } finally {
+        appsLoading = false;
+        // Короткая страница могла не заполнить экран — перепроверяем, не пора ли грузить дальше
+        list.schedule();
+    }
+}
+
+function renderApplications(apps, firstPage) {
+    const list = getAppsList();
+    
+    if (firstPage && appsOffset > 0) {
+        // Свежая первая страница пришла, когда уже подгружены следующие: обновляем строки на месте
+        list.update(apps);
+        return;
+    }
+    
+    if (firstPage && apps.length === 0) {
+        list.showPlaceholder(`
+            <div class="empty-state">
+                <div class="empty-state-icon">📄</div>
+                <p>У вас пока нет заявок</p>
+            </div>
+        `);
+        appsHasMore = false;
+    } else {
+        if (firstPage) {
+            list.reset(apps);
+        } else {
+            list.append(apps);
+        }
+        appsHasMore = apps.length === APPS_PAGE_SIZE;
+    }
+    
+    document.getElementById('load-more').style.display = appsHasMore ? 'block' : 'none';
+}
+
+// Статусы меняются на стороне бота: пока открыта вкладка заявок, перепроверяем
+// первую страницу (If-None-Match) и обновляем изменившиеся строки
+async function pollApplications() {
+    const page = document.getElementById('page-apps');
+    if (!appsList || document.hidden || !page.classList.contains('active')) return;
+    
+    try {
+        const filter = currentFilter;
+        const { data, changed } = await revalidate(appsEndpoint(0));
+        if (changed && filter === currentFilter) {
+            appsList.update(data);
         }
-        
-        apps.forEach((app, index) => {
-            const card = createAppCard(app);
-            card.style.animationDelay = `${index * 0.05}s`;
-            card.classList.add('animated');
-            container.appendChild(card);
-        });
-        
-        document.getElementById('load-more').style.display = 
-            apps.length === 20 ? 'block' : 'none';
-        
     } catch (error) {
-        console.error('Failed to load applications:', error);
-        container.innerHTML = '<div class="empty-state">Ошибка загрузки</div>';
+        console.error('Failed to refresh applications:', error);
     }
 }
 
@@ -260,7 +326,7 @@ function createAppCard(app) {
 }
 
 function loadMoreApps() {
-    appsOffset += 20;
+    appsOffset += APPS_PAGE_SIZE;
     loadApplications();
 }
 
@@ -305,9 +371,11 @@ async function showAppDetails(appId) {
                     <span class="detail-value">${formatDateTime(app.expires_at)}</span>
                 </div>
             ` : ''}
+            <div class="chat-thread" id="chat-thread"></div>
         `;
         
         document.getElementById('app-modal').classList.add('active');
+        loadChatThread(app.id);
         
         if (tg?.HapticFeedback) {
             tg.HapticFeedback.impactOccurred('medium');
@@ -319,6 +387,62 @@ async function showAppDetails(appId) {
     }
 }
 
+// ===== Chat History =====
+async function loadChatThread(appId, beforeId = null) {
+    const container = document.getElementById('chat-thread');
+    if (!container) return;
+    
+    try {
+        const params = new URLSearchParams({ limit: '20' });
+        if (beforeId) {
+            params.append('before_id', beforeId.toString());
+        }
+        
+        const { messages, next_before_id } = await apiGet(`/api/application/${appId}/messages?${params}`);
+        
+        if (!beforeId) {
+            container.innerHTML = '';
+            if (messages.length === 0) return;
+            
+            const title = document.createElement('span');
+            title.className = 'detail-label';
+            title.textContent = 'Переписка';
+            container.appendChild(title);
+        }
+        
+        container.querySelector('.chat-more')?.remove();
+        
+        // API отдаёт новые сначала — в треде показываем старые сверху
+        const anchor = container.querySelector('.chat-msg');
+        messages.slice().reverse().forEach(m => {
+            const item = document.createElement('div');
+            item.className = `chat-msg ${m.from_me ? 'mine' : ''}`;
+            
+            const text = document.createElement('div');
+            text.className = 'chat-msg-text';
+            text.textContent = m.text;
+            
+            const time = document.createElement('div');
+            time.className = 'chat-msg-time';
+            time.textContent = formatDateTime(m.created_at);
+            
+            item.append(text, time);
+            container.insertBefore(item, anchor);
+        });
+        
+        if (next_before_id) {
+            const more = document.createElement('button');
+            more.className = 'chat-more';
+            more.textContent = 'Показать ранее';
+            more.onclick = () => loadChatThread(appId, next_before_id);
+            container.insertBefore(more, container.querySelector('.chat-msg'));
+        }
+        
+    } catch (error) {
+        console.error('Failed to load chat history:', error);
+    }
+}
+
 function closeModal() {
     document.getElementById('app-modal').classList.remove('active');
 }
@@ -327,30 +451,30 @@ async function loadNotifications() {
     const container = document.getElementById('notifications-list');
     
     try {
-        const notifications = await apiGet('/api/notifications?limit=50');
-        
-        if (notifications.length === 0) {
-            container.innerHTML = `
-                <div class="empty-state">
-                    <div class="empty-state-icon">🔔</div>
-                    <p>Нет уведомлений</p>
-                </div>
-            `;
-            return;
-        }
-        
-        container.innerHTML = notifications.map((n, index) => `
-            <div class="notification-card ${n.is_read ? '' : 'unread'}" 
-                 onclick="markNotificationRead(${n.id})"
-                 style="animation-delay: ${index * 0.05}s">
-                <div class="notification-icon">${getNotificationIcon(n.type)}</div>
-                <div class="notification-content">
-                    <div class="notification-title">${n.title}</div>
-                    <div class="notification-message">${n.message}</div>
-                    <div class="notification-time">${formatDateTime(n.created_at)}</div>
+        await apiCached('/api/notifications?limit=50', notifications => {
+            if (notifications.length === 0) {
+                container.innerHTML = `
+                    <div class="empty-state">
+                        <div class="empty-state-icon">🔔</div>
+                        <p>Нет уведомлений</p>
+                    </div>
+                `;
+                return;
+            }
+            
+            container.innerHTML = notifications.map((n, index) => `
+                <div class="notification-card ${n.is_read ? '' : 'unread'}" 
+                     onclick="markNotificationRead(${n.id})"
+                     style="animation-delay: ${index * 0.05}s">
+                    <div class="notification-icon">${getNotificationIcon(n.type)}</div>
+                    <div class="notification-content">
+                        <div class="notification-title">${n.title}</div>
+                        <div class="notification-message">${n.message}</div>
+                        <div class="notification-time">${formatDateTime(n.created_at)}</div>
+                    </div>
                 </div>
-            </div>
-        `).join('');
+            `).join('');
+        });
         
     } catch (error) {
         console.error('Failed to load notifications:', error);
@@ -370,10 +494,11 @@ async function markNotificationRead(id) {
 
 async function loadUnreadCount() {
     try {
-        const { count } = await apiGet('/api/notifications/unread-count');
-        const badge = document.getElementById('notif-badge');
-        badge.textContent = count;
-        badge.style.display = count > 0 ? 'flex' : 'none';
+        await apiCached('/api/notifications/unread-count', ({ count }) => {
+            const badge = document.getElementById('notif-badge');
+            badge.textContent = count;
+            badge.style.display = count > 0 ? 'flex' : 'none';
+        });
     } catch (error) {
         console.error('Failed to load unread count:', error);
     }
@@ -385,14 +510,14 @@ async function loadCountries() {
     container.innerHTML = '<div class="loading-spinner">Загрузка...</div>';
     
     try {
-        const countries = await apiGet('/api/countries');
-        
-        container.innerHTML = countries.map((c, index) => `
-            <div class="option-card" onclick="selectCountry(${c.id}, '${c.name}')" style="animation-delay: ${index * 0.05}s">
-                <div class="option-icon">🌍</div>
-                <span class="option-text">${c.name}</span>
-            </div>
-        `).join('');
+        await apiCached('/api/countries', countries => {
+            container.innerHTML = countries.map((c, index) => `
+                <div class="option-card" onclick="selectCountry(${c.id}, '${c.name}')" style="animation-delay: ${index * 0.05}s">
+                    <div class="option-icon">🌍</div>
+                    <span class="option-text">${c.name}</span>
+                </div>
+            `).join('');
+        });
         
     } catch (error) {
         console.error('Failed to load countries:', error);
@@ -425,14 +550,14 @@ async function loadBanks(countryId) {
     container.innerHTML = '<div class="loading-spinner">Загрузка банков...</div>';
     
     try {
-        const banks = await apiGet(`/api/banks?country_id=${countryId}`);
-        
-        container.innerHTML = banks.map((b, index) => `
-            <div class="option-card" onclick="selectBank(${b.id}, '${b.name}')" style="animation-delay: ${index * 0.05}s">
-                <div class="option-icon">🏦</div>
-                <span class="option-text">${b.name}</span>
-            </div>
-        `).join('');
+        await apiCached(`/api/banks?country_id=${countryId}`, banks => {
+            container.innerHTML = banks.map((b, index) => `
+                <div class="option-card" onclick="selectBank(${b.id}, '${b.name}')" style="animation-delay: ${index * 0.05}s">
+                    <div class="option-icon">🏦</div>
+                    <span class="option-text">${b.name}</span>
+                </div>
+            `).join('');
+        });
         
     } catch (error) {
         console.error('Failed to load banks:', error);
@@ -498,17 +623,9 @@ async function submitApplication() {
         });
         
         if (result.success) {
-            // Если нет автовыдачи (реквизитов), отправляем боту для отправки в чат мерчантов
-            if (!result.requisites && tg?.sendData) {
-                tg.sendData(JSON.stringify({
-                    action: 'new_app_merchant',
-                    app_id: result.app_id,
-                    bank_name: result.bank_name || selectedBank.name,
-                    amount: result.amount || amount,
-                    country_name: result.country_name || selectedCountry.name
-                }));
-            } else if (result.requisites && tg?.sendData) {
-                // Если есть автовыдача, просто уведомляем бота
+            // Заявку без автовыдачи сервер сам передаёт мерчантам,
+            // боту сообщаем только о создании
+            if (tg?.sendData) {
                 tg.sendData(JSON.stringify({
                     action: 'app_created',
                     app_id: result.app_id
@@ -555,20 +672,271 @@ function resetForm() {
     loadCountries();
 }
 
-// ===== API Helpers =====
-async function apiGet(endpoint) {
-    const response = await fetch(`${CONFIG.API_URL}${endpoint}`, {
-        headers: {
-            'X-Init-Data': initData,
-            'Content-Type': 'application/json'
+// ===== Virtual List =====
+// Рисует только строки в окне просмотра (плюс overscan). Карточки одной высоты,
+// поэтому позиция строки — индекс * высота, а контейнер получает полную высоту
+// списка. DOM-узлы хранятся по id: при обновлении данных перерисовываются
+// только строки, у которых изменилось содержимое.
+class VirtualList {
+    constructor(container, { renderRow, keyOf = item => item.id, gap = 12, overscan = 4, onNearEnd = null }) {
+        this.container = container;
+        this.renderRow = renderRow;
+        this.keyOf = keyOf;
+        this.gap = gap;
+        this.overscan = overscan;
+        this.onNearEnd = onNearEnd;
+        this.items = [];
+        this.rows = new Map();
+        this.rowHeight = 0;
+        this.hasPlaceholder = true;
+        this.scheduled = false;
+        
+        container.classList.add('virtual');
+        window.addEventListener('scroll', () => this.schedule(), { passive: true });
+        window.addEventListener('resize', () => {
+            this.rowHeight = 0;
+            this.schedule();
+        }, { passive: true });
+    }
+    
+    reset(items) {
+        this.items = items.slice();
+        this.render();
+    }
+    
+    append(items) {
+        const known = new Set(this.items.map(this.keyOf));
+        this.items.push(...items.filter(item => !known.has(this.keyOf(item))));
+        this.render();
+    }
+    
+    // Известные id обновляются на месте, новые — в начало (список от новых к старым)
+    update(items) {
+        const positions = new Map(this.items.map((item, index) => [this.keyOf(item), index]));
+        const fresh = [];
+        
+        items.forEach(item => {
+            const index = positions.get(this.keyOf(item));
+            if (index === undefined) {
+                fresh.push(item);
+            } else {
+                this.items[index] = item;
+            }
+        });
+        
+        this.items.unshift(...fresh);
+        this.render();
+    }
+    
+    showPlaceholder(html) {
+        this.items = [];
+        this.rows.clear();
+        this.container.style.height = '';
+        this.container.innerHTML = html;
+        this.hasPlaceholder = true;
+    }
+    
+    schedule() {
+        if (this.scheduled) return;
+        this.scheduled = true;
+        requestAnimationFrame(() => {
+            this.scheduled = false;
+            this.render();
+        });
+    }
+    
+    measure() {
+        const probe = this.renderRow(this.items[0]);
+        probe.classList.add('vlist-row');
+        probe.style.visibility = 'hidden';
+        this.container.appendChild(probe);
+        this.rowHeight = probe.offsetHeight + this.gap;
+        probe.remove();
+    }
+    
+    render() {
+        // Скрытая вкладка (display: none) — нечего мерить, отрисуем при показе
+        if (!this.items.length || !this.container.offsetParent) return;
+        
+        if (this.hasPlaceholder) {
+            this.container.innerHTML = '';
+            this.hasPlaceholder = false;
         }
-    });
+        if (!this.rowHeight) {
+            this.measure();
+        }
+        
+        const total = this.items.length;
+        const top = this.container.getBoundingClientRect().top;
+        const first = Math.max(0, Math.floor(-top / this.rowHeight) - this.overscan);
+        const last = Math.min(total, Math.ceil((window.innerHeight - top) / this.rowHeight) + this.overscan);
+        const visible = new Set();
+        
+        this.container.style.height = `${total * this.rowHeight - this.gap}px`;
+        
+        for (let index = first; index < last; index++) {
+            const item = this.items[index];
+            const key = this.keyOf(item);
+            const signature = JSON.stringify(item);
+            let row = this.rows.get(key);
+            
+            if (!row || row.signature !== signature) {
+                const el = this.renderRow(item);
+                el.classList.add('vlist-row');
+                if (row) {
+                    row.el.replaceWith(el);
+                } else {
+                    this.container.appendChild(el);
+                }
+                row = { el, signature };
+                this.rows.set(key, row);
+            }
+            
+            row.el.style.top = `${index * this.rowHeight}px`;
+            visible.add(key);
+        }
+        
+        this.rows.forEach((row, key) => {
+            if (!visible.has(key)) {
+                row.el.remove();
+                this.rows.delete(key);
+            }
+        });
+        
+        if (this.onNearEnd && last >= total) {
+            this.onNearEnd();
+        }
+    }
+}
+
+// ===== Data Cache =====
+// GET-ответы хранятся в памяти и в localStorage (ключ — пользователь + endpoint).
+// apiCached сразу рисует сохранённые данные, затем перепроверяет их запросом
+// с If-None-Match: на 304 перерисовывать нечего. Одинаковые запросы в полёте
+// объединяются в один.
+const CACHE_PREFIX = 'nl-cache:v1:';
+const memoryCache = new Map();
+const inflight = new Map();
+
+// После успешного POST на endpoint с таким префиксом сбрасываются данные,
+// которые он мог изменить
+const INVALIDATION_RULES = [
+    ['/api/applications/create', ['/api/applications', '/api/user/', '/api/stats']],
+    ['/api/notifications/', ['/api/notifications']],
+];
+
+function cacheKey(endpoint) {
+    return `${CACHE_PREFIX}${currentUser?.id ?? 'anon'}:${endpoint}`;
+}
+
+function readCache(key) {
+    if (memoryCache.has(key)) {
+        return memoryCache.get(key);
+    }
+    try {
+        const entry = JSON.parse(localStorage.getItem(key));
+        if (entry) {
+            memoryCache.set(key, entry);
+        }
+        return entry;
+    } catch (error) {
+        return null;
+    }
+}
+
+function writeCache(key, entry) {
+    memoryCache.set(key, entry);
+    try {
+        localStorage.setItem(key, JSON.stringify(entry));
+    } catch (error) {
+        // Переполнен localStorage — выбрасываем свой кэш, в памяти данные остаются
+        storageKeys(CACHE_PREFIX).forEach(k => localStorage.removeItem(k));
+    }
+}
+
+function storageKeys(prefix) {
+    try {
+        return Object.keys(localStorage).filter(k => k.startsWith(prefix));
+    } catch (error) {
+        return [];
+    }
+}
+
+function invalidate(prefixes) {
+    const keys = prefixes.map(cacheKey);
+    const matches = key => keys.some(prefix => key.startsWith(prefix));
+    
+    [...memoryCache.keys()].filter(matches).forEach(key => memoryCache.delete(key));
+    storageKeys(cacheKey('')).filter(matches).forEach(key => localStorage.removeItem(key));
+}
+
+function invalidateAfter(endpoint) {
+    INVALIDATION_RULES
+        .filter(([prefix]) => endpoint.startsWith(prefix))
+        .forEach(([, prefixes]) => invalidate(prefixes));
+}
+
+// Свежие данные с сервера: { data, changed }; changed = false на 304
+function revalidate(endpoint) {
+    const key = cacheKey(endpoint);
+    let request = inflight.get(key);
+    
+    if (!request) {
+        request = fetchConditional(endpoint, key).finally(() => inflight.delete(key));
+        inflight.set(key, request);
+    }
+    
+    return request;
+}
+
+async function fetchConditional(endpoint, key) {
+    const cached = readCache(key);
+    const headers = {
+        'X-Init-Data': initData,
+        'Content-Type': 'application/json'
+    };
+    
+    if (cached?.etag) {
+        headers['If-None-Match'] = cached.etag;
+    }
+    
+    const response = await fetch(`${CONFIG.API_URL}${endpoint}`, { headers });
+    
+    if (response.status === 304 && cached) {
+        return { data: cached.data, changed: false };
+    }
     
     if (!response.ok) {
         throw new Error(`API error: ${response.status}`);
     }
     
-    return response.json();
+    const data = await response.json();
+    writeCache(key, { data, etag: response.headers.get('ETag') });
+    return { data, changed: true };
+}
+
+// Stale-while-revalidate: render вызывается с кэшем сразу и ещё раз,
+// если сервер вернул другие данные
+async function apiCached(endpoint, render) {
+    const cached = readCache(cacheKey(endpoint));
+    
+    if (cached) {
+        render(cached.data);
+    }
+    
+    const { data, changed } = await revalidate(endpoint);
+    
+    if (changed || !cached) {
+        render(data);
+    }
+    
+    return data;
+}
+
+// ===== API Helpers =====
+async function apiGet(endpoint) {
+    const { data } = await revalidate(endpoint);
+    return data;
 }
 
 async function apiPost(endpoint, data) {
@@ -585,6 +953,7 @@ async function apiPost(endpoint, data) {
         throw new Error(`API error: ${response.status}`);
     }
     
+    invalidateAfter(endpoint);
     return response.json();
 }
 
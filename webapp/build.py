@@ -0,0 +1,139 @@
+"""
+Сборка Mini App для раздачи из API-процесса
+
+    python webapp/build.py [--api-url URL] [--base /app/]
+
+Кладёт в webapp/dist/:
+  - index.html — оболочка с инлайном критического CSS (шапка, навигация,
+    главная страница) и ссылками на бандлы;
+  - app.<hash>.js, styles.<hash>.css — минифицированные бандлы с хэшем
+    содержимого в имени (кэшируются навсегда);
+  - .gz (и .br, если установлен пакет brotli) рядом с каждым файлом;
+  - manifest.json — исходное имя -> имя с хэшем.
+"""
+from __future__ import annotations
+import argparse
+import gzip
+import hashlib
+import json
+import re
+import shutil
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: тогда только .gz
+    brotli = None
+
+SRC = Path(__file__).resolve().parent
+DIST = SRC / "dist"
+
+# styles.css до этой секции (/* ===== ... ===== */) — первый экран: переменные,
+# базовые стили, навигация, шапка и карточки статистики. Критическая часть —
+# строго префикс файла, чтобы порядок каскада не изменился.
+CRITICAL_UNTIL = "Quick Actions"
+
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_CSS_SECTION_RE = re.compile(r"^/\* =====\s*(.+?)\s*=====\s*\*/", re.M)
+_HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.S)
+
+
+def minify_css(css: str) -> str:
+    css = _CSS_COMMENT_RE.sub("", css)
+    css = re.sub(r"\s+", " ", css)
+    # Пробел перед ":" не трогаем: "a :hover" и "a:hover" — разные селекторы
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+
+def minify_js(js: str) -> str:
+    """Консервативно: убирает отступы, пустые строки и комментарии на отдельных строках"""
+    out = []
+    in_block_comment = False
+    for line in js.splitlines():
+        stripped = line.strip()
+        if in_block_comment:
+            in_block_comment = "*/" not in stripped
+            continue
+        if stripped.startswith("/*"):
+            in_block_comment = "*/" not in stripped
+            continue
+        if not stripped or stripped.startswith("//"):
+            continue
+        out.append(stripped)
+    return "\n".join(out) + "\n"
+
+
+def minify_html(html: str) -> str:
+    html = _HTML_COMMENT_RE.sub("", html)
+    html = re.sub(r">\s+<", "><", html)
+    return re.sub(r"\n\s*", "\n", html).strip()
+
+
+def split_css(css: str) -> tuple[str, str]:
+    """Делит стили на критические (инлайн) и остальные (отдельный файл)"""
+    for m in _CSS_SECTION_RE.finditer(css):
+        if m.group(1).startswith(CRITICAL_UNTIL):
+            return css[:m.start()], css[m.start():]
+    return css, ""
+
+
+def fingerprint(name: str, data: bytes) -> str:
+    stem, ext = name.rsplit(".", 1)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}.{ext}"
+
+
+def write(path: Path, data: bytes) -> None:
+    """Файл и его сжатые варианты"""
+    path.write_bytes(data)
+    path.with_name(path.name + ".gz").write_bytes(gzip.compress(data, 9, mtime=0))
+    if brotli is not None:
+        path.with_name(path.name + ".br").write_bytes(brotli.compress(data, quality=11))
+
+
+def build(api_url: str = "", base: str = "/app/") -> dict[str, str]:
+    js = (SRC / "app.js").read_text(encoding="utf-8")
+    js = re.sub(r"API_URL:\s*'[^']*'", f"API_URL: {json.dumps(api_url)}", js, count=1)
+    critical, rest = split_css((SRC / "styles.css").read_text(encoding="utf-8"))
+    html = (SRC / "index.html").read_text(encoding="utf-8")
+
+    js_bytes = minify_js(js).encode("utf-8")
+    css_bytes = minify_css(rest).encode("utf-8")
+    manifest = {
+        "app.js": fingerprint("app.js", js_bytes),
+        "styles.css": fingerprint("styles.css", css_bytes),
+    }
+    css_href = base + manifest["styles.css"]
+
+    html = html.replace(
+        '<link rel="stylesheet" href="styles.css">',
+        f"<style>{minify_css(critical)}</style>"
+        f'<link rel="stylesheet" href="{css_href}" media="print" onload="this.media=\'all\'">'
+        f'<noscript><link rel="stylesheet" href="{css_href}"></noscript>',
+    )
+    html = html.replace('<script src="app.js"></script>', f'<script src="{base}{manifest["app.js"]}"></script>')
+
+    if DIST.exists():
+        shutil.rmtree(DIST)
+    DIST.mkdir()
+    write(DIST / manifest["app.js"], js_bytes)
+    write(DIST / manifest["styles.css"], css_bytes)
+    write(DIST / "index.html", minify_html(html).encode("utf-8"))
+    (DIST / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Сборка Mini App в webapp/dist")
+    parser.add_argument("--api-url", default="", help="адрес API; пусто — тот же origin")
+    parser.add_argument("--base", default="/app/", help="URL-префикс, с которого раздаётся dist")
+    args = parser.parse_args()
+    manifest = build(args.api_url, args.base)
+    for path in sorted(DIST.iterdir()):
+        print(f"{path.stat().st_size:8d}  {path.name}")
+    print(json.dumps(manifest))
+
+
+if __name__ == "__main__":
+    main()